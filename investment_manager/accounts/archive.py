@@ -0,0 +1,86 @@
+"""
+Hot/cold storage for transactions.
+
+``archive_before`` moves old transactions into ``ArchivedTransaction`` a
+calendar month at a time and records each month in ``ArchivedPeriod``.
+Readers call ``get_horizon`` and query the archive only when the requested
+range starts before it, so reads of recent data never touch the archive.
+Each shard archives its own rows; the horizon is the newest across shards.
+"""
+from datetime import datetime
+
+from django.db.models import F, Max, Value
+from django.utils import timezone
+
+from . import sharding
+from .models import ArchivedPeriod, ArchivedTransaction, Transaction
+
+
+def get_horizon():
+    """End of the newest archived period, or None if nothing has been archived."""
+    horizons = sharding.fan_out(lambda: ArchivedPeriod.objects.aggregate(horizon=Max('end'))['horizon'])
+    return max(filter(None, horizons), default=None)
+
+
+async def aget_horizon():
+    return (await ArchivedPeriod.objects.aaggregate(horizon=Max('end')))['horizon']
+
+
+def reaches_archive(horizon, start=None):
+    """Whether a range starting at ``start`` (None for unbounded) may include archived rows."""
+    return horizon is not None and (start is None or start < horizon)
+
+
+def month_start(value):
+    return timezone.localtime(value).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def next_month(start):
+    return timezone.make_aware(datetime(start.year + start.month // 12, start.month % 12 + 1, 1))
+
+
+def archive_before(cutoff, batch_size=5000):
+    """
+    Archive every transaction older than the start of ``cutoff``'s month,
+    oldest month first, on every shard. Returns the number of transactions moved.
+    """
+    cutoff = month_start(cutoff)
+    return sum(sharding.fan_out(lambda: _archive_before(cutoff, batch_size)))
+
+
+def _archive_before(cutoff, batch_size):
+    moved = 0
+    while True:
+        oldest = Transaction.objects.filter(timestamp__lt=cutoff).order_by('timestamp').values_list('timestamp', flat=True).first()
+        if oldest is None:
+            return moved
+        start = month_start(oldest)
+        moved += archive_period(start, next_month(start), batch_size)
+
+
+def archive_period(start, end, batch_size=5000):
+    moved = 0
+    transactions = Transaction.objects.filter(timestamp__gte=start, timestamp__lt=end)
+    while True:
+        # Each batch moves, and raises the horizon, in one transaction, so a
+        # reader sees a row in exactly one of the two tables.
+        with sharding.atomic():
+            rows = list(transactions.order_by('id').values_list('id', 'account_id', 'user_id', 'amount', 'timestamp')[:batch_size])
+            if not rows:
+                return moved
+            ArchivedTransaction.objects.bulk_create(
+                [ArchivedTransaction(id=id, account_id=account_id, user_id=user_id, amount=amount, timestamp=timestamp)
+                 for id, account_id, user_id, amount, timestamp in rows],
+                batch_size=1000,
+            )
+            # Archived rows still count towards the balances and rollups, so
+            # skip the delete signals that would take them out of the ledger.
+            sharding.delete_ids(Transaction, [row[0] for row in rows])
+
+            period, _ = ArchivedPeriod.objects.get_or_create(start=start, defaults={'end': end})
+            ArchivedPeriod.objects.filter(pk=period.pk).update(
+                total=F('total') + Value(sum(row[3] for row in rows), output_field=ArchivedPeriod._meta.get_field('total')),
+                transaction_count=F('transaction_count') + len(rows),
+                archived_at=timezone.now(),
+            )
+        moved += len(rows)
@@ -0,0 +1,186 @@
+"""
+Native async versions of the transaction read endpoints.
+
+Enabled with ``ACCOUNTS_ASYNC_VIEWS``. Under an ASGI server these views wait
+on the database without holding a worker thread, and return exactly what the
+DRF views in ``views.py`` return. They serve session users only; other
+clients (Basic auth, anonymous), writes, exports and HTML on the same URLs
+go to the regular DRF views, as does everything once the account data is
+sharded. ``transaction_events``, the change feed, has no sync counterpart
+and is always served from here.
+"""
+from asgiref.sync import sync_to_async
+from django.contrib.auth import get_user
+from django.core.handlers.asgi import ASGIRequest
+from django.db.models import Sum
+from django.http import JsonResponse, StreamingHttpResponse
+from rest_framework import status
+from rest_framework.request import Request
+from rest_framework.utils.encoders import JSONEncoder
+
+from .archive import aget_horizon
+from .conditional import aaccount_state, make_validators, not_modified, stamp
+from . import events, sharding
+from .db_routers import replica_reads
+from .models import AccountUserBalance, ArchivedTransaction, Transaction
+from .pagination import KeysetPagination
+from .permissions import HasAccountPermission, aload_account_permissions
+from .row_serializers import TransactionRowSerializer
+from .reports import archived_report_queryset, report_queryset
+from .views import AdminTransactionViewSet, TransactionViewSet
+
+NOT_AUTHENTICATED = 'Authentication credentials were not provided.'
+PERMISSION_DENIED = 'You do not have permission to perform this action.'
+NOT_FOUND = 'Not found.'
+
+
+def json_response(data, status_code=status.HTTP_200_OK):
+    return JsonResponse(data, status=status_code, encoder=JSONEncoder, safe=False)
+
+
+async def validators(request, user, account_permissions):
+    # Salted like AccountVersionConditionalMixin, so the two paths share ETags
+    salt = (user.pk, request.get_full_path(), 'application/json')
+    return make_validators(await aaccount_state(account_permissions), account_permissions, salt)
+
+
+def wants_json(request):
+    if request.GET.get('format', 'json') != 'json':
+        return False
+    accept = request.headers.get('Accept', '*/*')
+    return 'application/json' in accept or accept.strip() == '*/*'
+
+
+def with_sync_fallback(async_view, sync_view):
+    """
+    Serve JSON reads by session users from ``async_view`` and hand everything
+    else, writes, exports, the browsable API and requests the session does
+    not authenticate, to the DRF view and its authentication classes.
+    """
+    async def view(request, *args, **kwargs):
+        if request.method in ('GET', 'HEAD') and wants_json(request) and not sharding.is_sharded():
+            # Like ReplicaReadMixin: the session user comes from the primary
+            user = await sync_to_async(get_user)(request)
+            if user.is_authenticated:
+                with replica_reads(request):
+                    return await async_view(request, user, *args, **kwargs)
+        return await sync_to_async(sync_view)(request, *args, **kwargs)
+
+    # Django 4.2's csrf_exempt cannot wrap a coroutine; DRF enforces CSRF itself.
+    view.csrf_exempt = True
+    return view
+
+
+async def transaction_list(request, user):
+    account_permissions = await aload_account_permissions(user)
+    etag, last_modified = await validators(request, user, account_permissions)
+    response = not_modified(request, etag, last_modified)
+    if response is not None:
+        return response
+
+    row_serializer = TransactionRowSerializer()
+    rows = row_serializer.select(Transaction.objects.filter(account_id__in=account_permissions))
+    horizon = await aget_horizon()
+    archived = row_serializer.select(ArchivedTransaction.objects.filter(account_id__in=account_permissions)) if horizon is not None else None
+
+    paginator = KeysetPagination()
+    page = await paginator.apaginate_queryset(rows, Request(request), archive=archived, horizon=horizon)
+    return stamp(json_response({
+        'next': paginator.get_next_link(),
+        'previous': paginator.get_previous_link(),
+        'results': row_serializer.serialize(page),
+    }), etag, last_modified)
+
+
+async def transaction_detail(request, user, pk):
+    account_permissions = await aload_account_permissions(user)
+    row_serializer = TransactionRowSerializer()
+    row = await row_serializer.select(Transaction.objects.filter(pk=pk, account_id__in=account_permissions)).afirst()
+    if row is None:
+        row = await row_serializer.select(ArchivedTransaction.objects.filter(pk=pk, account_id__in=account_permissions)).afirst()
+    if row is None:
+        return json_response({'detail': NOT_FOUND}, status_code=status.HTTP_404_NOT_FOUND)
+
+    permission = account_permissions[row.account_id]
+    if not HasAccountPermission().check_permission(permission, request.method):
+        return json_response({'detail': PERMISSION_DENIED}, status_code=status.HTTP_403_FORBIDDEN)
+
+    etag, last_modified = await validators(request, user, {row.account_id: permission})
+    return not_modified(request, etag, last_modified) or stamp(json_response(row_serializer.to_representation(row)), etag, last_modified)
+
+
+async def admin_report(request, user):
+    if not user.is_staff:
+        return json_response({'detail': PERMISSION_DENIED}, status_code=status.HTTP_403_FORBIDDEN)
+
+    transactions, dates, error = report_queryset(request.GET)
+    if error:
+        return json_response({'error': error}, status_code=status.HTTP_400_BAD_REQUEST)
+    horizon = await aget_horizon()
+    archived = archived_report_queryset(request.GET, dates, horizon)
+
+    if dates:
+        total_balance = 0
+        for queryset in (transactions, archived):
+            if queryset is not None:
+                total_balance += (await queryset.aaggregate(total=Sum('amount')))['total'] or 0
+    else:
+        balances = AccountUserBalance.objects.filter(user_id=request.GET.get('user_id'))
+        total_balance = (await balances.aaggregate(total=Sum('balance')))['total'] or 0
+
+    row_serializer = TransactionRowSerializer()
+    paginator = KeysetPagination()
+    page = await paginator.apaginate_queryset(
+        row_serializer.select(transactions), Request(request),
+        archive=row_serializer.select(archived) if archived is not None else None, horizon=horizon,
+    )
+    return json_response({
+        'transactions': row_serializer.serialize(page),
+        'total_balance': total_balance,
+        'next': paginator.get_next_link(),
+        'previous': paginator.get_previous_link(),
+    })
+
+
+async def transaction_events(request):
+    """
+    Stream new transactions on the accounts the user may read as server-sent
+    events, resuming after the cursor in ``Last-Event-ID`` (or the
+    ``last_event_id`` query parameter) if one is sent.
+
+    Under WSGI, which cannot hold a stream open without tying up a worker,
+    the response carries only the missed events and ends; the client's
+    EventSource reconnects after the ``retry`` delay and so polls instead.
+    """
+    if request.method != 'GET':
+        return json_response({'detail': f'Method "{request.method}" not allowed.'}, status_code=status.HTTP_405_METHOD_NOT_ALLOWED)
+    user = await sync_to_async(get_user)(request)
+    if not user.is_authenticated:
+        return json_response({'detail': NOT_AUTHENTICATED}, status_code=status.HTTP_403_FORBIDDEN)
+
+    last_event_id = request.headers.get('Last-Event-ID') or request.GET.get('last_event_id')
+    account_ids = await sync_to_async(events.readable_accounts)(user)
+    if isinstance(request, ASGIRequest):
+        subscription = events.broadcaster.subscribe(account_ids)
+        try:
+            positions, backlog = await sync_to_async(events.catch_up)(account_ids, last_event_id)
+        except BaseException:
+            events.broadcaster.unsubscribe(subscription)
+            raise
+        content = events.Stream(subscription, user, positions, backlog)
+    else:
+        positions, backlog = await sync_to_async(events.catch_up)(account_ids, last_event_id)
+        content = [events.preamble(None if backlog else events.format_cursor(positions))] + [chunk for _, chunk in backlog]
+
+    response = StreamingHttpResponse(content, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Stop proxies such as nginx from buffering the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+transaction_collection = with_sync_fallback(transaction_list, TransactionViewSet.as_view({'get': 'list', 'post': 'create'}))
+transaction_member = with_sync_fallback(transaction_detail, TransactionViewSet.as_view({
+    'get': 'retrieve', 'put': 'update', 'patch': 'partial_update', 'delete': 'destroy',
+}))
+admin_transactions = with_sync_fallback(admin_report, AdminTransactionViewSet.as_view({'get': 'list_user_transactions'}))
@@ -0,0 +1,108 @@
+import hashlib
+from functools import partial
+
+from django.db.models import Count, Max, Sum
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+
+from . import sharding
+from .models import AccountBalance
+from .permissions import HasAccountPermission, get_account_permissions
+
+
+def make_validators(state, account_permissions, salt):
+    """
+    ETag and Last-Modified for a payload drawn from a set of accounts.
+
+    ``state`` is the aggregate of the accounts' version counters. Versions
+    only ever grow, so their sum changes whenever any account in the set
+    changes; the caller's grants are hashed in too, so gaining or losing an
+    account changes the tag even when no version moved.
+    """
+    if not state['count']:
+        return None, None
+
+    digest = hashlib.md5()
+    for part in (state['version'], state['count'], sorted(account_permissions.items()), *salt):
+        digest.update(repr(part).encode())
+        digest.update(b'\0')
+    return f'"{digest.hexdigest()}"', state['modified']
+
+
+def account_state(account_ids):
+    states = sharding.fan_out_accounts(
+        lambda ids: AccountBalance.objects.filter(account_id__in=ids).aggregate(
+            version=Sum('version'), modified=Max('modified'), count=Count('pk'),
+        ),
+        account_ids,
+    )
+    if len(states) == 1:
+        return states[0]
+    # Combine the shards' aggregates the way the single query would have
+    return {
+        'version': sum(state['version'] or 0 for state in states),
+        'modified': max((state['modified'] for state in states if state['modified']), default=None),
+        'count': sum(state['count'] for state in states),
+    }
+
+
+async def aaccount_state(account_ids):
+    return await AccountBalance.objects.filter(account_id__in=account_ids).aaggregate(
+        version=Sum('version'), modified=Max('modified'), count=Count('pk'),
+    )
+
+
+def not_modified(request, etag, last_modified):
+    """The 304 response if the client's copy is still current, else None."""
+    if etag is None:
+        return None
+    response = get_conditional_response(request, etag=etag, last_modified=int(last_modified.timestamp()))
+    return stamp(response, etag, last_modified) if response is not None else None
+
+
+def stamp(response, etag, last_modified):
+    if etag is not None and response.status_code in (200, 304):
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(int(last_modified.timestamp()))
+    return response
+
+
+def conditional(request, etag, last_modified, respond):
+    """
+    Answer 304 if the client's copy is current, otherwise call ``respond``
+    and stamp its result with the validators.
+    """
+    return not_modified(request, etag, last_modified) or stamp(respond(), etag, last_modified)
+
+
+class AccountVersionConditionalMixin:
+    """
+    Conditional GET for viewsets whose payloads depend only on accounts.
+
+    Validators come from the per-account version counters, so a request whose
+    ``If-None-Match`` still matches is answered with 304 before the main
+    queryset runs. Subclasses say which account a detail response draws on.
+    """
+
+    def list(self, request, *args, **kwargs):
+        account_permissions = get_account_permissions(request)
+        etag, last_modified = make_validators(account_state(account_permissions), account_permissions, self.get_salt())
+        return conditional(request, etag, last_modified, partial(super().list, request, *args, **kwargs))
+
+    def retrieve(self, request, *args, **kwargs):
+        account_permissions = get_account_permissions(request)
+        account_id = self.get_object_account_id(account_permissions)
+        permission = account_permissions.get(account_id)
+        respond = partial(super().retrieve, request, *args, **kwargs)
+        # Anything the object permission would refuse takes the normal path to its error
+        if permission is None or not HasAccountPermission().check_permission(permission, request.method):
+            return respond()
+
+        etag, last_modified = make_validators(account_state([account_id]), {account_id: permission}, self.get_salt())
+        return conditional(request, etag, last_modified, respond)
+
+    def get_salt(self):
+        return (self.request.user.pk, self.request.get_full_path(), self.request.accepted_media_type)
+
+    def get_object_account_id(self, account_permissions):
+        raise NotImplementedError('.get_object_account_id() must be implemented.')
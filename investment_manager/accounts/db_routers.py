@@ -0,0 +1,110 @@
+"""
+Read-replica routing for the accounts API.
+
+Views opt in with ``ReplicaReadMixin``. For a safe request the mixin routes
+every read the view makes to one of ``ACCOUNTS_DATABASE_REPLICAS``. It does
+this after authentication, so sessions and users are always read from the
+primary. Reads stay on the primary when:
+
+* the request sends the ``X-Read-Primary`` header (pin to primary);
+* the request has already written, so it reads its own writes;
+* the client wrote within the last ``ACCOUNTS_REPLICA_LAG_SECONDS``. A
+  short-lived cookie records this, so a client never reads from a replica
+  that has not caught up with its own writes.
+"""
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from rest_framework.permissions import SAFE_METHODS
+
+PIN_HEADER = 'X-Read-Primary'
+PRIMARY_COOKIE = 'accounts_read_primary_until'
+
+_reads = ContextVar('accounts_replica_reads', default=None)
+
+
+class ReplicaReads:
+    """Routing state for one request."""
+
+    def __init__(self, alias):
+        self.alias = alias
+        self.wrote = False
+
+
+class ReplicaRouter:
+
+    def db_for_read(self, model, **hints):
+        reads = _reads.get()
+        if reads is None or reads.wrote:
+            return None
+        return reads.alias
+
+    def db_for_write(self, model, **hints):
+        reads = _reads.get()
+        if reads is not None:
+            reads.wrote = True
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same data as the primary
+        return True
+
+
+def choose_replica(request):
+    """The replica alias to read from for this request, or None for the primary."""
+    replicas = getattr(settings, 'ACCOUNTS_DATABASE_REPLICAS', [])
+    if not replicas or request.method not in SAFE_METHODS or request.headers.get(PIN_HEADER):
+        return None
+    try:
+        if float(request.COOKIES.get(PRIMARY_COOKIE, 0)) > time.time():
+            return None
+    except ValueError:
+        pass
+    return random.choice(replicas)
+
+
+def start(request):
+    """Begin routing the current context's reads for ``request``; pass the result to ``finish``."""
+    alias = choose_replica(request)
+    return _reads.set(ReplicaReads(alias) if alias else None)
+
+
+def finish(token):
+    _reads.reset(token)
+
+
+@contextmanager
+def replica_reads(request):
+    token = start(request)
+    try:
+        yield
+    finally:
+        finish(token)
+
+
+def pin_after_write(request, response):
+    """Keep the client on the primary while replicas catch up with a write it just made."""
+    if request.method not in SAFE_METHODS and response.status_code < 400:
+        lag = getattr(settings, 'ACCOUNTS_REPLICA_LAG_SECONDS', 5)
+        response.set_cookie(PRIMARY_COOKIE, str(time.time() + lag), max_age=lag, httponly=True, samesite='Lax')
+    return response
+
+
+class ReplicaReadMixin:
+    """Serve a viewset's safe requests from a read replica when one is configured."""
+
+    def initial(self, request, *args, **kwargs):
+        # Authenticate first, so the session and user come from the primary
+        super().initial(request, *args, **kwargs)
+        self.replica_token = start(request)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        token = getattr(self, 'replica_token', None)
+        if token is not None:
+            finish(token)
+            self.replica_token = None
+        return pin_after_write(request, response)
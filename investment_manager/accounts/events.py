@@ -0,0 +1,279 @@
+"""
+The change feed: new transactions pushed to clients as server-sent events.
+
+Creating a transaction also writes a TransactionEvent to the change log, in
+the same database transaction, and once that commits ``record`` hands the
+event to this process's ``broadcaster``. Every client streaming
+``/api/transactions/events/`` holds a subscription for the accounts it may
+read, so an event is encoded once, only if someone is watching its account,
+and queued for just those clients. Nothing polls the database while a
+stream is open.
+
+The log is read only when a client reconnects with ``Last-Event-ID``, to send
+what it missed. Each shard numbers its own log, so the SSE id is a cursor
+holding the highest event id sent from every shard; whatever a client last
+received is a safe place to resume from. A write that commits after a later
+event was already sent is only delivered live, so a client that was away at
+that moment misses it.
+
+The broadcaster hears only the writes made in its own process. Serve the
+API from one ASGI process, or feed ``broadcaster.publish`` from a channel
+shared by every process.
+"""
+import asyncio
+import threading
+from collections import defaultdict
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import Max
+from rest_framework.renderers import JSONRenderer
+
+from . import sharding
+from .models import TransactionEvent
+from .permissions import HasAccountPermission, load_account_permissions
+from .serializers import TransactionEventSerializer
+
+
+def record(transactions, using=None):
+    """
+    Log newly created ``transactions`` to the change feed and publish them
+    once the surrounding transaction on ``using`` commits.
+
+    Model signals call this for single creates; bulk creates that bypass
+    signals must call it themselves, as they do ``ledger.apply``.
+    """
+    using = using or DEFAULT_DB_ALIAS
+    events = [
+        TransactionEvent(account_id=row.account_id, transaction_id=row.pk, user_id=row.user_id, amount=row.amount, timestamp=row.timestamp)
+        for row in transactions
+    ]
+    TransactionEvent.objects.using(using).bulk_create(events)
+    transaction.on_commit(lambda: broadcaster.publish(using, events), using=using)
+
+
+def prune(before, batch_size=5000):
+    """
+    Delete log entries created before ``before`` on every shard and return
+    how many went.
+
+    Entries are read oldest first along the primary key, which follows
+    creation order, so no index on ``created_at`` is needed.
+    """
+    def prune_shard():
+        deleted = 0
+        while True:
+            batch = list(TransactionEvent.objects.order_by('id').values_list('id', 'created_at')[:batch_size])
+            expired = [event_id for event_id, created_at in batch if created_at < before]
+            if expired:
+                deleted += sharding.delete_ids(TransactionEvent, expired)
+            if len(expired) < batch_size:
+                return deleted
+    return sum(sharding.fan_out(prune_shard))
+
+
+def encode(event):
+    return JSONRenderer().render(TransactionEventSerializer(event).data)
+
+
+class Subscription:
+    """One client's queue of events, drained on the event loop serving it."""
+
+    def __init__(self, loop, size):
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=size)
+        self.account_ids = frozenset()
+        # Set when the client fell too far behind; its stream then ends and
+        # the client catches up from the log when it reconnects
+        self.overflowed = False
+
+    def deliver(self, message):
+        if self.overflowed:
+            return
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+
+class Broadcaster:
+    """
+    Pass each published event to the subscriptions watching its account.
+
+    ``publish`` runs on whichever thread committed the write, so messages
+    reach each subscription through its own event loop.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._watching = defaultdict(set)
+
+    def subscribe(self, account_ids):
+        subscription = Subscription(asyncio.get_running_loop(), getattr(settings, 'ACCOUNTS_EVENTS_QUEUE_SIZE', 1000))
+        self.watch(subscription, account_ids)
+        return subscription
+
+    def watch(self, subscription, account_ids):
+        """Change the accounts ``subscription`` receives events for."""
+        account_ids = frozenset(account_ids)
+        with self._lock:
+            for account_id in subscription.account_ids - account_ids:
+                self._watching[account_id].discard(subscription)
+                if not self._watching[account_id]:
+                    del self._watching[account_id]
+            for account_id in account_ids - subscription.account_ids:
+                self._watching[account_id].add(subscription)
+            subscription.account_ids = account_ids
+
+    def unsubscribe(self, subscription):
+        self.watch(subscription, ())
+
+    def publish(self, alias, events):
+        """Send committed ``events``, written to ``alias``, to everyone watching their accounts."""
+        for event in events:
+            with self._lock:
+                subscriptions = list(self._watching.get(event.account_id, ()))
+            if not subscriptions:
+                continue
+            message = (alias, event.pk, event.account_id, encode(event))
+            for subscription in subscriptions:
+                try:
+                    subscription.loop.call_soon_threadsafe(subscription.deliver, message)
+                except RuntimeError:
+                    # The loop has closed; the subscription goes with its stream
+                    pass
+
+
+broadcaster = Broadcaster()
+
+
+def readable_accounts(user):
+    """The accounts whose transactions ``user`` may read, as HasAccountPermission decides for a GET."""
+    check = HasAccountPermission().check_permission
+    return {account_id for account_id, permission in load_account_permissions(user).items() if check(permission, 'GET')}
+
+
+def format_cursor(positions):
+    return '.'.join(str(positions.get(alias, 0)) for alias in sharding.get_shards())
+
+
+def parse_cursor(value):
+    """``{alias: event_id}`` from a cursor sent back as ``Last-Event-ID``, or None if it is not one."""
+    shards = sharding.get_shards()
+    parts = value.split('.')
+    if len(parts) != len(shards) or not all(part.isdigit() for part in parts):
+        return None
+    return dict(zip(shards, map(int, parts)))
+
+
+def head():
+    """The newest event id on every shard."""
+    def newest():
+        return sharding.current_shard() or DEFAULT_DB_ALIAS, TransactionEvent.objects.aggregate(newest=Max('id'))['newest'] or 0
+    return dict(sharding.fan_out(newest))
+
+
+def missed(account_ids, positions, limit):
+    """
+    Events on ``account_ids`` after ``positions``, oldest first on each
+    shard, as ``(alias, event)`` pairs; None if there are more than ``limit``.
+    """
+    def read(ids):
+        alias = sharding.current_shard() or DEFAULT_DB_ALIAS
+        events = TransactionEvent.objects.filter(account_id__in=ids, id__gt=positions.get(alias, 0)).order_by('id')
+        return [(alias, event) for event in events[:limit + 1]]
+
+    events = [pair for shard_events in sharding.fan_out_accounts(read, account_ids) for pair in shard_events] if account_ids else []
+    return events if len(events) <= limit else None
+
+
+def catch_up(account_ids, last_event_id):
+    """
+    Where a client's feed starts: the cursor and the events on
+    ``account_ids`` it missed since ``last_event_id``, as ``(key, message)``
+    pairs where ``key`` identifies the logged event sent.
+
+    Call it after subscribing, so nothing committed meanwhile falls between
+    the two. A cursor that cannot be resumed from, because it is malformed
+    or too far behind, starts the feed from the newest events with a
+    ``reset`` message telling the client to reload.
+    """
+    if not last_event_id:
+        return head(), []
+
+    resume_from = parse_cursor(last_event_id)
+    events = missed(account_ids, resume_from, getattr(settings, 'ACCOUNTS_EVENTS_REPLAY_LIMIT', 1000)) if resume_from else None
+    if events is None:
+        positions = head()
+        return positions, [(None, message('reset', format_cursor(positions), b'{"detail": "Missed events are no longer available; reload."}'))]
+
+    messages = []
+    for alias, event in events:
+        resume_from[alias] = max(resume_from[alias], event.pk)
+        messages.append(((alias, event.pk), message('transaction', format_cursor(resume_from), encode(event))))
+    return resume_from, messages
+
+
+def message(event, cursor, data):
+    return b'id: %s\nevent: %s\ndata: %s\n\n' % (cursor.encode(), event.encode(), data)
+
+
+def preamble(cursor=None):
+    # How soon the client reconnects, and where it resumes if nothing else is sent
+    retry = b'retry: %d\n' % getattr(settings, 'ACCOUNTS_EVENTS_RETRY_MS', 3000)
+    return retry + (b'id: %s\n\n' % cursor.encode() if cursor is not None else b'\n')
+
+
+class Stream:
+    """
+    The body of a live feed: the backlog, then events as they reach
+    ``subscription``.
+
+    Ends after ``ACCOUNTS_EVENTS_MAX_SECONDS`` (the client reconnects and
+    resumes) or as soon as the client falls too far behind. Grants are
+    re-read with every keepalive, so access changes apply within
+    ``ACCOUNTS_EVENTS_KEEPALIVE_SECONDS``. Django closes the response's
+    content however the response ends, which drops the subscription.
+    """
+
+    def __init__(self, subscription, user, positions, backlog):
+        self.subscription = subscription
+        self.user = user
+        self.positions = positions
+        self.backlog = backlog
+
+    def __aiter__(self):
+        return self.messages()
+
+    def close(self):
+        broadcaster.unsubscribe(self.subscription)
+
+    async def messages(self):
+        subscription, positions = self.subscription, self.positions
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + getattr(settings, 'ACCOUNTS_EVENTS_MAX_SECONDS', 300)
+        keepalive = getattr(settings, 'ACCOUNTS_EVENTS_KEEPALIVE_SECONDS', 15)
+        sent = {key for key, _ in self.backlog}
+        try:
+            # Backlog messages carry their own cursors, each as far as the client has got
+            yield preamble(None if self.backlog else format_cursor(positions))
+            for _, chunk in self.backlog:
+                yield chunk
+            while not subscription.overflowed:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    return
+                try:
+                    alias, event_id, account_id, data = await asyncio.wait_for(subscription.queue.get(), min(keepalive, remaining))
+                except asyncio.TimeoutError:
+                    broadcaster.watch(subscription, await sync_to_async(readable_accounts)(self.user))
+                    yield b': keepalive\n\n'
+                    continue
+                # Already sent from the log, or published before a revoked grant was noticed
+                if (alias, event_id) in sent or account_id not in subscription.account_ids:
+                    continue
+                positions[alias] = max(positions.get(alias, 0), event_id)
+                yield message('transaction', format_cursor(positions), data)
+        finally:
+            self.close()
@@ -0,0 +1,84 @@
+"""
+Money amounts stored as whole numbers of a currency's minor unit.
+
+``MoneyField`` keeps an amount in a 64-bit integer column, so ``12.34`` USD
+is stored as ``1234`` cents. Python code, forms and the API still see
+``Decimal`` values with the currency's number of decimal places; only the
+database sees integers, which it sums exactly and the driver hands back
+without a per-row decimal conversion.
+"""
+from decimal import Decimal, InvalidOperation
+
+from django import forms
+from django.core import exceptions, validators
+from django.db import models
+from django.utils.functional import cached_property
+
+# ISO 4217 minor units for the currencies amounts may be kept in
+CURRENCY_DECIMAL_PLACES = {
+    'USD': 2, 'EUR': 2, 'GBP': 2, 'CHF': 2, 'CAD': 2, 'AUD': 2, 'CNY': 2, 'INR': 2, 'KES': 2,
+    'JPY': 0, 'KRW': 0,
+    'BHD': 3, 'KWD': 3, 'OMR': 3,
+}
+
+# Digits that always fit a signed 64-bit column, whatever the scale
+MAX_DIGITS = 18
+
+
+class MoneyField(models.BigIntegerField):
+    description = 'Amount in minor units of a currency'
+
+    def __init__(self, *args, currency='USD', **kwargs):
+        if currency not in CURRENCY_DECIMAL_PLACES:
+            raise ValueError(f'Unknown currency {currency!r}.')
+        self.currency = currency
+        self.decimal_places = CURRENCY_DECIMAL_PLACES[currency]
+        self.max_digits = MAX_DIGITS
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        if self.currency != 'USD':
+            kwargs['currency'] = self.currency
+        return name, path, args, kwargs
+
+    @cached_property
+    def validators(self):
+        # The integer range checks of BigIntegerField would apply to the
+        # major-unit value; limit the digits instead.
+        return [*self._validators, validators.DecimalValidator(self.max_digits, self.decimal_places)]
+
+    def to_minor(self, value):
+        """A Decimal, or anything ``to_python`` accepts, as an int of minor units."""
+        return int(self.to_python(value).scaleb(self.decimal_places).to_integral_value())
+
+    def from_minor(self, value):
+        """An int of minor units as a Decimal with the currency's decimal places."""
+        return Decimal(value).scaleb(-self.decimal_places)
+
+    def to_python(self, value):
+        if value is None or isinstance(value, Decimal):
+            return value
+        try:
+            if isinstance(value, float):
+                return Decimal(repr(value))
+            return Decimal(value)
+        except (InvalidOperation, TypeError, ValueError):
+            raise exceptions.ValidationError(
+                '“%(value)s” value must be a decimal number.', code='invalid', params={'value': value},
+            )
+
+    def get_prep_value(self, value):
+        value = models.Field.get_prep_value(self, value)
+        return None if value is None else self.to_minor(value)
+
+    def from_db_value(self, value, expression, connection):
+        return None if value is None else self.from_minor(value)
+
+    def formfield(self, **kwargs):
+        return models.Field.formfield(self, **{
+            'form_class': forms.DecimalField,
+            'max_digits': self.max_digits,
+            'decimal_places': self.decimal_places,
+            **kwargs,
+        })
@@ -0,0 +1,162 @@
+"""
+A database-backed queue for reports and exports too slow to run in a request.
+
+``enqueue`` adds a ReportJob row and the ``run_jobs`` management command
+works through them; no broker is involved.
+
+* A worker claims a due job with a conditional UPDATE, so two workers never
+  run the same job, and holds it under a lease of
+  ``ACCOUNTS_JOB_LEASE_SECONDS`` that it renews while the job runs.
+* At most ``ACCOUNTS_JOB_CONCURRENCY`` jobs run at once across all workers.
+* A job that raises, or whose worker dies and lets the lease lapse, is
+  retried with exponential backoff until it has had ``max_attempts`` tries,
+  then marked failed.
+* Results are written to a temporary file under ``ACCOUNTS_JOB_RESULTS_DIR``
+  and renamed into place, so a download never sees a partial file.
+"""
+import logging
+import os
+import socket
+import tempfile
+from datetime import timedelta
+from pathlib import Path
+
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import ReportJob
+
+logger = logging.getLogger('accounts.jobs')
+
+# The function that runs each kind of job. It is called with the job's params
+# and a binary file to write to, and returns the result's content type and
+# file extension.
+RUNNERS = {
+    'export': 'accounts.reports.run_export_job',
+    'batch-report': 'accounts.reports.run_batch_report_job',
+}
+
+ACTIVE_STATUSES = ('queued', 'running')
+
+
+def get_results_dir():
+    return Path(getattr(settings, 'ACCOUNTS_JOB_RESULTS_DIR', Path(settings.BASE_DIR) / 'job_results'))
+
+
+def get_result_path(job):
+    return get_results_dir() / job.result_name
+
+
+def get_lease():
+    return timedelta(seconds=getattr(settings, 'ACCOUNTS_JOB_LEASE_SECONDS', 300))
+
+
+def worker_name():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def enqueue(kind, user, params):
+    """Queue a job of ``kind`` for ``user``; ``params`` must already be valid for that kind."""
+    return ReportJob.objects.create(
+        kind=kind, params=params, requested_by=user,
+        max_attempts=getattr(settings, 'ACCOUNTS_JOB_MAX_ATTEMPTS', 3),
+    )
+
+
+def active_job_count(user):
+    return ReportJob.objects.filter(requested_by=user, status__in=ACTIVE_STATUSES).count()
+
+
+def claim(worker, limit=1):
+    """
+    Claim up to ``limit`` due jobs for ``worker`` and return their ids, oldest
+    first, without taking the number running past ``ACCOUNTS_JOB_CONCURRENCY``.
+    """
+    if limit <= 0:
+        return []
+    now = timezone.now()
+    due = ReportJob.objects.filter(status='queued', run_after__lte=now).order_by('run_after', 'id')
+    claimed = []
+    for pk in list(due.values_list('pk', flat=True)[:limit]):
+        # Conditional on the job still being queued, so only one worker wins it
+        won = ReportJob.objects.filter(pk=pk, status='queued').update(
+            status='running', locked_by=worker, locked_until=now + get_lease(), attempts=F('attempts') + 1,
+        )
+        if not won:
+            continue
+        # Counted after claiming, so workers racing for the last slot can
+        # only both back off, never both run
+        if ReportJob.objects.filter(status='running').count() > getattr(settings, 'ACCOUNTS_JOB_CONCURRENCY', 4):
+            ReportJob.objects.filter(pk=pk, status='running', locked_by=worker).update(
+                status='queued', locked_by='', locked_until=None, attempts=F('attempts') - 1,
+            )
+            break
+        claimed.append(pk)
+    return claimed
+
+
+def renew(worker, job_ids):
+    """Extend the lease on jobs ``worker`` is still running."""
+    if job_ids:
+        ReportJob.objects.filter(pk__in=list(job_ids), status='running', locked_by=worker).update(
+            locked_until=timezone.now() + get_lease(),
+        )
+
+
+def recover_expired():
+    """Retry or fail running jobs whose worker stopped renewing the lease."""
+    expired = ReportJob.objects.filter(status='running', locked_until__lt=timezone.now())
+    for job in expired:
+        logger.warning('Job %s lost its worker %s', job.pk, job.locked_by)
+        retry_or_fail(job, 'The worker running the job stopped.')
+
+
+def retry_or_fail(job, error):
+    """Requeue ``job`` with backoff after a failed attempt, or fail it once out of attempts."""
+    now = timezone.now()
+    if job.attempts < job.max_attempts:
+        delay = getattr(settings, 'ACCOUNTS_JOB_RETRY_SECONDS', 30) * 2 ** (job.attempts - 1)
+        changes = {'status': 'queued', 'run_after': now + timedelta(seconds=delay)}
+    else:
+        changes = {'status': 'failed', 'finished_at': now}
+    # Only the worker holding the job may release it
+    return ReportJob.objects.filter(pk=job.pk, status='running', locked_by=job.locked_by).update(
+        locked_by='', locked_until=None, error=error, **changes,
+    )
+
+
+def run(job_id):
+    """
+    Run a job claimed by this process's worker and record the outcome.
+
+    Returns the job's status afterwards. Runs in a ``run_jobs`` pool process,
+    so failures are recorded here rather than raised.
+    """
+    job = ReportJob.objects.get(pk=job_id)
+    ReportJob.objects.filter(pk=job.pk).update(started_at=timezone.now())
+    results = get_results_dir()
+    results.mkdir(parents=True, exist_ok=True)
+    handle, temporary = tempfile.mkstemp(dir=results, prefix=f'.{job.pk}-')
+    try:
+        with os.fdopen(handle, 'wb') as output:
+            content_type, extension = import_string(RUNNERS[job.kind])(job.params, output)
+        name = f'{job.pk}.{extension}'
+        os.replace(temporary, results / name)
+    except Exception as error:
+        logger.exception('Job %s failed on attempt %s', job.pk, job.attempts)
+        if os.path.exists(temporary):
+            os.unlink(temporary)
+        retry_or_fail(job, f'{type(error).__name__}: {error}')
+        return ReportJob.objects.values_list('status', flat=True).get(pk=job.pk)
+
+    finished = ReportJob.objects.filter(pk=job.pk, status='running', locked_by=job.locked_by).update(
+        status='succeeded', result_name=name, content_type=content_type, error='',
+        locked_by='', locked_until=None, finished_at=timezone.now(),
+    )
+    if not finished:
+        # The lease lapsed and the job was requeued or failed meanwhile
+        logger.warning('Job %s finished after losing its lease', job.pk)
+        return ReportJob.objects.values_list('status', flat=True).get(pk=job.pk)
+    return 'succeeded'
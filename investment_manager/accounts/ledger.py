@@ -0,0 +1,339 @@
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import router, transaction
+from django.db.models import Count, DateField, F, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Trunc
+from django.utils import timezone
+
+from . import archive, sharding
+from .models import AccountBalance, AccountUserBalance, ArchivedTransaction, BalanceCheckpoint, InvestmentAccount, Transaction, TransactionRollup
+
+ROLLUP_GRANULARITIES = [granularity for granularity, _ in TransactionRollup.GRANULARITY_CHOICES]
+
+
+def apply(added=(), removed=(), using=None):
+    """
+    Fold created and deleted transactions into the materialized balances,
+    time-bucket rollups and balance checkpoints.
+
+    An update is recorded as the removal of the old row plus the addition of
+    the new one. Model signals call this for single-row writes; bulk writes
+    that bypass signals must call it themselves, inside the same database
+    transaction, so the summaries never drift from the rows they summarize.
+    ``using`` is the database the rows were written to.
+    """
+    deltas = defaultdict(lambda: [Decimal('0'), 0])
+    for sign, rows in ((1, added), (-1, removed)):
+        for row in rows:
+            amount = sign * Decimal(str(row.amount))
+            for key in _summary_keys(row):
+                deltas[key][0] += amount
+                deltas[key][1] += sign
+
+    now = timezone.now()
+    using = using or router.db_for_write(AccountBalance)
+    with transaction.atomic(using=using):
+        missing = defaultdict(list)
+        for (model, amount_field, lookup), (amount, count) in deltas.items():
+            if not amount and not count and model is not AccountBalance:
+                continue
+            # A net removal from a missing row means the row went in a cascade
+            # delete with its account or user, so there is nothing to correct
+            if not _bump(model, using, dict(lookup), {amount_field: amount, 'transaction_count': count}, now) and count >= 0:
+                missing[model].append((amount_field, lookup, amount, count))
+
+        # First write to a summary row: create it empty, tolerating a
+        # concurrent writer doing the same, then apply the delta as usual.
+        for model, rows in missing.items():
+            model.objects.using(using).bulk_create([model(**dict(lookup)) for _, lookup, _, _ in rows], ignore_conflicts=True)
+            for amount_field, lookup, amount, count in rows:
+                _bump(model, using, dict(lookup), {amount_field: amount, 'transaction_count': count}, now)
+
+        _shift_checkpoints(added, removed, using, now)
+
+
+def touch(account_ids, using=None):
+    """Mark the accounts as changed so cached copies of their payloads are revalidated."""
+    AccountBalance.objects.db_manager(using).filter(account_id__in=account_ids).update(version=F('version') + 1, modified=timezone.now())
+
+
+def _summary_keys(row):
+    yield AccountBalance, 'balance', (('account_id', row.account_id),)
+    yield AccountUserBalance, 'balance', (('account_id', row.account_id), ('user_id', row.user_id))
+    for granularity in ROLLUP_GRANULARITIES:
+        bucket = bucket_for(row.timestamp, granularity)
+        yield TransactionRollup, 'total', (
+            ('account_id', row.account_id), ('user_id', row.user_id), ('granularity', granularity), ('bucket', bucket),
+        )
+
+
+def _shift_checkpoints(added, removed, using, now):
+    # Checkpoints only exist for buckets that have started, so rows in the
+    # current bucket, as nearly all new ones are, cost no query. Back-dated,
+    # changed and deleted rows move every later checkpoint of their account.
+    granularity = get_checkpoint_interval()
+    current = bucket_for(now, granularity)
+    shifts = defaultdict(lambda: [Decimal('0'), 0])
+    for sign, rows in ((1, added), (-1, removed)):
+        for row in rows:
+            bucket = bucket_for(row.timestamp, granularity)
+            if bucket < current:
+                shifts[row.account_id, bucket][0] += sign * Decimal(str(row.amount))
+                shifts[row.account_id, bucket][1] += sign
+
+    balance_field = BalanceCheckpoint._meta.get_field('balance')
+    for (account_id, bucket), (amount, count) in shifts.items():
+        if amount or count:
+            BalanceCheckpoint.objects.using(using).filter(account_id=account_id, granularity=granularity, bucket__gt=bucket).update(
+                balance=F('balance') + Value(amount, output_field=balance_field), transaction_count=F('transaction_count') + count,
+            )
+
+
+def _bump(model, using, lookup, deltas, now):
+    # Typed values so amounts are converted to the columns' minor units
+    changes = {field: F(field) + Value(delta, output_field=model._meta.get_field(field)) for field, delta in deltas.items()}
+    if model is AccountBalance:
+        # Any posting to the account, even one that nets to zero, changes its payloads
+        changes.update(version=F('version') + 1, modified=now)
+    return model.objects.using(using).filter(**lookup).update(**changes)
+
+
+def bucket_for(value, granularity):
+    """First day of the day, ISO week or month holding a date or datetime, in the current time zone."""
+    day = value
+    if isinstance(value, datetime):
+        day = timezone.localtime(value).date() if timezone.is_aware(value) else value.date()
+    if granularity == 'week':
+        return day - timedelta(days=day.weekday())
+    if granularity == 'month':
+        return day.replace(day=1)
+    return day
+
+
+def next_bucket(bucket, granularity):
+    if granularity == 'week':
+        return bucket + timedelta(days=7)
+    if granularity == 'month':
+        return (bucket + timedelta(days=31)).replace(day=1)
+    return bucket + timedelta(days=1)
+
+
+def bucket_start(bucket):
+    """The moment a bucket starts, midnight in the current time zone."""
+    return timezone.make_aware(datetime.combine(bucket, time.min))
+
+
+def get_checkpoint_interval():
+    return getattr(settings, 'ACCOUNTS_CHECKPOINT_INTERVAL', 'week')
+
+
+def account_balance(account_id):
+    with sharding.pinned(sharding.shard_for(account_id)):
+        balance = AccountBalance.objects.filter(account_id=account_id).values_list('balance', flat=True).first()
+    return balance if balance is not None else Decimal('0')
+
+
+def user_balance(user_id):
+    """Total of every transaction posted by the user, across all accounts."""
+    totals = sharding.fan_out(lambda: AccountUserBalance.objects.filter(user_id=user_id).aggregate(total=Sum('balance'))['total'])
+    return sum(total for total in totals if total is not None) or 0
+
+
+def balance_as_of(account_id, moment):
+    """
+    The balance and transaction count of an account over every transaction
+    timestamped at or before ``moment``, archived ones included.
+
+    Starts from the newest checkpoint before ``moment`` and adds the
+    transactions since. A moment in the current bucket has no checkpoint
+    after it yet, so the transactions since ``moment`` are taken off the
+    live balance instead. Either way only part of one bucket's transactions
+    is summed, as long as ``checkpoint_balances`` keeps up.
+    """
+    granularity = get_checkpoint_interval()
+    bucket = bucket_for(moment, granularity)
+    horizon = archive.get_horizon()
+    with sharding.pinned(sharding.shard_for(account_id)):
+        if bucket >= bucket_for(timezone.now(), granularity):
+            balance, count = AccountBalance.objects.filter(account_id=account_id).values_list('balance', 'transaction_count').first() or (Decimal('0'), 0)
+            later, later_count = _total(account_id, {'timestamp__gt': moment}, archived=archive.reaches_archive(horizon, moment))
+            return balance - later, count - later_count
+
+        checkpoint = (
+            BalanceCheckpoint.objects.filter(account_id=account_id, granularity=granularity, bucket__lte=bucket)
+            .order_by('-bucket').values_list('bucket', 'balance', 'transaction_count').first()
+        )
+        if checkpoint is None:
+            start, balance, count = None, Decimal('0'), 0
+        else:
+            start, balance, count = bucket_start(checkpoint[0]), checkpoint[1], checkpoint[2]
+        lookups = {'timestamp__lte': moment} if start is None else {'timestamp__gte': start, 'timestamp__lte': moment}
+        since, since_count = _total(account_id, lookups, archived=archive.reaches_archive(horizon, start))
+        return balance + since, count + since_count
+
+
+def _total(account_id, lookups, archived):
+    total, count = Decimal('0'), 0
+    for model in (Transaction, ArchivedTransaction) if archived else (Transaction,):
+        row = model.objects.filter(account_id=account_id, **lookups).aggregate(total=Sum('amount'), count=Count('id'))
+        total += row['total'] or 0
+        count += row['count']
+    return total, count
+
+
+def checkpoint(account_ids=None, rebuild=False, batch_size=1000):
+    """
+    Add balance checkpoints for the buckets that have ended since each
+    account's newest one and return how many were added.
+
+    Checkpoints are running totals of the rollups, so each run only reads
+    the rollups since the last. A bucket that first sees activity after
+    later checkpoints exist, through back-dating, is summed from the
+    checkpoint before it until a rebuild. ``rebuild`` starts over; checkpoints for
+    another interval than ``ACCOUNTS_CHECKPOINT_INTERVAL`` are always
+    dropped, as they are no longer kept up to date.
+    """
+    return sum(sharding.fan_out(lambda: _checkpoint(account_ids, rebuild, batch_size)))
+
+
+def _checkpoint(account_ids, rebuild, batch_size):
+    granularity = get_checkpoint_interval()
+    current = bucket_for(timezone.now(), granularity)
+    accounts = AccountBalance.objects.order_by('account_id').values_list('account_id', flat=True)
+    if account_ids is not None:
+        accounts = accounts.filter(account_id__in=account_ids)
+    accounts = list(accounts)
+
+    created = 0
+    for start in range(0, len(accounts), batch_size):
+        batch = accounts[start:start + batch_size]
+        with transaction.atomic(using=router.db_for_write(BalanceCheckpoint)):
+            # Writers lock the ledger rows first, so this waits for postings in
+            # flight and holds off new ones until the checkpoints are in
+            list(AccountBalance.objects.select_for_update().filter(account_id__in=batch).values_list('pk', flat=True))
+            checkpoints = BalanceCheckpoint.objects.filter(account_id__in=batch)
+            (checkpoints if rebuild else checkpoints.exclude(granularity=granularity)).delete()
+            created += len(BalanceCheckpoint.objects.bulk_create(_new_checkpoints(batch, granularity, current), batch_size=1000))
+    return created
+
+
+def _new_checkpoints(account_ids, granularity, current):
+    newest = BalanceCheckpoint.objects.filter(account_id=OuterRef('account_id'), granularity=granularity).order_by('-bucket').values('bucket')[:1]
+    running = {
+        row['account_id']: [row['balance'], row['transaction_count']]
+        for row in BalanceCheckpoint.objects.filter(account_id__in=account_ids, granularity=granularity, bucket=Subquery(newest))
+        .values('account_id', 'balance', 'transaction_count')
+    }
+    # Ended buckets with activity since each account's newest checkpoint
+    pending = (
+        TransactionRollup.objects.filter(account_id__in=account_ids, granularity=granularity, bucket__lt=current)
+        .annotate(checkpointed=Subquery(newest))
+        .filter(Q(checkpointed__isnull=True) | Q(bucket__gte=F('checkpointed')))
+        .values('account_id', 'bucket')
+        .annotate(total=Sum('total'), count=Sum('transaction_count'))
+        .filter(count__gt=0)
+        .order_by('account_id', 'bucket')
+    )
+    checkpoints = []
+    for row in pending:
+        totals = running.setdefault(row['account_id'], [Decimal('0'), 0])
+        totals[0] += row['total']
+        totals[1] += row['count']
+        checkpoints.append(BalanceCheckpoint(
+            account_id=row['account_id'], granularity=granularity, bucket=next_bucket(row['bucket'], granularity),
+            balance=totals[0], transaction_count=totals[1],
+        ))
+    return checkpoints
+
+
+def rebuild(account_ids=None):
+    """Recompute the balance tables from the Transaction rows, archived ones included."""
+    return sum(sharding.fan_out(lambda: _rebuild(account_ids)))
+
+
+def _rebuild(account_ids):
+    with transaction.atomic(using=router.db_for_write(AccountBalance)):
+        accounts = InvestmentAccount.objects.all()
+        account_balances = AccountBalance.objects.all()
+        user_balances = AccountUserBalance.objects.all()
+        if account_ids is not None:
+            accounts = accounts.filter(pk__in=account_ids)
+            account_balances = account_balances.filter(account_id__in=account_ids)
+            user_balances = user_balances.filter(account_id__in=account_ids)
+
+        # Versions carry on from where they were, one higher, so no ETag
+        # handed out before the rebuild can match a payload after it
+        versions = dict(account_balances.values_list('account_id', 'version'))
+        account_balances.delete()
+        user_balances.delete()
+
+        now = timezone.now()
+        per_account = {
+            account_id: AccountBalance(account_id=account_id, balance=Decimal('0'), transaction_count=0, version=versions.get(account_id, 0) + 1, modified=now)
+            for account_id in accounts.values_list('pk', flat=True)
+        }
+        per_user = {}
+        for transactions in _history(account_ids):
+            totals = transactions.values('account_id', 'user_id').annotate(balance=Sum('amount'), transaction_count=Count('id'))
+            for total in totals.order_by():
+                account_id, user_id = total['account_id'], total['user_id']
+                user_balance = per_user.get((account_id, user_id))
+                if user_balance is None:
+                    user_balance = per_user[account_id, user_id] = AccountUserBalance(
+                        account_id=account_id, user_id=user_id, balance=Decimal('0'), transaction_count=0,
+                    )
+                for row in (user_balance, per_account[account_id]):
+                    row.balance += total['balance']
+                    row.transaction_count += total['transaction_count']
+
+        AccountUserBalance.objects.bulk_create(per_user.values(), batch_size=1000)
+        AccountBalance.objects.bulk_create(per_account.values(), batch_size=1000)
+        return len(per_account)
+
+
+def rebuild_rollups(account_ids=None, granularities=None):
+    """Recompute the time-bucket rollups from the Transaction rows, archived ones included."""
+    return sum(sharding.fan_out(lambda: _rebuild_rollups(account_ids, granularities)))
+
+
+def _rebuild_rollups(account_ids, granularities):
+    with transaction.atomic(using=router.db_for_write(TransactionRollup)):
+        granularities = granularities or ROLLUP_GRANULARITIES
+        rollups = TransactionRollup.objects.filter(granularity__in=granularities)
+        if account_ids is not None:
+            rollups = rollups.filter(account_id__in=account_ids)
+
+        rollups.delete()
+
+        created = 0
+        for granularity in granularities:
+            buckets = {}
+            for transactions in _history(account_ids):
+                totals = (
+                    transactions.annotate(bucket=Trunc('timestamp', granularity, output_field=DateField()))
+                    .values('account_id', 'user_id', 'bucket')
+                    .annotate(total=Sum('amount'), transaction_count=Count('id'))
+                    .order_by()
+                )
+                for total in totals.iterator():
+                    key = total['account_id'], total['user_id'], total['bucket']
+                    rollup = buckets.get(key)
+                    if rollup is None:
+                        buckets[key] = TransactionRollup(granularity=granularity, **total)
+                    else:
+                        rollup.total += total['total']
+                        rollup.transaction_count += total['transaction_count']
+            created += len(TransactionRollup.objects.bulk_create(buckets.values(), batch_size=1000))
+        return created
+
+
+def _history(account_ids=None):
+    """The hot and archived transaction querysets, optionally limited to some accounts."""
+    for model in (Transaction, ArchivedTransaction):
+        transactions = model.objects.all()
+        if account_ids is not None:
+            transactions = transactions.filter(account_id__in=account_ids)
+        yield transactions
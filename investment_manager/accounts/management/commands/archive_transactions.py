@@ -0,0 +1,37 @@
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from accounts import archive
+
+
+class Command(BaseCommand):
+    help = (
+        'Move transactions older than the horizon into the archive table, a calendar month at a time. '
+        'Balances and rollups are unaffected, and lists and reports read the archive whenever a range reaches into it.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--older-than-days', type=int, default=getattr(settings, 'ACCOUNTS_ARCHIVE_AFTER_DAYS', 365),
+            help='Archive whole months that ended at least this many days ago.',
+        )
+        parser.add_argument('--before', help='Archive whole months before this date (YYYY-MM-DD) instead.')
+        parser.add_argument('--batch-size', type=int, default=5000, help='Rows moved per database transaction.')
+
+    def handle(self, *args, **options):
+        if options['before']:
+            before = parse_date(options['before'])
+            if before is None:
+                raise CommandError('--before must be a date in YYYY-MM-DD format.')
+            cutoff = timezone.make_aware(datetime(before.year, before.month, before.day))
+        else:
+            cutoff = timezone.now() - timedelta(days=options['older_than_days'])
+
+        moved = archive.archive_before(cutoff, options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Archived {moved} transaction(s) from before {archive.month_start(cutoff):%Y-%m-%d}.'
+        ))
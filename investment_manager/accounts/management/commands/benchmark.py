@@ -0,0 +1,211 @@
+import json
+import math
+import platform
+import statistics
+import time
+import tracemalloc
+from collections import namedtuple
+from contextlib import ExitStack
+from datetime import timedelta
+
+import django
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, reset_queries, transaction
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from accounts import sharding
+from accounts.models import AccountPermission, InvestmentAccount, Transaction
+from accounts.renderers import ColumnarRenderer
+
+Scenario = namedtuple('Scenario', ['name', 'method', 'url', 'body', 'admin', 'expected', 'accept'], defaults=['application/json'])
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+
+class Command(BaseCommand):
+    help = (
+        'Drive every accounts endpoint in-process and report p50/p95/p99 latency, queries per request '
+        'and peak memory. Writes run inside a transaction that is rolled back, so the dataset is left '
+        'as it was. Seed data first with seed_data.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('username', help='User to benchmark as; needs a crud grant on at least one account.')
+        parser.add_argument('--admin', help='Staff user for the admin report; defaults to the first superuser.')
+        parser.add_argument('--requests', type=int, default=100, help='Timed requests per endpoint.')
+        parser.add_argument('--page-size', type=int, default=100)
+        parser.add_argument('--bulk-rows', type=int, default=100, help='Rows per request to the bulk endpoint.')
+        parser.add_argument('--only', action='append', metavar='NAME', help='Run only this scenario. May be repeated.')
+        parser.add_argument('--label', default='', help='Free-form label stored with the results.')
+        parser.add_argument('--output', help='Write the results as JSON to this file.')
+        parser.add_argument('--compare', help='Earlier JSON results to print p50/p95 changes against.')
+
+    def handle(self, *args, **options):
+        user, admin = self.get_users(options['username'], options['admin'])
+        scenarios = self.get_scenarios(user, options['page_size'], options['bulk_rows'])
+        if options['only']:
+            unknown = set(options['only']) - {scenario.name for scenario in scenarios}
+            if unknown:
+                raise CommandError(f'Unknown scenario(s): {", ".join(sorted(unknown))}.')
+            scenarios = [scenario for scenario in scenarios if scenario.name in options['only']]
+
+        clients = {False: Client(), True: Client()}
+        clients[False].force_login(user)
+        clients[True].force_login(admin)
+
+        results = []
+        self.stdout.write(f'{"endpoint":<24} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9} {"queries":>8} {"peak KiB":>9}')
+        with override_settings(ALLOWED_HOSTS=['testserver']):
+            for scenario in scenarios:
+                result = self.run_scenario(clients[scenario.admin], scenario, options['requests'])
+                results.append(result)
+                self.stdout.write(
+                    f'{scenario.name:<24} {result["p50_ms"]:>9.2f} {result["p95_ms"]:>9.2f} {result["p99_ms"]:>9.2f} '
+                    f'{result["queries"]:>8} {result["peak_memory_kib"]:>9.1f}'
+                )
+
+        report = {
+            'label': options['label'],
+            'started_at': timezone.now().isoformat(),
+            'environment': {
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'database': connection.vendor,
+            },
+            'dataset': {
+                'users': User.objects.count(),
+                'accounts': sum(sharding.fan_out(InvestmentAccount.objects.count)),
+                'grants': sum(sharding.fan_out(AccountPermission.objects.count)),
+                'transactions': sum(sharding.fan_out(Transaction.objects.count)),
+                'shards': len(sharding.get_shards()),
+            },
+            'requests': options['requests'],
+            'page_size': options['page_size'],
+            'results': results,
+        }
+        if options['compare']:
+            self.compare(results, options['compare'])
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(report, output, indent=2)
+            self.stdout.write(self.style.SUCCESS(f'Wrote results to {options["output"]}.'))
+
+    def get_users(self, username, admin_username):
+        try:
+            user = User.objects.get(username=username)
+        except User.DoesNotExist:
+            raise CommandError(f'No user named {username!r}.')
+        admins = User.objects.filter(is_staff=True)
+        admin = admins.filter(username=admin_username).first() if admin_username else admins.filter(is_superuser=True).order_by('pk').first()
+        if admin is None:
+            raise CommandError('No staff user found for the admin report; pass --admin.')
+        return user, admin
+
+    def get_scenarios(self, user, page_size, bulk_rows):
+        grants = AccountPermission.objects.filter(user=user, permission='crud').order_by('account_id').values_list('account_id', flat=True)
+        account_ids = [account_id for account_id in sharding.fan_out(grants.first) if account_id is not None]
+        if not account_ids:
+            raise CommandError(f'{user.username} has no crud grant; pick another user.')
+        account_id = min(account_ids)
+        with sharding.pinned(sharding.shard_for(account_id)):
+            transaction_id = Transaction.objects.filter(account_id=account_id).values_list('pk', flat=True).first()
+        if transaction_id is None:
+            raise CommandError(f'Account {account_id} has no transactions; seed some data first.')
+
+        report = f'/api/admin-transactions/?user_id={user.pk}&page_size={page_size}'
+        month_ago = (timezone.now() - timedelta(days=30)).strftime('%Y-%m-%dT%H:%M:%SZ')
+        bulk = [{'account': account_id, 'amount': '1.00'}] * bulk_rows
+        return [
+            Scenario('api-root', 'get', '/api/', None, False, 200),
+            Scenario('account-list', 'get', '/api/accounts/', None, False, 200),
+            Scenario('account-detail', 'get', f'/api/accounts/{account_id}/', None, False, 200),
+            Scenario('account-rollups', 'get', f'/api/accounts/{account_id}/rollups/?granularity=month', None, False, 200),
+            Scenario('account-create', 'post', '/api/accounts/', {'name': 'Benchmark'}, False, 201),
+            Scenario('account-update', 'put', f'/api/accounts/{account_id}/', {'name': 'Benchmark'}, False, 200),
+            Scenario('transaction-list', 'get', f'/api/transactions/?page_size={page_size}', None, False, 200),
+            Scenario('transaction-list-columns', 'get', f'/api/transactions/?page_size={page_size}', None, False, 200, ColumnarRenderer.media_type),
+            Scenario('transaction-detail', 'get', f'/api/transactions/{transaction_id}/', None, False, 200),
+            Scenario('transaction-create', 'post', '/api/transactions/', {'account': account_id, 'amount': '1.00'}, False, 201),
+            Scenario('transaction-update', 'put', f'/api/transactions/{transaction_id}/', {'account': account_id, 'amount': '2.00'}, False, 200),
+            Scenario('transaction-delete', 'delete', f'/api/transactions/{transaction_id}/', None, False, 204),
+            Scenario('transaction-bulk', 'post', '/api/transactions/bulk/', bulk, False, 201),
+            Scenario('admin-report', 'get', report, None, True, 200),
+            Scenario('admin-report-columns', 'get', report, None, True, 200, ColumnarRenderer.media_type),
+            Scenario('admin-report-dated', 'get', f'{report}&start_date={month_ago}', None, True, 200),
+            Scenario('admin-report-batch', 'get', f'/api/admin-transactions/batch/?user_ids={user.pk}&start_date={month_ago}', None, True, 200),
+            Scenario('admin-export-ndjson', 'get', f'{report}&format=ndjson', None, True, 200, 'application/x-ndjson'),
+            Scenario('metrics', 'get', '/api/metrics/', None, True, 200, 'text/plain'),
+        ]
+
+    def run_scenario(self, client, scenario, requests):
+        # One profiled request for queries and memory, kept out of the timings
+        # because query capture and tracemalloc both slow every request down.
+        reset_queries()
+        tracemalloc.start()
+        with CaptureQueriesContext(connection) as queries:
+            self.request(client, scenario)
+        query_count = len(queries)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        latencies = []
+        for _ in range(requests):
+            started = time.perf_counter()
+            self.request(client, scenario)
+            latencies.append(time.perf_counter() - started)
+        latencies.sort()
+        return {
+            'name': scenario.name,
+            'method': scenario.method.upper(),
+            'url': scenario.url,
+            'requests': requests,
+            'mean_ms': statistics.fmean(latencies) * 1000,
+            'p50_ms': percentile(latencies, 0.50) * 1000,
+            'p95_ms': percentile(latencies, 0.95) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+            'queries': query_count,
+            'peak_memory_kib': peak / 1024,
+        }
+
+    def request(self, client, scenario):
+        kwargs = {'HTTP_ACCEPT': scenario.accept}
+        if scenario.body is not None:
+            kwargs.update(data=json.dumps(scenario.body), content_type='application/json')
+        # Roll back on every shard; reads fanned out to other threads only see committed rows
+        with ExitStack() as stack:
+            for alias in sharding.get_shards():
+                stack.enter_context(transaction.atomic(using=alias))
+            response = getattr(client, scenario.method)(scenario.url, **kwargs)
+            if response.streaming:
+                for _ in response.streaming_content:
+                    pass
+            for alias in sharding.get_shards():
+                transaction.set_rollback(True, using=alias)
+        if response.status_code != scenario.expected:
+            raise CommandError(f'{scenario.name}: {scenario.url} returned {response.status_code}.')
+
+    def compare(self, results, path):
+        try:
+            with open(path) as baseline_file:
+                baseline = {result['name']: result for result in json.load(baseline_file)['results']}
+        except (OSError, ValueError, KeyError) as error:
+            raise CommandError(f'Cannot read {path}: {error}')
+
+        self.stdout.write(f'\n{"endpoint":<24} {"p50 change":>11} {"p95 change":>11} {"queries":>9}')
+        for result in results:
+            before = baseline.get(result['name'])
+            if before is None:
+                continue
+            self.stdout.write(
+                f'{result["name"]:<24} {self.change(before["p50_ms"], result["p50_ms"]):>11} '
+                f'{self.change(before["p95_ms"], result["p95_ms"]):>11} {result["queries"] - before["queries"]:>+9}'
+            )
+
+    def change(self, before, after):
+        return f'{(after - before) / before:+.1%}' if before else 'n/a'
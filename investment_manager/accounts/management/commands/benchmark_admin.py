@@ -0,0 +1,113 @@
+import json
+import random
+import statistics
+import time
+from datetime import timedelta
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, reset_queries, transaction
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from accounts import sharding
+from accounts.models import AccountPermission, InvestmentAccount, Transaction
+
+from .benchmark import percentile
+
+
+class Command(BaseCommand):
+    help = (
+        'Time the admin changelists for transactions and grants while the transaction table grows '
+        'through --sizes rows. Page times should stay flat. Everything runs inside a transaction '
+        'that is rolled back, so the database is left as it was.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='1000,10000,100000', help='Comma-separated transaction counts to time at.')
+        parser.add_argument('--requests', type=int, default=20, help='Timed requests per page per size.')
+        parser.add_argument('--days', type=int, default=365, help='Spread the added transactions over this many past days.')
+        parser.add_argument('--batch-size', type=int, default=10000, help='Rows per bulk insert.')
+        parser.add_argument('--output', help='Write the results as JSON to this file.')
+
+    def handle(self, *args, **options):
+        if sharding.is_sharded():
+            raise CommandError('The admin reads the default database only; run this without sharding.')
+        try:
+            sizes = sorted({int(size) for size in options['sizes'].split(',')})
+        except ValueError:
+            raise CommandError('--sizes takes a comma-separated list of row counts.')
+
+        results = []
+        self.stdout.write(f'{"rows":>9} {"page":<24} {"p50 ms":>9} {"p95 ms":>9} {"queries":>8}')
+        with override_settings(ALLOWED_HOSTS=['testserver']), transaction.atomic():
+            admin = User.objects.create(username='admin-benchmark', is_staff=True, is_superuser=True)
+            account = InvestmentAccount.objects.create(name='Admin benchmark')
+            AccountPermission.objects.create(user=admin, account=account, permission='crud')
+            client = Client()
+            client.force_login(admin)
+
+            rng = random.Random(0)
+            for size in sizes:
+                self.grow(rng, account, admin, size, options['days'], options['batch_size'])
+                rows = Transaction.objects.count()
+                for name, url in self.get_pages(account).items():
+                    result = self.time_page(client, url, options['requests'])
+                    results.append({'rows': rows, 'name': name, 'url': url, **result})
+                    self.stdout.write(f'{rows:>9} {name:<24} {result["p50_ms"]:>9.2f} {result["p95_ms"]:>9.2f} {result["queries"]:>8}')
+            transaction.set_rollback(True)
+
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump({'started_at': timezone.now().isoformat(), 'database': connection.vendor, 'results': results}, output, indent=2)
+            self.stdout.write(self.style.SUCCESS(f'Wrote results to {options["output"]}.'))
+
+    def grow(self, rng, account, user, size, days, batch_size):
+        """Add transactions on ``account`` until the table holds ``size`` rows."""
+        missing = size - Transaction.objects.count()
+        now = timezone.now()
+        span = days * 86400
+        while missing > 0:
+            batch = [
+                Transaction(account=account, user=user, amount=Decimal(rng.randint(-100000, 100000)) / 100, timestamp=now - timedelta(seconds=rng.randrange(span)))
+                for _ in range(min(batch_size, missing))
+            ]
+            # bulk_create skips the ledger signals, which the rollback would undo anyway
+            Transaction.objects.bulk_create(batch, batch_size=batch_size)
+            missing -= len(batch)
+
+    def get_pages(self, account):
+        today = timezone.localdate()
+        return {
+            'transactions': '/admin/accounts/transaction/',
+            'transactions-page-5': '/admin/accounts/transaction/?p=5',
+            'transactions-month': f'/admin/accounts/transaction/?timestamp__year={today.year}&timestamp__month={today.month}',
+            'transactions-account': f'/admin/accounts/transaction/?account__id__exact={account.pk}',
+            'grants': '/admin/accounts/accountpermission/',
+            'grants-crud': '/admin/accounts/accountpermission/?permission__exact=crud',
+        }
+
+    def time_page(self, client, url, requests):
+        # The request resets the query log as it starts, so start it empty
+        reset_queries()
+        with CaptureQueriesContext(connection) as queries:
+            self.get(client, url)
+        latencies = []
+        for _ in range(requests):
+            started = time.perf_counter()
+            self.get(client, url)
+            latencies.append(time.perf_counter() - started)
+        latencies.sort()
+        return {
+            'mean_ms': statistics.fmean(latencies) * 1000,
+            'p50_ms': percentile(latencies, 0.50) * 1000,
+            'p95_ms': percentile(latencies, 0.95) * 1000,
+            'queries': len(queries),
+        }
+
+    def get(self, client, url):
+        response = client.get(url)
+        if response.status_code != 200:
+            raise CommandError(f'{url} returned {response.status_code}.')
@@ -0,0 +1,80 @@
+import asyncio
+import statistics
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.test import AsyncClient, override_settings
+from django.urls import include, path
+
+from accounts.models import Transaction
+from accounts.permissions import load_account_permissions
+from accounts.urls import async_urlpatterns, sync_urlpatterns
+
+
+class SyncURLConf:
+    urlpatterns = [path('api/', include(sync_urlpatterns))]
+
+
+class AsyncURLConf:
+    urlpatterns = [path('api/', include(async_urlpatterns + sync_urlpatterns))]
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare concurrent request throughput of the sync and async transaction read views. '
+        'Both modes run through the same ASGI handler on one event loop, so the only difference '
+        'is whether a request holds a thread while it waits on the database.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('username', help='User whose transactions are requested; must have account grants.')
+        parser.add_argument('--requests', type=int, default=500, help='Requests per endpoint per mode.')
+        parser.add_argument('--concurrency', type=int, default=50, help='Requests in flight at once.')
+        parser.add_argument('--page-size', type=int, default=100)
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options['username'])
+        except User.DoesNotExist:
+            raise CommandError(f'No user named {options["username"]!r}.')
+
+        transaction_id = (
+            Transaction.objects.filter(account_id__in=load_account_permissions(user))
+            .values_list('id', flat=True).first()
+        )
+        if transaction_id is None:
+            raise CommandError('The user cannot see any transactions; seed some data first.')
+
+        paths = [f'/api/transactions/?page_size={options["page_size"]}', f'/api/transactions/{transaction_id}/']
+        if user.is_staff:
+            paths.append(f'/api/admin-transactions/?user_id={user.pk}&page_size={options["page_size"]}')
+
+        self.stdout.write(f'{"mode":<6} {"endpoint":<50} {"req/s":>9} {"p50 ms":>9} {"p95 ms":>9}')
+        for mode, urlconf in (('sync', SyncURLConf), ('async', AsyncURLConf)):
+            with override_settings(ROOT_URLCONF=urlconf, ALLOWED_HOSTS=['testserver']):
+                client = AsyncClient()
+                client.force_login(user)
+                for url in paths:
+                    elapsed, latencies = asyncio.run(self.drive(client, url, options['requests'], options['concurrency']))
+                    latencies.sort()
+                    self.stdout.write(
+                        f'{mode:<6} {url[:50]:<50} {len(latencies) / elapsed:>9.1f} '
+                        f'{statistics.median(latencies) * 1000:>9.2f} {latencies[int(len(latencies) * 0.95)] * 1000:>9.2f}'
+                    )
+
+    async def drive(self, client, url, requests, concurrency):
+        semaphore = asyncio.Semaphore(concurrency)
+        latencies = []
+
+        async def one():
+            async with semaphore:
+                started = time.perf_counter()
+                response = await client.get(url)
+                latencies.append(time.perf_counter() - started)
+                if response.status_code != 200:
+                    raise CommandError(f'{url} returned {response.status_code}.')
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one() for _ in range(requests)))
+        return time.perf_counter() - started, latencies
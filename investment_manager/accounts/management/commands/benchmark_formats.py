@@ -0,0 +1,81 @@
+import gzip
+import json
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.renderers import JSONRenderer
+
+from accounts import sharding
+from accounts.models import Transaction
+from accounts.renderers import ColumnarRenderer
+from accounts.row_serializers import TransactionRowSerializer
+
+from .benchmark import percentile
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare the JSON and columnar transaction formats on pages of real rows: encoded and gzipped '
+        'size, and the time to serialize and render a page. Rows are read once, so only encoding is timed.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--page-sizes', default='100,1000,10000', help='Comma-separated rows per page.')
+        parser.add_argument('--repeat', type=int, default=20, help='Timed encodes per format per page size.')
+        parser.add_argument('--output', help='Write the results as JSON to this file.')
+
+    def handle(self, *args, **options):
+        try:
+            page_sizes = sorted({int(size) for size in options['page_sizes'].split(',')})
+        except ValueError:
+            raise CommandError('--page-sizes takes a comma-separated list of row counts.')
+
+        row_serializer = TransactionRowSerializer()
+        newest = row_serializer.select(Transaction.objects.order_by('-timestamp', '-id'))[:max(page_sizes)]
+        rows = sorted((row for shard_rows in sharding.fan_out(lambda: list(newest.all())) for row in shard_rows), key=lambda row: (row.timestamp, row.id), reverse=True)
+        if not rows:
+            raise CommandError('There are no transactions; seed some data first.')
+
+        formats = {
+            'json': (row_serializer.serialize, JSONRenderer()),
+            'columns': (row_serializer.serialize_columns, ColumnarRenderer()),
+        }
+        results = []
+        self.stdout.write(f'{"rows":>7} {"format":<8} {"bytes":>11} {"gzip bytes":>11} {"p50 ms":>9} {"p95 ms":>9} {"size":>7}')
+        for page_size in page_sizes:
+            page = rows[:page_size]
+            baseline = None
+            for name, (serialize, renderer) in formats.items():
+                result = self.time_format(page, serialize, renderer, options['repeat'])
+                baseline = baseline or result
+                results.append({'rows': len(page), 'format': name, **result})
+                self.stdout.write(
+                    f'{len(page):>7} {name:<8} {result["bytes"]:>11} {result["gzip_bytes"]:>11} '
+                    f'{result["p50_ms"]:>9.2f} {result["p95_ms"]:>9.2f} {result["bytes"] / baseline["bytes"]:>7.0%}'
+                )
+
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump({'results': results}, output, indent=2)
+            self.stdout.write(self.style.SUCCESS(f'Wrote results to {options["output"]}.'))
+
+    def time_format(self, page, serialize, renderer, repeat):
+        # Page-sized payloads: results plus the keyset links every list response carries
+        def encode():
+            return renderer.render({'next': None, 'previous': None, 'results': serialize(page)})
+
+        body = encode()
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            encode()
+            timings.append(time.perf_counter() - started)
+        timings.sort()
+        return {
+            'bytes': len(body),
+            'gzip_bytes': len(gzip.compress(body)),
+            'mean_ms': statistics.fmean(timings) * 1000,
+            'p50_ms': percentile(timings, 0.50) * 1000,
+            'p95_ms': percentile(timings, 0.95) * 1000,
+        }
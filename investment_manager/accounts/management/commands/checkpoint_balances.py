@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from accounts import ledger
+
+
+class Command(BaseCommand):
+    help = (
+        'Add balance checkpoints for every ACCOUNTS_CHECKPOINT_INTERVAL bucket that has ended since the last run, '
+        'so point-in-time balances stay cheap. Run it on a schedule, e.g. daily.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('account_ids', nargs='*', type=int, help='Limit the run to these accounts.')
+        parser.add_argument(
+            '--rebuild', action='store_true',
+            help='Drop and recompute the checkpoints, e.g. after rebuild_rollups.',
+        )
+
+    def handle(self, *args, **options):
+        count = ledger.checkpoint(options['account_ids'] or None, rebuild=options['rebuild'])
+        self.stdout.write(self.style.SUCCESS(f'Added {count} balance checkpoint(s) by {ledger.get_checkpoint_interval()}.'))
@@ -0,0 +1,26 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from accounts import events
+
+
+class Command(BaseCommand):
+    help = (
+        'Delete old entries from the change feed log. '
+        'Clients that reconnect from further back are told to reload instead of catching up.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--older-than-days', type=int, default=getattr(settings, 'ACCOUNTS_EVENTS_RETENTION_DAYS', 7),
+            help='Delete entries logged at least this many days ago.',
+        )
+        parser.add_argument('--batch-size', type=int, default=5000, help='Entries deleted per query.')
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options['older_than_days'])
+        deleted = events.prune(cutoff, options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} change feed event(s) logged before {cutoff:%Y-%m-%d %H:%M}.'))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from accounts import ledger
+
+
+class Command(BaseCommand):
+    help = 'Recompute the materialized account balances from the transaction history.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('account_ids', nargs='*', type=int, help='Limit the rebuild to these accounts.')
+
+    def handle(self, *args, **options):
+        count = ledger.rebuild(options['account_ids'] or None)
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt balances for {count} account(s).'))
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from accounts import ledger
+
+
+class Command(BaseCommand):
+    help = 'Recompute the daily, weekly and monthly transaction rollups from the transaction history.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('account_ids', nargs='*', type=int, help='Limit the rebuild to these accounts.')
+        parser.add_argument(
+            '--granularity', action='append', choices=ledger.ROLLUP_GRANULARITIES, dest='granularities',
+            help='Rebuild only this granularity. May be repeated; defaults to all of them.',
+        )
+
+    def handle(self, *args, **options):
+        count = ledger.rebuild_rollups(options['account_ids'] or None, options['granularities'])
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {count} rollup row(s).'))
@@ -0,0 +1,130 @@
+import multiprocessing
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from accounts import jobs
+from accounts.models import ReportJob
+
+
+class Command(BaseCommand):
+    help = (
+        'Run queued report and export jobs on a pool of processes, writing results under ACCOUNTS_JOB_RESULTS_DIR. '
+        'Any number of workers may share the queue; start one per machine.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--processes', type=int, default=getattr(settings, 'ACCOUNTS_JOB_CONCURRENCY', 4),
+            help='Jobs this worker runs at once, each in its own process. 0 runs them one at a time in this process.',
+        )
+        parser.add_argument('--poll-interval', type=float, default=1.0, help='Seconds between checks for new jobs.')
+        parser.add_argument('--once', action='store_true', help='Exit once no job is due and none is running.')
+
+    def handle(self, *args, **options):
+        self.worker = jobs.worker_name()
+        self.stdout.write(f'Worker {self.worker} running jobs with {options["processes"] or "no"} extra process(es).')
+        if options['processes'] > 0:
+            self.run_pool(options['processes'], options['poll_interval'], options['once'])
+        else:
+            self.run_inline(options['poll_interval'], options['once'])
+
+    def run_inline(self, poll_interval, once):
+        while True:
+            jobs.recover_expired()
+            claimed = jobs.claim(self.worker)
+            if claimed:
+                with self.heartbeat(claimed):
+                    job_status = jobs.run(claimed[0])
+                self.report(claimed[0], job_status)
+            elif once:
+                return
+            else:
+                time.sleep(poll_interval)
+
+    @contextmanager
+    def heartbeat(self, job_ids):
+        """
+        Renew the lease on ``job_ids`` from a background thread while the
+        block runs, as the pool loop does between polls, so a long inline job
+        is not taken over by another worker.
+        """
+        stop = threading.Event()
+        interval = jobs.get_lease().total_seconds() / 3
+
+        def beat():
+            try:
+                while not stop.wait(interval):
+                    jobs.renew(self.worker, job_ids)
+            finally:
+                # Only this thread's connections
+                connections.close_all()
+
+        thread = threading.Thread(target=beat, name='run_jobs-heartbeat', daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def run_pool(self, processes, poll_interval, once):
+        running = {}
+        pool = self.start_pool(processes)
+        try:
+            while True:
+                jobs.recover_expired()
+                jobs.renew(self.worker, running.values())
+                for job_id in jobs.claim(self.worker, processes - len(running)):
+                    running[pool.submit(jobs.run, job_id)] = job_id
+                if not running:
+                    if once:
+                        return
+                    time.sleep(poll_interval)
+                    continue
+
+                done, _ = wait(running, timeout=poll_interval, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job_id = running.pop(future)
+                    try:
+                        self.report(job_id, future.result())
+                    except BrokenProcessPool:
+                        # A process died mid-job (killed, out of memory); count it
+                        # as a failed attempt and carry on with a fresh pool
+                        self.abandon(job_id, 'The process running the job died.')
+                        for other in running.values():
+                            self.abandon(other, 'The process running the job died.')
+                        self.stop_pool(pool, running)
+                        running.clear()
+                        pool = self.start_pool(processes)
+                        break
+        finally:
+            self.stop_pool(pool, running)
+
+    def start_pool(self, processes):
+        # Fresh interpreters rather than forks, so no process inherits
+        # another's database connections
+        return ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn'), initializer=django.setup)
+
+    def stop_pool(self, pool, futures):
+        # Cancel what has not started rather than shutdown(cancel_futures=True),
+        # which needs Python 3.9
+        for future in futures:
+            future.cancel()
+        pool.shutdown(wait=False)
+
+    def abandon(self, job_id, error):
+        job = ReportJob.objects.get(pk=job_id)
+        jobs.retry_or_fail(job, error)
+        self.report(job_id, ReportJob.objects.values_list('status', flat=True).get(pk=job_id))
+
+    def report(self, job_id, job_status):
+        style = self.style.SUCCESS if job_status == 'succeeded' else self.style.WARNING
+        self.stdout.write(style(f'Job {job_id}: {job_status}'))
@@ -0,0 +1,122 @@
+import random
+import time
+from datetime import timedelta
+from decimal import Decimal
+from operator import attrgetter
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from accounts import ledger, sharding
+from accounts.models import AccountPermission, InvestmentAccount, Transaction
+
+PERMISSIONS = ['view', 'crud', 'post']
+PERMISSION_WEIGHTS = [5, 3, 2]
+
+
+class Command(BaseCommand):
+    help = (
+        'Seed a synthetic dataset for load testing: users, accounts, mixed permission grants and '
+        'transactions, written with bulk inserts. The balance ledger and rollups are rebuilt at the end.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100)
+        parser.add_argument('--accounts', type=int, default=1000)
+        parser.add_argument('--transactions', type=int, default=100000)
+        parser.add_argument('--grants-per-account', type=int, default=3, help='Upper bound on users granted each account.')
+        parser.add_argument('--days', type=int, default=365, help='Spread transaction timestamps over this many past days.')
+        parser.add_argument('--batch-size', type=int, default=10000, help='Rows per bulk insert.')
+        parser.add_argument('--prefix', default='bench', help='Prefix for generated usernames and account names.')
+        parser.add_argument('--seed', type=int, default=0, help='Random seed, so runs are reproducible.')
+
+    def handle(self, *args, **options):
+        if min(options['users'], options['accounts'], options['grants_per_account']) < 1:
+            raise CommandError('--users, --accounts and --grants-per-account must be at least 1.')
+        prefix = options['prefix']
+        if User.objects.filter(username__startswith=f'{prefix}-').exists():
+            raise CommandError(f'Users prefixed {prefix!r} already exist; pick another --prefix.')
+
+        rng = random.Random(options['seed'])
+        started = time.perf_counter()
+
+        user_ids = self.create_users(prefix, options['users'], options['batch_size'])
+        account_ids = self.create_accounts(prefix, options['accounts'], options['batch_size'])
+        writers = self.create_grants(rng, user_ids, account_ids, options['grants_per_account'], options['batch_size'])
+        self.create_transactions(rng, writers, options['transactions'], options['days'], options['batch_size'])
+
+        # bulk_create skips the signals that maintain the ledger
+        self.stdout.write('Rebuilding balances and rollups...')
+        ledger.rebuild()
+        ledger.rebuild_rollups()
+        self.stdout.write(self.style.SUCCESS(
+            f'Seeded {len(user_ids)} users, {len(account_ids)} accounts and {options["transactions"]} transactions '
+            f'in {time.perf_counter() - started:.1f}s. Log in as {prefix}-admin / password for the admin report.'
+        ))
+
+    def create_users(self, prefix, count, batch_size):
+        # Hashing is deliberately slow, so every generated user shares one hash
+        password = make_password('password')
+        users = [User(username=f'{prefix}-{i}', password=password) for i in range(count)]
+        users.append(User(username=f'{prefix}-admin', password=password, is_staff=True, is_superuser=True))
+        User.objects.bulk_create(users, batch_size=batch_size)
+        return list(User.objects.filter(username__startswith=f'{prefix}-', is_staff=False).values_list('pk', flat=True))
+
+    def create_accounts(self, prefix, count, batch_size):
+        accounts = [InvestmentAccount(name=f'{prefix} account {i}') for i in range(count)]
+        if not sharding.is_sharded():
+            InvestmentAccount.objects.bulk_create(accounts, batch_size=batch_size)
+            return list(InvestmentAccount.objects.filter(name__startswith=f'{prefix} account ').values_list('pk', flat=True))
+        for account, pk in zip(accounts, sharding.allocate_ids(InvestmentAccount, count)):
+            account.pk = pk
+        self.bulk_create(InvestmentAccount, accounts, batch_size, key=attrgetter('pk'))
+        return [account.pk for account in accounts]
+
+    def create_grants(self, rng, user_ids, account_ids, grants_per_account, batch_size):
+        """Grant each account to a few distinct users and return, per account, who may post to it."""
+        grants = []
+        writers = {}
+        for account_id in account_ids:
+            holders = rng.sample(user_ids, rng.randint(1, min(grants_per_account, len(user_ids))))
+            for user_id in holders:
+                permission = rng.choices(PERMISSIONS, PERMISSION_WEIGHTS)[0]
+                grants.append(AccountPermission(user_id=user_id, account_id=account_id, permission=permission))
+                if permission in ('crud', 'post'):
+                    writers.setdefault(account_id, []).append(user_id)
+        self.bulk_create(AccountPermission, grants, batch_size)
+        return writers
+
+    def create_transactions(self, rng, writers, count, days, batch_size):
+        if count and not writers:
+            raise CommandError('No account has a crud or post grant to attribute transactions to; add users or grants.')
+        accounts = list(writers)
+        now = timezone.now()
+        span = days * 86400
+        written = 0
+        while written < count:
+            size = min(batch_size, count - written)
+            batch = []
+            for _ in range(size):
+                account_id = rng.choice(accounts)
+                batch.append(Transaction(
+                    account_id=account_id,
+                    user_id=rng.choice(writers[account_id]),
+                    amount=Decimal(rng.randint(-100000, 100000)) / 100,
+                    timestamp=now - timedelta(seconds=rng.randrange(span)),
+                ))
+            if sharding.is_sharded():
+                for row, pk in zip(batch, sharding.allocate_ids(Transaction, size)):
+                    row.pk = pk
+            self.bulk_create(Transaction, batch, batch_size)
+            written += size
+            self.stdout.write(f'  {written}/{count} transactions', ending='\r')
+        self.stdout.write('')
+
+    def bulk_create(self, model, rows, batch_size, key=attrgetter('account_id')):
+        """Insert rows on the shard of the account each belongs to."""
+        for alias, shard_rows in sharding.group_by_shard(rows, key=key).items():
+            with transaction.atomic(using=alias):
+                model.objects.using(alias).bulk_create(shard_rows, batch_size=batch_size)
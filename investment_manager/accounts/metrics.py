@@ -0,0 +1,154 @@
+"""
+In-process request and database metrics, exposed in Prometheus text format.
+
+Each worker process keeps its own registry, so a deployment with several
+workers should scrape each of them (or put a single worker behind
+``/api/metrics/``). Recording a request costs a lock acquisition and a few
+list updates, which is cheap enough to leave on in production.
+"""
+import logging
+import threading
+import time
+from bisect import bisect_left
+
+logger = logging.getLogger('accounts.slow_queries')
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self):
+        """Cumulative ``(le, count)`` pairs, ending with ``+Inf``."""
+        cumulative = 0
+        for bound, count in zip((*self.buckets, '+Inf'), self.counts):
+            cumulative += count
+            yield bound, cumulative
+
+
+class RouteMetrics:
+    __slots__ = ('responses', 'duration', 'queries', 'db_seconds', 'slow_queries', 'size')
+
+    def __init__(self):
+        self.responses = {}
+        self.duration = Histogram(DURATION_BUCKETS)
+        self.queries = Histogram(QUERY_BUCKETS)
+        self.db_seconds = 0.0
+        self.slow_queries = 0
+        self.size = Histogram(SIZE_BUCKETS)
+
+
+class QueryTimer:
+    """
+    ``connection.execute_wrapper`` hook counting and timing a request's queries.
+
+    Queries slower than ``threshold`` milliseconds are logged to
+    ``accounts.slow_queries``; pass None to turn the log off.
+    """
+
+    def __init__(self, threshold=None, path=''):
+        self.threshold = threshold
+        self.path = path
+        self.count = 0
+        self.seconds = 0.0
+        self.slow = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.count += 1
+            self.seconds += elapsed
+            if self.threshold is not None and elapsed * 1000 >= self.threshold:
+                self.slow += 1
+                logger.warning('Slow query (%.1f ms) during %s: %s', elapsed * 1000, self.path, sql)
+
+
+class Registry:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.routes = {}
+
+    def record(self, route, method, status_code, duration, timer, size=None):
+        with self.lock:
+            metrics = self.routes.get((route, method))
+            if metrics is None:
+                metrics = self.routes[route, method] = RouteMetrics()
+            metrics.responses[status_code] = metrics.responses.get(status_code, 0) + 1
+            metrics.duration.observe(duration)
+            metrics.queries.observe(timer.count)
+            metrics.db_seconds += timer.seconds
+            metrics.slow_queries += timer.slow
+            if size is not None:
+                metrics.size.observe(size)
+
+    def reset(self):
+        with self.lock:
+            self.routes = {}
+
+    def render(self):
+        with self.lock:
+            routes = sorted(self.routes.items())
+            lines = []
+
+            def family(name, kind, help_text):
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} {kind}')
+
+            def histogram(name, labels, histogram):
+                for bound, count in histogram.samples():
+                    lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {count}')
+                lines.append(f'{name}_sum{{{labels}}} {histogram.sum}')
+                lines.append(f'{name}_count{{{labels}}} {histogram.count}')
+
+            family('accounts_http_requests_total', 'counter', 'Responses by route, method and status.')
+            for (route, method), metrics in routes:
+                for status_code, count in sorted(metrics.responses.items()):
+                    lines.append(f'accounts_http_requests_total{{{labels(route, method)},status="{status_code}"}} {count}')
+
+            family('accounts_http_request_duration_seconds', 'histogram', 'Time to produce the response.')
+            for (route, method), metrics in routes:
+                histogram('accounts_http_request_duration_seconds', labels(route, method), metrics.duration)
+
+            family('accounts_db_queries_per_request', 'histogram', 'SQL queries issued per request.')
+            for (route, method), metrics in routes:
+                histogram('accounts_db_queries_per_request', labels(route, method), metrics.queries)
+
+            family('accounts_db_query_seconds_total', 'counter', 'Time spent waiting on SQL queries.')
+            for (route, method), metrics in routes:
+                lines.append(f'accounts_db_query_seconds_total{{{labels(route, method)}}} {metrics.db_seconds}')
+
+            family('accounts_db_slow_queries_total', 'counter', 'Queries over ACCOUNTS_SLOW_QUERY_MS.')
+            for (route, method), metrics in routes:
+                lines.append(f'accounts_db_slow_queries_total{{{labels(route, method)}}} {metrics.slow_queries}')
+
+            family('accounts_http_response_size_bytes', 'histogram', 'Serialized body size of non-streaming responses.')
+            for (route, method), metrics in routes:
+                histogram('accounts_http_response_size_bytes', labels(route, method), metrics.size)
+
+        return '\n'.join(lines) + '\n'
+
+
+def labels(route, method):
+    route = route.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return f'route="{route}",method="{method}"'
+
+
+registry = Registry()
@@ -0,0 +1,65 @@
+import time
+from contextlib import ExitStack
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+
+from .metrics import QueryTimer, registry
+
+
+class RequestMetricsMiddleware:
+    """
+    Record per-route request counts, latency, SQL query counts and time, and
+    response size into ``accounts.metrics.registry``.
+
+    Place it first in MIDDLEWARE so the timings cover the whole stack. For
+    streaming responses only the time to the first byte is measured and the
+    size is not recorded.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        timer = self.get_timer(request)
+        started = time.perf_counter()
+        with self.instrument(timer):
+            response = self.get_response(request)
+        self.record(request, response, time.perf_counter() - started, timer)
+        return response
+
+    async def __acall__(self, request):
+        timer = self.get_timer(request)
+        started = time.perf_counter()
+        with self.instrument(timer):
+            response = await self.get_response(request)
+        self.record(request, response, time.perf_counter() - started, timer)
+        return response
+
+    def get_timer(self, request):
+        return QueryTimer(getattr(settings, 'ACCOUNTS_SLOW_QUERY_MS', None), request.path)
+
+    def instrument(self, timer):
+        stack = ExitStack()
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(timer))
+        return stack
+
+    def record(self, request, response, duration, timer):
+        size = None if response.streaming else len(response.content)
+        registry.record(route_label(request), request.method, response.status_code, duration, timer, size)
+
+
+def route_label(request):
+    """The URL name of the matched route, or its pattern if it has none."""
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unmatched'
+    return match.view_name if match.url_name else match.route
@@ -0,0 +1,62 @@
+# Generated by Django 4.2.16 on 2026-10-18 17:25
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def backfill_balances(apps, schema_editor):
+    InvestmentAccount = apps.get_model('accounts', 'InvestmentAccount')
+    Transaction = apps.get_model('accounts', 'Transaction')
+    AccountBalance = apps.get_model('accounts', 'AccountBalance')
+    AccountUserBalance = apps.get_model('accounts', 'AccountUserBalance')
+
+    totals = (
+        Transaction.objects.values('account_id', 'user_id')
+        .annotate(balance=models.Sum('amount'), transaction_count=models.Count('id'))
+        .order_by()
+    )
+    per_account = {account_id: (0, 0) for account_id in InvestmentAccount.objects.values_list('id', flat=True)}
+    for total in totals:
+        AccountUserBalance.objects.create(**total)
+        balance, count = per_account[total['account_id']]
+        per_account[total['account_id']] = (balance + total['balance'], count + total['transaction_count'])
+
+    AccountBalance.objects.bulk_create(
+        AccountBalance(account_id=account_id, balance=balance, transaction_count=count)
+        for account_id, (balance, count) in per_account.items()
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('accounts', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AccountBalance',
+            fields=[
+                ('account', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='ledger', serialize=False, to='accounts.investmentaccount')),
+                ('balance', models.DecimalField(decimal_places=2, default=0, max_digits=20)),
+                ('transaction_count', models.PositiveBigIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='AccountUserBalance',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('balance', models.DecimalField(decimal_places=2, default=0, max_digits=20)),
+                ('transaction_count', models.PositiveBigIntegerField(default=0)),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='user_balances', to='accounts.investmentaccount')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='account_balances', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='accountuserbalance',
+            constraint=models.UniqueConstraint(fields=('account', 'user'), name='unique_account_user_balance'),
+        ),
+        migrations.RunPython(backfill_balances, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 4.2.16 on 2026-10-18 17:36
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models.functions import Trunc
+
+
+def backfill_rollups(apps, schema_editor):
+    Transaction = apps.get_model('accounts', 'Transaction')
+    TransactionRollup = apps.get_model('accounts', 'TransactionRollup')
+
+    for granularity in ('day', 'week', 'month'):
+        totals = (
+            Transaction.objects.annotate(bucket=Trunc('timestamp', granularity, output_field=models.DateField()))
+            .values('account_id', 'user_id', 'bucket')
+            .annotate(total=models.Sum('amount'), transaction_count=models.Count('id'))
+            .order_by()
+        )
+        TransactionRollup.objects.bulk_create(
+            [TransactionRollup(granularity=granularity, **total) for total in totals],
+            batch_size=1000,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('accounts', '0002_account_balances'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TransactionRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('granularity', models.CharField(choices=[('day', 'Daily'), ('week', 'Weekly'), ('month', 'Monthly')], max_length=5)),
+                ('bucket', models.DateField()),
+                ('total', models.DecimalField(decimal_places=2, default=0, max_digits=20)),
+                ('transaction_count', models.BigIntegerField(default=0)),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rollups', to='accounts.investmentaccount')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='transaction_rollups', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='transactionrollup',
+            constraint=models.UniqueConstraint(fields=('account', 'granularity', 'bucket', 'user'), name='unique_transaction_rollup'),
+        ),
+        migrations.RunPython(backfill_rollups, migrations.RunPython.noop),
+    ]
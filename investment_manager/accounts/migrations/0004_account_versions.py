@@ -0,0 +1,24 @@
+# Generated by Django 4.2.16 on 2026-10-18 17:45
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0003_transaction_rollups'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='accountbalance',
+            name='modified',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='accountbalance',
+            name='version',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 4.2.16 on 2026-10-18 17:59
+
+from django.db import migrations, models
+
+
+def remove_duplicate_permissions(apps, schema_editor):
+    # Keep the newest grant for each user and account; the permission map,
+    # read in insertion order, already let the last duplicate win.
+    AccountPermission = apps.get_model('accounts', 'AccountPermission')
+    duplicates = (
+        AccountPermission.objects.values('user_id', 'account_id')
+        .annotate(keep=models.Max('id'), copies=models.Count('id'))
+        .filter(copies__gt=1)
+        .order_by()
+    )
+    for duplicate in duplicates.iterator():
+        AccountPermission.objects.filter(
+            user_id=duplicate['user_id'], account_id=duplicate['account_id'],
+        ).exclude(pk=duplicate['keep']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0005_transaction_timestamp_default'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_permissions, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['account', 'timestamp', 'id'], name='transaction_account_time'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['user', 'timestamp', 'id'], name='transaction_user_time'),
+        ),
+        migrations.AddConstraint(
+            model_name='accountpermission',
+            constraint=models.UniqueConstraint(fields=('user', 'account'), name='unique_account_permission'),
+        ),
+    ]
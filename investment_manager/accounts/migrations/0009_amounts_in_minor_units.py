@@ -0,0 +1,69 @@
+from django.db import migrations, models
+from django.db.models.functions import Cast, Round
+
+import accounts.fields
+
+# (model, field, max_digits of the old decimal column, whether it defaults to 0)
+AMOUNT_FIELDS = [
+    ('transaction', 'amount', 10, False),
+    ('archivedtransaction', 'amount', 10, False),
+    ('accountbalance', 'balance', 20, True),
+    ('accountuserbalance', 'balance', 20, True),
+    ('transactionrollup', 'total', 20, True),
+    ('archivedperiod', 'total', 20, True),
+]
+
+# Cents per dollar. The columns converted here were decimal_places=2 and the
+# MoneyField replacing them was USD; fixed rather than read from app code, so
+# replaying or reversing this migration never depends on later field changes
+SCALE = 100
+
+
+def copy_amounts(model_name, field_name, to_minor):
+    old = f'{field_name}_decimal'
+
+    def copy(apps, schema_editor):
+        Model = apps.get_model('accounts', model_name)
+        rows = Model.objects.using(schema_editor.connection.alias)
+        if to_minor:
+            rows.update(**{field_name: Cast(Round(models.F(old) * SCALE), models.BigIntegerField())})
+        else:
+            # Divide by a float so SQLite does not truncate to whole units;
+            # the decimal column rounds the result back to cents.
+            rows.update(**{old: models.ExpressionWrapper(models.F(field_name) / float(SCALE), output_field=models.DecimalField())})
+    return copy
+
+
+def convert(model_name, field_name, max_digits, has_default):
+    """
+    Swap a decimal column for a minor-unit one, copying the values across in
+    SQL. The old column is made nullable first so the swap can be reversed.
+    """
+    old = f'{field_name}_decimal'
+    default = {'default': 0} if has_default else {}
+    return [
+        migrations.RenameField(model_name=model_name, old_name=field_name, new_name=old),
+        migrations.AlterField(model_name=model_name, name=old, field=models.DecimalField(decimal_places=2, max_digits=max_digits, null=True, **default)),
+        migrations.AddField(model_name=model_name, name=field_name, field=accounts.fields.MoneyField(null=True)),
+        migrations.RunPython(
+            copy_amounts(model_name, field_name, to_minor=True),
+            copy_amounts(model_name, field_name, to_minor=False),
+            # Lets the shard router run the copy on every shard holding the table
+            hints={'model_name': model_name},
+        ),
+        migrations.RemoveField(model_name=model_name, name=old),
+        migrations.AlterField(model_name=model_name, name=field_name, field=accounts.fields.MoneyField(**default)),
+    ]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0008_shard_sequences_unconstrained_users'),
+    ]
+
+    operations = [
+        operation
+        for model_name, field_name, max_digits, has_default in AMOUNT_FIELDS
+        for operation in convert(model_name, field_name, max_digits, has_default)
+    ]
@@ -1,5 +1,11 @@
 from django.contrib.auth.models import User
 from django.db import models
+from django.utils import timezone
+
+from .fields import MoneyField
+
+# Users stay on the default database when the account data is sharded (see
+# sharding.py), so foreign keys to them carry no database constraint.
 
 class InvestmentAccount(models.Model):
     name = models.CharField(max_length=255)
@@ -15,18 +21,214 @@ class AccountPermission(models.Model):
         ('post', 'Post Transactions Only'),
     ]
 
-    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, db_constraint=False)
     account = models.ForeignKey(InvestmentAccount, on_delete=models.CASCADE)
     permission = models.CharField(max_length=10, choices=PERMISSION_CHOICES)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'account'], name='unique_account_permission'),
+        ]
+
     def __str__(self):
         return f'{self.user.username} - {self.account.name} ({self.permission})'
 
 class Transaction(models.Model):
     account = models.ForeignKey(InvestmentAccount, related_name='transactions', on_delete=models.CASCADE)
-    user = models.ForeignKey(User, on_delete=models.CASCADE)
-    amount = models.DecimalField(max_digits=10, decimal_places=2)
-    timestamp = models.DateTimeField(auto_now_add=True)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, db_constraint=False)
+    # Whole cents in a bigint column; read and written as a Decimal
+    amount = MoneyField()
+    timestamp = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        # Lists and reports filter on one of the foreign keys and page by (timestamp, id);
+        # the admin pages the whole table by (timestamp, id) and drills into date ranges
+        indexes = [
+            models.Index(fields=['account', 'timestamp', 'id'], name='transaction_account_time'),
+            models.Index(fields=['user', 'timestamp', 'id'], name='transaction_user_time'),
+            models.Index(fields=['timestamp', 'id'], name='transaction_time'),
+        ]
 
     def __str__(self):
         return f'{self.amount} - {self.account.name} by {self.user.username}'
+
+class AccountBalance(models.Model):
+    account = models.OneToOneField(InvestmentAccount, primary_key=True, related_name='ledger', on_delete=models.CASCADE)
+    balance = MoneyField(default=0)
+    transaction_count = models.PositiveBigIntegerField(default=0)
+    # Bumped whenever anything that shows up in the account's API payloads changes
+    version = models.PositiveBigIntegerField(default=0)
+    modified = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f'{self.account_id}: {self.balance}'
+
+class AccountUserBalance(models.Model):
+    account = models.ForeignKey(InvestmentAccount, related_name='user_balances', on_delete=models.CASCADE)
+    user = models.ForeignKey(User, related_name='account_balances', on_delete=models.CASCADE, db_constraint=False)
+    balance = MoneyField(default=0)
+    transaction_count = models.PositiveBigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['account', 'user'], name='unique_account_user_balance'),
+        ]
+
+    def __str__(self):
+        return f'{self.account_id}/{self.user_id}: {self.balance}'
+
+class TransactionRollup(models.Model):
+    GRANULARITY_CHOICES = [
+        ('day', 'Daily'),
+        ('week', 'Weekly'),
+        ('month', 'Monthly'),
+    ]
+
+    account = models.ForeignKey(InvestmentAccount, related_name='rollups', on_delete=models.CASCADE)
+    user = models.ForeignKey(User, related_name='transaction_rollups', on_delete=models.CASCADE, db_constraint=False)
+    granularity = models.CharField(max_length=5, choices=GRANULARITY_CHOICES)
+    bucket = models.DateField()
+    total = MoneyField(default=0)
+    transaction_count = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            # Column order serves the range scan: one account, one granularity, a span of buckets
+            models.UniqueConstraint(fields=['account', 'granularity', 'bucket', 'user'], name='unique_transaction_rollup'),
+        ]
+
+    def __str__(self):
+        return f'{self.account_id}/{self.user_id} {self.granularity} {self.bucket}: {self.total}'
+
+class BalanceCheckpoint(models.Model):
+    """
+    An account's balance over every transaction before ``bucket`` starts.
+
+    Kept for each ``ACCOUNTS_CHECKPOINT_INTERVAL`` bucket that follows one
+    with activity, so a point-in-time balance only sums the transactions
+    since the nearest checkpoint (see ``ledger.balance_as_of``).
+    """
+    account = models.ForeignKey(InvestmentAccount, related_name='checkpoints', on_delete=models.CASCADE)
+    granularity = models.CharField(max_length=5, choices=TransactionRollup.GRANULARITY_CHOICES)
+    bucket = models.DateField()
+    balance = MoneyField(default=0)
+    transaction_count = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            # Also serves the lookup of the newest checkpoint before a date
+            models.UniqueConstraint(fields=['account', 'granularity', 'bucket'], name='unique_balance_checkpoint'),
+        ]
+
+    def __str__(self):
+        return f'{self.account_id} before {self.bucket}: {self.balance}'
+
+class ArchivedTransaction(models.Model):
+    """
+    A transaction moved out of the hot table by ``archive_transactions``.
+
+    Rows keep their original id, so (timestamp, id) keyset cursors stay valid
+    across the two tables. Archived rows are read-only and still counted in
+    the balances and rollups, which archiving leaves untouched.
+    """
+    id = models.BigIntegerField(primary_key=True)
+    account = models.ForeignKey(InvestmentAccount, related_name='archived_transactions', on_delete=models.CASCADE)
+    user = models.ForeignKey(User, related_name='archived_transactions', on_delete=models.CASCADE, db_constraint=False)
+    amount = MoneyField()
+    timestamp = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['account', 'timestamp', 'id'], name='archived_account_time'),
+            models.Index(fields=['user', 'timestamp', 'id'], name='archived_user_time'),
+        ]
+
+    def __str__(self):
+        return f'{self.amount} - {self.account_id} by {self.user_id} (archived)'
+
+class ArchivedPeriod(models.Model):
+    """One calendar month of archived transactions, with its totals."""
+    start = models.DateTimeField(unique=True)
+    end = models.DateTimeField()
+    total = MoneyField(default=0)
+    transaction_count = models.BigIntegerField(default=0)
+    archived_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f'{self.start:%Y-%m}: {self.transaction_count} transaction(s)'
+
+class TransactionEvent(models.Model):
+    """
+    One entry in the change feed's log: a transaction as it was created.
+
+    Written in the same database transaction as the transaction itself and
+    read only when a client resumes the feed (see events.py), by account and
+    id. ``prune_transaction_events`` trims old entries.
+    """
+    account = models.ForeignKey(InvestmentAccount, related_name='events', on_delete=models.CASCADE)
+    # Not a foreign key: the transaction may since have been archived or deleted
+    transaction_id = models.BigIntegerField()
+    user = models.ForeignKey(User, related_name='+', on_delete=models.CASCADE, db_constraint=False)
+    amount = MoneyField()
+    timestamp = models.DateTimeField()
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['account', 'id'], name='transaction_event_account'),
+        ]
+
+    def __str__(self):
+        return f'Event {self.pk}: transaction {self.transaction_id} on {self.account_id}'
+
+class ShardSequence(models.Model):
+    """Next ids for a sharded model, kept on the default database so ids are unique across shards."""
+    name = models.CharField(max_length=100, unique=True)
+    last_id = models.PositiveBigIntegerField(default=0)
+
+    def __str__(self):
+        return f'{self.name}: {self.last_id}'
+
+class ReportJob(models.Model):
+    """
+    A report or export queued for the ``run_jobs`` worker (see jobs.py).
+
+    The table is the queue: workers claim queued rows whose ``run_after`` has
+    passed, hold them under a lease until ``locked_until``, and leave the
+    result in a file under ``ACCOUNTS_JOB_RESULTS_DIR``.
+    """
+    KIND_CHOICES = [
+        ('export', 'Transaction export'),
+        ('batch-report', 'Batch report'),
+    ]
+    STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('succeeded', 'Succeeded'),
+        ('failed', 'Failed'),
+    ]
+
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    params = models.JSONField(default=dict)
+    requested_by = models.ForeignKey(User, related_name='report_jobs', on_delete=models.CASCADE)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='queued')
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=3)
+    run_after = models.DateTimeField(default=timezone.now)
+    locked_by = models.CharField(max_length=100, blank=True)
+    locked_until = models.DateTimeField(null=True, blank=True)
+    result_name = models.CharField(max_length=255, blank=True)
+    content_type = models.CharField(max_length=100, blank=True)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # Workers look for the oldest due job of one status
+            models.Index(fields=['status', 'run_after', 'id'], name='report_job_queue'),
+        ]
+
+    def __str__(self):
+        return f'{self.kind} #{self.pk} ({self.status})'
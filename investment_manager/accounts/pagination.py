@@ -0,0 +1,152 @@
+from base64 import b64decode, b64encode
+from collections import OrderedDict, namedtuple
+from collections.abc import Mapping
+from itertools import chain
+from urllib import parse
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+from . import sharding
+
+Cursor = namedtuple('Cursor', ['reverse', 'timestamp', 'id'])
+
+
+class KeysetPagination(BasePagination):
+    """
+    Newest-first keyset pagination over ``(timestamp, id)``.
+
+    The cursor carries the sort key of the row at the page boundary, so each
+    page is fetched with a range condition rather than an OFFSET and costs the
+    same however deep the client has paged.
+    """
+    page_size = 100
+    max_page_size = 1000
+    page_size_query_param = 'page_size'
+    cursor_query_param = 'cursor'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None, archive=None, horizon=None, shards=None):
+        """
+        Return the requested page. ``archive`` is a second queryset holding
+        only rows older than ``horizon``; it is read and merged in just when
+        the page could reach back that far.
+
+        When the data is sharded, each of ``shards`` (all by default) returns
+        its own candidate page in parallel and the pages are merged.
+        """
+        self.read_request(request)
+        return self.set_page(self.merge(*sharding.fan_out(lambda: self.get_rows(queryset, archive, horizon), shards)))
+
+    async def apaginate_queryset(self, queryset, request, view=None, archive=None, horizon=None):
+        self.read_request(request)
+        rows = [row async for row in self.get_page_queryset(queryset)]
+        if archive is not None and self.reaches_archive(rows, horizon):
+            rows = self.merge(rows, [row async for row in self.get_page_queryset(archive)])
+        return self.set_page(rows)
+
+    def read_request(self, request):
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        self.page_size = self.get_page_size(request)
+        self.cursor = self.decode_cursor(request)
+        self.reverse = self.cursor is not None and self.cursor.reverse
+
+    def get_rows(self, queryset, archive=None, horizon=None):
+        rows = list(self.get_page_queryset(queryset))
+        if archive is not None and self.reaches_archive(rows, horizon):
+            rows = self.merge(rows, list(self.get_page_queryset(archive)))
+        return rows
+
+    def get_page_queryset(self, queryset):
+        """Narrow the queryset to the rows of the requested page, plus one to detect a further page."""
+        if self.cursor is not None:
+            queryset = queryset.filter(self.get_boundary(self.cursor))
+        ordering = ('timestamp', 'id') if self.reverse else ('-timestamp', '-id')
+        return queryset.order_by(*ordering)[:self.page_size + 1]
+
+    def reaches_archive(self, rows, horizon):
+        if self.reverse:
+            return self.cursor.timestamp < horizon
+        # A full page ending at or after the horizon sorts ahead of every archived row
+        return len(rows) <= self.page_size or self.get_key(rows[-1])[0] < horizon
+
+    def merge(self, *pages):
+        if len(pages) == 1:
+            return pages[0]
+        rows = sorted(chain.from_iterable(pages), key=self.get_key, reverse=not self.reverse)
+        return rows[:self.page_size + 1]
+
+    def set_page(self, rows):
+        has_more = len(rows) > self.page_size
+        self.page = rows[:self.page_size]
+        if self.reverse:
+            self.page.reverse()
+            self.has_next, self.has_previous = True, has_more
+        else:
+            self.has_next, self.has_previous = has_more, self.cursor is not None
+        return self.page
+
+    def get_boundary(self, cursor):
+        # The redundant outer bound lets the database seek straight to the
+        # timestamp in the index instead of evaluating the OR row by row.
+        if cursor.reverse:
+            return Q(timestamp__gte=cursor.timestamp) & (Q(timestamp__gt=cursor.timestamp) | Q(id__gt=cursor.id))
+        return Q(timestamp__lte=cursor.timestamp) & (Q(timestamp__lt=cursor.timestamp) | Q(id__lt=cursor.id))
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if page_size <= 0:
+            return self.page_size
+        return min(page_size, self.max_page_size)
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.encode_cursor(Cursor(False, *self.get_key(self.page[-1])))
+
+    def get_previous_link(self):
+        if not self.has_previous or not self.page:
+            return None
+        return self.encode_cursor(Cursor(True, *self.get_key(self.page[0])))
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data),
+        ]))
+
+    def get_key(self, row):
+        if isinstance(row, Mapping):
+            return row['timestamp'], row['id']
+        return row.timestamp, row.id
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+
+        try:
+            querystring = b64decode(encoded.encode('ascii')).decode('ascii')
+            tokens = parse.parse_qs(querystring, keep_blank_values=True)
+            timestamp = parse_datetime(tokens['t'][0])
+            cursor = Cursor(reverse=bool(int(tokens['r'][0])), timestamp=timestamp, id=int(tokens['i'][0]))
+        except (TypeError, ValueError, KeyError, UnicodeError):
+            raise NotFound(self.invalid_cursor_message)
+        if timestamp is None:
+            raise NotFound(self.invalid_cursor_message)
+        return cursor
+
+    def encode_cursor(self, cursor):
+        tokens = {'r': int(cursor.reverse), 't': cursor.timestamp.isoformat(), 'i': cursor.id}
+        querystring = parse.urlencode(tokens, doseq=True)
+        encoded = b64encode(querystring.encode('ascii')).decode('ascii')
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded)
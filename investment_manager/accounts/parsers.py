@@ -0,0 +1,43 @@
+import json
+
+from django.conf import settings
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser, JSONParser
+
+
+class NDJSONParser(BaseParser):
+    """
+    Parses newline-delimited JSON into a list, one item per non-blank line.
+    """
+    media_type = 'application/x-ndjson'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        parser_context = parser_context or {}
+        encoding = parser_context.get('encoding', settings.DEFAULT_CHARSET)
+
+        rows = []
+        for number, line in enumerate(stream, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                rows.append(json.loads(line.decode(encoding)))
+            except ValueError as exc:
+                raise ParseError(f'NDJSON parse error on line {number} - {exc}')
+        return rows
+
+
+class ColumnarParser(JSONParser):
+    """
+    Parses a JSON object of equal-length field lists, the layout
+    ColumnarRenderer sends, into a list with one dict per row.
+    """
+    media_type = 'application/vnd.accounts.columns+json'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        columns = super().parse(stream, media_type, parser_context)
+        if not isinstance(columns, dict) or not all(isinstance(values, list) for values in columns.values()):
+            raise ParseError('Expected an object mapping each field to a list of values.')
+        if len({len(values) for values in columns.values()}) > 1:
+            raise ParseError('Every field must have the same number of values.')
+        return [dict(zip(columns, values)) for values in zip(*columns.values())]
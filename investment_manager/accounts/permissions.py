@@ -1,24 +1,147 @@
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, transaction
 from rest_framework import permissions
-from .models import AccountPermission, InvestmentAccount, Transaction
+from . import ledger, sharding
+from .models import AccountPermission, ArchivedTransaction, InvestmentAccount, Transaction
 
 # Define permission constants
 VIEW_PERMISSION = 'view'
 CRUD_PERMISSION = 'crud'
 POST_PERMISSION = 'post'
 
+def permission_cache_key(user_id):
+    return f'accounts:permissions:{user_id}'
+
+def get_account_permissions(request):
+    """
+    Map of account id to permission level for the requesting user.
+
+    Loaded at most once per request and shared across requests through the
+    Django cache; AccountPermission signals drop the entry on any change.
+    """
+    request = getattr(request, '_request', request)
+    if not hasattr(request, '_account_permissions'):
+        request._account_permissions = load_account_permissions(request.user)
+    return request._account_permissions
+
+def load_account_permissions(user):
+    if not user.is_authenticated:
+        return {}
+
+    key = permission_cache_key(user.pk)
+    account_permissions = cache.get(key)
+    if account_permissions is None:
+        account_permissions = {
+            account_id: permission
+            for grants in sharding.fan_out(lambda: list(grants_for(user)))
+            for account_id, permission in grants
+        }
+        cache.set(key, account_permissions, getattr(settings, 'ACCOUNTS_PERMISSION_CACHE_TIMEOUT', 300))
+    return account_permissions
+
+async def aload_account_permissions(user):
+    if not user.is_authenticated:
+        return {}
+
+    key = permission_cache_key(user.pk)
+    account_permissions = await cache.aget(key)
+    if account_permissions is None:
+        account_permissions = {account_id: permission async for account_id, permission in grants_for(user)}
+        await cache.aset(key, account_permissions, getattr(settings, 'ACCOUNTS_PERMISSION_CACHE_TIMEOUT', 300))
+    return account_permissions
+
+def grants_for(user):
+    # Always read from the primary (or the pinned shard): the map is cached,
+    # and one loaded from a lagging replica would outlive the invalidation
+    # that should replace it.
+    return AccountPermission.objects.using(sharding.current_shard() or DEFAULT_DB_ALIAS).filter(user=user).values_list('account_id', 'permission')
+
+def invalidate_account_permissions(user_ids):
+    cache.delete_many([permission_cache_key(user_id) for user_id in user_ids])
+
+def apply_permission_changes(changes, batch_size=500):
+    """
+    Apply many grants and revocations at once and return what changed.
+
+    ``changes`` maps (user_id, account_id) to a permission level, or to None
+    to revoke. Existing grants are read in batches, new and changed ones
+    written with one upsert on the (user, account) unique constraint and
+    revoked ones deleted by id, all in one transaction per shard, held open
+    until every shard is done. Permission caches and account versions are
+    updated once for the whole batch rather than per row.
+
+    Returns ``created``, ``updated`` and ``revoked`` lists of changed grants
+    and the number of ``unchanged`` pairs.
+    """
+    diff = {'created': [], 'updated': [], 'revoked': [], 'unchanged': 0}
+    with ExitStack() as stack:
+        for alias, pairs in sharding.group_by_shard(changes, key=lambda pair: pair[1]).items():
+            stack.enter_context(transaction.atomic(using=alias))
+            existing = existing_grants(alias, set(pairs), batch_size)
+            upserts, deletes, changed = [], [], []
+            for user_id, account_id in sorted(pairs):
+                permission = changes[user_id, account_id]
+                grant_id, previous = existing.get((user_id, account_id), (None, None))
+                if permission == previous:
+                    diff['unchanged'] += 1
+                    continue
+                changed.append((user_id, account_id))
+                if permission is None:
+                    deletes.append(grant_id)
+                    diff['revoked'].append({'user': user_id, 'account': account_id, 'previous': previous})
+                    continue
+                upserts.append(AccountPermission(user_id=user_id, account_id=account_id, permission=permission))
+                if previous is None:
+                    diff['created'].append({'user': user_id, 'account': account_id, 'permission': permission})
+                else:
+                    diff['updated'].append({'user': user_id, 'account': account_id, 'permission': permission, 'previous': previous})
+
+            AccountPermission.objects.using(alias).bulk_create(
+                upserts, batch_size=batch_size,
+                update_conflicts=True, unique_fields=['user', 'account'], update_fields=['permission'],
+            )
+            sharding.delete_ids(AccountPermission, deletes, using=alias, batch_size=batch_size)
+
+            # Bulk writes skip the AccountPermission signals, so do their work once here
+            account_ids = sorted({account_id for _, account_id in changed})
+            for start in range(0, len(account_ids), batch_size):
+                ledger.touch(account_ids[start:start + batch_size], using=alias)
+            user_ids = {user_id for user_id, _ in changed}
+            invalidate_account_permissions(user_ids)
+            transaction.on_commit(lambda user_ids=user_ids: invalidate_account_permissions(user_ids), using=alias)
+
+    for key in ('created', 'updated', 'revoked'):
+        diff[key].sort(key=lambda grant: (grant['user'], grant['account']))
+    return diff
+
+def existing_grants(alias, pairs, batch_size):
+    """``{(user_id, account_id): (grant_id, permission)}`` for those of ``pairs`` granted on ``alias``."""
+    user_ids = sorted({user_id for user_id, _ in pairs})
+    account_ids = sorted({account_id for _, account_id in pairs})
+    grants = {}
+    for start in range(0, len(account_ids), batch_size):
+        for end in range(0, len(user_ids), batch_size):
+            rows = AccountPermission.objects.using(alias).filter(
+                account_id__in=account_ids[start:start + batch_size], user_id__in=user_ids[end:end + batch_size],
+            ).values_list('id', 'user_id', 'account_id', 'permission')
+            grants.update({(user_id, account_id): (grant_id, permission) for grant_id, user_id, account_id, permission in rows})
+    return {pair: grant for pair, grant in grants.items() if pair in pairs}
+
 class HasAccountPermission(permissions.BasePermission):
     def has_object_permission(self, request, view, obj):
         """
         Check if the user has permission to access the object based on AccountPermission.
         """
-        account = obj.account if isinstance(obj, Transaction) else obj
-        
-        try:
-            account_permission = AccountPermission.objects.get(user=request.user, account=account)
-        except AccountPermission.DoesNotExist:
+        account_id = obj.account_id if isinstance(obj, (Transaction, ArchivedTransaction)) else obj.pk
+
+        permission = get_account_permissions(request).get(account_id)
+        if permission is None:
             return False
 
-        return self.check_permission(account_permission.permission, request.method)
+        return self.check_permission(permission, request.method)
 
     def check_permission(self, permission, method):
         permission_map = {
@@ -0,0 +1,100 @@
+import csv
+import io
+import json
+
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+
+class StreamingRenderer(BaseRenderer):
+    """
+    Renderer that can also emit a report one row at a time.
+
+    ``render`` handles ordinary responses such as validation errors, while
+    ``stream`` turns an iterable of row dicts into an iterable of encoded
+    chunks, finishing with a trailer row, for use with StreamingHttpResponse.
+    """
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        rows = data if isinstance(data, list) else [data]
+        return b''.join(self.stream(rows))
+
+    def stream(self, rows, trailer=None):
+        raise NotImplementedError('.stream() must be implemented.')
+
+
+class NDJSONRenderer(StreamingRenderer):
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+
+    def stream(self, rows, trailer=None):
+        for row in rows:
+            yield self.encode(row)
+        if trailer is not None:
+            yield self.encode(trailer)
+
+    def encode(self, row):
+        return (json.dumps(row, cls=JSONEncoder, separators=(',', ':')) + '\n').encode(self.charset)
+
+
+class CSVRenderer(StreamingRenderer):
+    media_type = 'text/csv'
+    format = 'csv'
+
+    def stream(self, rows, trailer=None):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        header = None
+        for row in rows:
+            row = self.flatten(row)
+            if header is None:
+                header = list(row)
+                writer.writerow(header)
+            writer.writerow([row.get(column, '') for column in header])
+            yield self.drain(buffer)
+        if trailer is not None:
+            for item in trailer.items():
+                writer.writerow(item)
+            yield self.drain(buffer)
+
+    def flatten(self, row, prefix=''):
+        flat = {}
+        for key, value in row.items():
+            if isinstance(value, dict):
+                flat.update(self.flatten(value, prefix=f'{prefix}{key}.'))
+            else:
+                flat[f'{prefix}{key}'] = value
+        return flat
+
+    def drain(self, buffer):
+        value = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return value.encode(self.charset)
+
+
+class ColumnarRenderer(JSONRenderer):
+    """
+    Compact JSON with list responses laid out by column.
+
+    Views that offer it hand over one list per field instead of one object
+    per row (see ``TransactionRowSerializer.serialize_columns``), so keys and
+    repeated users are sent once per page rather than once per row. Anything
+    else, errors included, renders as plain JSON.
+    """
+    media_type = 'application/vnd.accounts.columns+json'
+    format = 'columns'
+
+
+class PrometheusRenderer(BaseRenderer):
+    media_type = 'text/plain'
+    format = 'prometheus'
+    charset = 'utf-8'
+    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        # Errors such as a 403 arrive as dicts; show them as comments
+        if isinstance(data, dict):
+            data = ''.join(f'# {key}: {value}\n' for key, value in data.items())
+        return data.encode(self.charset)
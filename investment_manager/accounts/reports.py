@@ -0,0 +1,222 @@
+"""
+The admin transaction reports.
+
+``AdminTransactionViewSet`` serves these inside a request; ``jobs.py`` runs
+the same code in a background worker for reports too large to wait for.
+Both take plain parameter mappings (query parameters or a job's stored
+params), so a report reads the same whichever way it is requested.
+"""
+import heapq
+from decimal import Decimal
+from itertools import chain
+
+from django.db import models
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from rest_framework.renderers import JSONRenderer
+from rest_framework.serializers import ValidationError
+
+from . import archive, sharding
+from .models import AccountUserBalance, ArchivedTransaction, Transaction
+from .renderers import CSVRenderer, NDJSONRenderer
+from .row_serializers import TransactionRowSerializer
+from .serializers import BatchReportSerializer
+
+# Rows fetched per round trip while an export streams
+EXPORT_CHUNK_SIZE = 2000
+
+# Transactions a single batch report may return inline
+BATCH_MAX_ROWS = 100000
+
+# Formats an export job may be written in
+EXPORT_RENDERERS = {renderer.format: renderer for renderer in (NDJSONRenderer, CSVRenderer)}
+
+
+def report_queryset(params, model=Transaction):
+    """
+    Build the admin report queryset from its query parameters.
+
+    Returns the queryset, the date filters applied (``start_date`` and
+    ``end_date`` as aware datetimes; naive ones are taken in the current
+    time zone), and an error message if a date could not be parsed.
+    """
+    transactions = sharding.select_user(model.objects.filter(user_id=params.get('user_id')))
+    dates = {}
+
+    for param, lookup, label in (('start_date', 'timestamp__gte', 'start'), ('end_date', 'timestamp__lte', 'end')):
+        value = params.get(param)
+        if not value:
+            continue
+        value = parse_datetime(value)
+        if value is None:
+            return transactions, dates, f'Invalid {label} date format.'
+        if timezone.is_naive(value):
+            value = timezone.make_aware(value)
+        transactions = transactions.filter(**{lookup: value})
+        dates[param] = value
+
+    return transactions, dates, None
+
+
+def archived_report_queryset(params, dates, horizon):
+    """The archived part of the admin report, or None if its date range starts after the horizon."""
+    if not archive.reaches_archive(horizon, dates.get('start_date')):
+        return None
+    return report_queryset(params, ArchivedTransaction)[0]
+
+
+def export(transactions, archived, renderer, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Encode every matching row with a StreamingRenderer, oldest first, as an
+    iterator of byte chunks read through a server-side cursor.
+
+    The total is accumulated while streaming and written as a trailer row,
+    so memory use stays flat whatever the size of the date range.
+    """
+    row_serializer = TransactionRowSerializer()
+    querysets = sharding.split(transactions) + (sharding.split(archived) if archived is not None else [])
+    rows = [export_rows(row_serializer, queryset, chunk_size) for queryset in querysets]
+    rows = rows[0] if len(rows) == 1 else heapq.merge(*rows, key=lambda row: (row.timestamp, row.id))
+    trailer = {}
+
+    def serialized_rows():
+        total = Decimal('0.00')
+        for row in rows:
+            total += row.amount
+            yield row_serializer.to_representation(row)
+        trailer['total_balance'] = str(total)
+
+    # The renderer reads the trailer only after the last row has gone out,
+    # by which point the running total is complete.
+    return renderer.stream(serialized_rows(), trailer=trailer)
+
+
+def export_rows(row_serializer, transactions, chunk_size):
+    # Rows are read while the response streams, after the view has
+    # returned, so fix the database now rather than at iteration time.
+    rows = row_serializer.select(transactions.using(transactions.db)).order_by('timestamp', 'id')
+    return rows.iterator(chunk_size=chunk_size)
+
+
+def batch_report(params, max_rows=BATCH_MAX_ROWS):
+    """
+    Report on many users and/or accounts at once, grouped by user.
+
+    ``params`` is BatchReportSerializer's validated data. Returns the report
+    and an error message if it would cover more than ``max_rows``
+    transactions. Totals come from one grouped query (the ledger's per-user
+    balances when no date range is given) and the transactions from one row
+    fetch, each repeated against the archive only if the range reaches into it.
+    """
+    filters = {}
+    if params.get('user_ids'):
+        filters['user_id__in'] = params['user_ids']
+    if params.get('account_ids'):
+        filters['account_id__in'] = params['account_ids']
+    dated = 'start_date' in params or 'end_date' in params
+    if 'start_date' in params:
+        filters['timestamp__gte'] = params['start_date']
+    if 'end_date' in params:
+        filters['timestamp__lte'] = params['end_date']
+
+    models_read = [Transaction]
+    if archive.reaches_archive(archive.get_horizon(), params.get('start_date')):
+        models_read.append(ArchivedTransaction)
+
+    row_serializer = TransactionRowSerializer()
+    totals = batch_totals(filters, dated, models_read)
+    if row_serializer.users is not None:
+        row_serializer.users.load(total['user_id'] for total in totals)
+
+    users = {}
+    for total in totals:
+        user = users.get(total['user_id'])
+        if user is None:
+            user = users[total['user_id']] = {
+                'user': row_serializer.users[total['user_id']] if row_serializer.users is not None else
+                {'id': total['user_id'], 'username': total['user__username'], 'email': total['user__email']},
+                'total_balance': Decimal('0'), 'transaction_count': 0, 'accounts': {}, 'transactions': [],
+            }
+        account = user['accounts'].setdefault(total['account_id'], {'account': total['account_id'], 'total_balance': Decimal('0'), 'transaction_count': 0})
+        for entry in (user, account):
+            entry['total_balance'] += total['total']
+            entry['transaction_count'] += total['count']
+
+    row_count = sum(user['transaction_count'] for user in users.values())
+    if max_rows is not None and row_count > max_rows:
+        return None, f'The report covers {row_count} transactions; narrow it to at most {max_rows}.'
+
+    fetches = [
+        row_serializer.select(queryset).order_by('user_id', '-timestamp', '-id')
+        for model in models_read
+        for queryset in sharding.split(model.objects.filter(**filters))
+    ]
+    for row in heapq.merge(*fetches, key=lambda row: (row.user_id, -row.timestamp.timestamp(), -row.id)):
+        users[row.user_id]['transactions'].append(row_serializer.to_representation(row))
+
+    results = []
+    for user_id in sorted(users):
+        user = users[user_id]
+        user['accounts'] = [user['accounts'][account_id] for account_id in sorted(user['accounts'])]
+        results.append(user)
+    return {
+        'total_balance': sum((user['total_balance'] for user in results), Decimal('0')),
+        'transaction_count': row_count,
+        'users': results,
+    }, None
+
+
+def batch_totals(filters, dated, models_read):
+    """
+    Per (user, account) totals, with the user's name and email for the
+    response unless sharded. An account lives on one shard, so each
+    shard's totals are complete for its accounts.
+    """
+    columns = ('user_id', 'account_id') if sharding.is_sharded() else ('user_id', 'user__username', 'user__email', 'account_id')
+    if not dated:
+        querysets = [
+            AccountUserBalance.objects.filter(**filters).exclude(transaction_count=0)
+            .values(*columns, total=models.F('balance'), count=models.F('transaction_count'))
+        ]
+    else:
+        querysets = [
+            model.objects.filter(**filters).values(*columns).annotate(total=models.Sum('amount'), count=models.Count('id')).order_by()
+            for model in models_read
+        ]
+    return list(chain.from_iterable(sharding.fan_out(lambda: [total for queryset in querysets for total in queryset.all()])))
+
+
+def validate_job_params(kind, params):
+    """Check a job's params before it is queued, raising ValidationError."""
+    if not isinstance(params, dict):
+        raise ValidationError({'params': ['Expected an object.']})
+    if kind == 'export':
+        if params.get('format', 'ndjson') not in EXPORT_RENDERERS:
+            raise ValidationError({'params': [f'format must be one of {", ".join(EXPORT_RENDERERS)}.']})
+        error = report_queryset(params)[2]
+        if error:
+            raise ValidationError({'params': [error]})
+    elif kind == 'batch-report':
+        serializer = BatchReportSerializer(data=params)
+        if not serializer.is_valid():
+            raise ValidationError({'params': serializer.errors})
+
+
+def run_export_job(params, output):
+    """Write the admin export for ``params`` to ``output``, as the export endpoint would stream it."""
+    renderer = EXPORT_RENDERERS[params.get('format', 'ndjson')]()
+    transactions, dates, error = report_queryset(params)
+    if error:
+        raise ValueError(error)
+    for chunk in export(transactions, archived_report_queryset(params, dates, archive.get_horizon()), renderer):
+        output.write(chunk)
+    return f'{renderer.media_type}; charset={renderer.charset}', renderer.format
+
+
+def run_batch_report_job(params, output):
+    """Write the batch report for ``params`` to ``output`` as JSON, without the inline row limit."""
+    serializer = BatchReportSerializer(data=params)
+    serializer.is_valid(raise_exception=True)
+    data, _ = batch_report(serializer.validated_data, max_rows=None)
+    output.write(JSONRenderer().render(data))
+    return 'application/json', 'json'
@@ -1,7 +1,13 @@
 from rest_framework import serializers
-from .models import InvestmentAccount, AccountPermission, Transaction
+from rest_framework.reverse import reverse
+from .models import InvestmentAccount, AccountPermission, AccountBalance, ReportJob, Transaction, TransactionEvent, TransactionRollup
 from django.contrib.auth.models import User
 
+def money_field(model, name, **kwargs):
+    """A DecimalField with the precision of a model's MoneyField."""
+    field = model._meta.get_field(name)
+    return serializers.DecimalField(max_digits=field.max_digits, decimal_places=field.decimal_places, **kwargs)
+
 class UserSerializer(serializers.ModelSerializer):
     class Meta:
         model = User
@@ -16,14 +22,125 @@ class AccountPermissionSerializer(serializers.ModelSerializer):
 
 class InvestmentAccountSerializer(serializers.ModelSerializer):
     permissions = AccountPermissionSerializer(source='accountpermission_set', many=True, read_only=True)
+    balance = money_field(AccountBalance, 'balance', source='ledger.balance', read_only=True)
 
     class Meta:
         model = InvestmentAccount
-        fields = ['id', 'name', 'permissions']
+        fields = ['id', 'name', 'permissions', 'balance']
 
 class TransactionSerializer(serializers.ModelSerializer):
     user = UserSerializer(read_only=True)
+    amount = money_field(Transaction, 'amount')
 
     class Meta:
         model = Transaction
         fields = ['id', 'account', 'user', 'amount', 'timestamp']
+        read_only_fields = ['timestamp']
+
+class TransactionEventSerializer(serializers.ModelSerializer):
+    """
+    One change feed event: the new transaction as TransactionSerializer shows
+    it, but with the user as a bare id, since users are not kept with the log.
+    """
+    id = serializers.IntegerField(source='transaction_id')
+    amount = money_field(TransactionEvent, 'amount')
+
+    class Meta:
+        model = TransactionEvent
+        fields = ['id', 'account', 'user', 'amount', 'timestamp']
+
+class TransactionIngestSerializer(serializers.Serializer):
+    """
+    Validates one row of a bulk upload.
+
+    The account is taken as a bare id so a whole batch can be checked against
+    a single permission query instead of one lookup per row.
+    """
+    account = serializers.IntegerField(min_value=1)
+    amount = money_field(Transaction, 'amount')
+
+class RollupBucketSerializer(serializers.Serializer):
+    bucket = serializers.DateField()
+    total = money_field(TransactionRollup, 'total', source='bucket_total')
+    transaction_count = serializers.IntegerField(source='bucket_count')
+
+class BalanceAsOfSerializer(serializers.Serializer):
+    account = serializers.IntegerField()
+    as_of = serializers.DateTimeField()
+    balance = money_field(AccountBalance, 'balance')
+    transaction_count = serializers.IntegerField()
+
+class BatchReportSerializer(serializers.Serializer):
+    """
+    Filters for the multi-user admin report.
+
+    Lists may be sent as repeated query parameters (``?user_ids=1&user_ids=2``)
+    or, when they run to thousands of ids, as a JSON body.
+    """
+    user_ids = serializers.ListField(child=serializers.IntegerField(min_value=1), required=False, max_length=10000)
+    account_ids = serializers.ListField(child=serializers.IntegerField(min_value=1), required=False, max_length=10000)
+    start_date = serializers.DateTimeField(required=False)
+    end_date = serializers.DateTimeField(required=False)
+
+    def validate(self, attrs):
+        if not attrs.get('user_ids') and not attrs.get('account_ids'):
+            raise serializers.ValidationError('Pass user_ids, account_ids or both.')
+        return attrs
+
+class PermissionBlockSerializer(serializers.Serializer):
+    """Every user in ``users`` on every account in ``accounts``."""
+    users = serializers.ListField(child=serializers.IntegerField(min_value=1), min_length=1, max_length=10000)
+    accounts = serializers.ListField(child=serializers.IntegerField(min_value=1), min_length=1, max_length=10000)
+
+class PermissionGrantSerializer(PermissionBlockSerializer):
+    permission = serializers.ChoiceField(choices=AccountPermission.PERMISSION_CHOICES)
+
+class BulkPermissionSerializer(serializers.Serializer):
+    """
+    A matrix of permission changes. Each ``grant`` block gives its users the
+    permission on its accounts, replacing any other level; each ``revoke``
+    block removes its users' grants on its accounts.
+
+    The validated data carries ``changes``: the permission, or None to revoke,
+    for each (user id, account id) pair.
+    """
+    max_changes = 100000
+
+    grant = PermissionGrantSerializer(many=True, required=False)
+    revoke = PermissionBlockSerializer(many=True, required=False)
+
+    def validate(self, attrs):
+        blocks = [(block, block['permission']) for block in attrs.get('grant', [])]
+        blocks += [(block, None) for block in attrs.get('revoke', [])]
+        if not blocks:
+            raise serializers.ValidationError('Pass grant, revoke or both.')
+        if sum(len(block['users']) * len(block['accounts']) for block, _ in blocks) > self.max_changes:
+            raise serializers.ValidationError(f'At most {self.max_changes} user and account pairs per request.')
+
+        changes = {}
+        for block, permission in blocks:
+            for user_id in block['users']:
+                for account_id in block['accounts']:
+                    if changes.setdefault((user_id, account_id), permission) != permission:
+                        raise serializers.ValidationError(f'Conflicting changes for user {user_id} on account {account_id}.')
+        attrs['changes'] = changes
+        return attrs
+
+class ReportJobSerializer(serializers.ModelSerializer):
+    """
+    A queued report or export. Clients send ``kind`` and ``params``, the same
+    parameters the admin report or batch report endpoint takes (plus
+    ``format`` for exports), and poll ``url`` until ``result`` is set.
+    """
+    url = serializers.HyperlinkedIdentityField(view_name='job-detail')
+    result = serializers.SerializerMethodField()
+
+    class Meta:
+        model = ReportJob
+        fields = ['id', 'url', 'kind', 'params', 'status', 'attempts', 'error', 'created_at', 'started_at', 'finished_at', 'result']
+        read_only_fields = ['status', 'attempts', 'error', 'created_at', 'started_at', 'finished_at']
+
+    def get_result(self, job):
+        if job.status != 'succeeded':
+            return None
+        return reverse('job-result', args=[job.pk], request=self.context.get('request'))
@@ -0,0 +1,294 @@
+"""
+Horizontal sharding of the accounts data by account id.
+
+An account and every row that belongs to it (grants, transactions, the
+ledger and its checkpoints, the archive and the change feed's log) live on
+the database alias that ``shard_for`` picks from ``ACCOUNTS_SHARDS`` by
+hashing the account id. Users, sessions and the id sequences stay on
+``default``. With a single shard, the default, every helper here leaves
+queries to the usual routers.
+
+* Work on one account runs inside ``pinned(shard_for(account_id))``, so
+  ``ShardRouter`` sends its queries, signals and ledger updates included,
+  to that shard. ``ShardPinMixin`` does this for a whole API request.
+* Reads across accounts go through ``fan_out``. It calls a function once per
+  shard, pinned to that shard, on a thread pool, and returns the results in
+  shard order for the caller to merge.
+* New accounts and transactions take ids from ``ShardSequence`` on the
+  default database, reserved in blocks, so ids stay unique across shards.
+"""
+import threading
+import zlib
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, close_old_connections, connections, router, transaction
+from django.db.models import F, Max
+
+from .models import InvestmentAccount, ShardSequence
+
+# Models whose rows live on the shard of the account they belong to
+SHARDED_MODELS = frozenset({
+    'accounts.investmentaccount',
+    'accounts.accountpermission',
+    'accounts.transaction',
+    'accounts.accountbalance',
+    'accounts.accountuserbalance',
+    'accounts.transactionrollup',
+    'accounts.balancecheckpoint',
+    'accounts.archivedtransaction',
+    'accounts.archivedperiod',
+    'accounts.transactionevent',
+})
+
+_pinned = ContextVar('accounts_shard', default=None)
+_worker = threading.local()
+_executor = None
+_executor_lock = threading.Lock()
+_blocks = {}
+_blocks_lock = threading.Lock()
+
+
+def get_shards():
+    return list(getattr(settings, 'ACCOUNTS_SHARDS', [DEFAULT_DB_ALIAS]))
+
+
+def is_sharded():
+    return len(get_shards()) > 1
+
+
+def is_sharded_model(model):
+    return model._meta.label_lower in SHARDED_MODELS
+
+
+def shard_for(account_id):
+    """The alias holding an account. crc32 rather than hash() so every process agrees."""
+    shards = get_shards()
+    return shards[zlib.crc32(str(int(account_id)).encode()) % len(shards)]
+
+
+def group_by_shard(items, key=int):
+    """Split account ids, or rows keyed by ``key``, into ``{alias: [item, ...]}``."""
+    groups = defaultdict(list)
+    for item in items:
+        groups[shard_for(key(item))].append(item)
+    return dict(groups)
+
+
+def current_shard():
+    return _pinned.get()
+
+
+@contextmanager
+def pinned(alias):
+    """Route every query on sharded models to ``alias`` inside the block."""
+    token = _pinned.set(alias)
+    try:
+        yield alias
+    finally:
+        _pinned.reset(token)
+
+
+def atomic():
+    """``transaction.atomic`` on the pinned shard, or on the default database."""
+    return transaction.atomic(using=current_shard())
+
+
+def fan_out(function, shards=None):
+    """
+    Call ``function()`` pinned to each shard (all of them by default) and
+    return the results in shard order.
+
+    Several shards are queried in parallel on a thread pool of
+    ``ACCOUNTS_SHARD_WORKERS`` threads. Unsharded, ``function`` runs once,
+    unpinned, so replica routing still applies.
+    """
+    if not is_sharded():
+        return [function()]
+    shards = get_shards() if shards is None else list(shards)
+    # A fan-out from inside a worker runs inline rather than queueing behind itself
+    if len(shards) <= 1 or getattr(_worker, 'active', False):
+        return [_call(alias, function) for alias in shards]
+    futures = [get_executor().submit(_call_in_worker, alias, function) for alias in shards]
+    return [future.result() for future in futures]
+
+
+def fan_out_accounts(function, account_ids):
+    """Call ``function(ids)`` once per shard holding any of ``account_ids``, with that shard's ids."""
+    if not is_sharded():
+        return [function(list(account_ids))]
+    groups = group_by_shard(account_ids)
+    return fan_out(lambda: function(groups[current_shard()]), groups)
+
+
+def shards_for(account_ids):
+    """The shards holding any of ``account_ids``."""
+    return list(group_by_shard(account_ids))
+
+
+def locate(function, shards=None):
+    """The first shard, in shard order, on which ``function()`` returns something true, or None."""
+    shards = get_shards() if shards is None else list(shards)
+    return next((alias for alias, found in zip(shards, fan_out(function, shards)) if found), None)
+
+
+def split(queryset, shards=None):
+    """One copy of ``queryset`` fixed to each shard, for callers that read them lazily."""
+    if not is_sharded():
+        return [queryset]
+    return [queryset.using(alias) for alias in (get_shards() if shards is None else shards)]
+
+
+def select_user(queryset):
+    # Users live on the default database, so a shard cannot join them in
+    return queryset if is_sharded() else queryset.select_related('user')
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            workers = getattr(settings, 'ACCOUNTS_SHARD_WORKERS', 8)
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='accounts-shard')
+        return _executor
+
+
+def _call(alias, function):
+    with pinned(alias):
+        return function()
+
+
+def _call_in_worker(alias, function):
+    _worker.active = True
+    try:
+        return _call(alias, function)
+    finally:
+        _worker.active = False
+        # Worker threads keep their own connections; recycle them as a request would
+        close_old_connections()
+
+
+def allocate_ids(model, count=1):
+    """
+    ``count`` ids for new rows of ``model``, unique across every shard.
+
+    Ids are reserved from the model's ShardSequence in blocks of
+    ``ACCOUNTS_SHARD_ID_BLOCK``, so most calls do not touch the database.
+    Ids left in a block when the process exits are never used.
+    """
+    label = model._meta.label_lower
+    with _blocks_lock:
+        next_id, end = _blocks.get(label, (0, 0))
+        if end - next_id < count:
+            next_id, end = _reserve(model, max(count, getattr(settings, 'ACCOUNTS_SHARD_ID_BLOCK', 1000)))
+        _blocks[label] = (next_id + count, end)
+    return list(range(next_id, next_id + count))
+
+
+def _reserve(model, size):
+    label = model._meta.label_lower
+    sequences = ShardSequence.objects.using(DEFAULT_DB_ALIAS).filter(name=label)
+    with transaction.atomic(using=DEFAULT_DB_ALIAS):
+        if not sequences.update(last_id=F('last_id') + size):
+            # First use: start above the rows written before sharding was turned on
+            highest = [value for value in fan_out(lambda: model.objects.aggregate(highest=Max('pk'))['highest']) if value]
+            ShardSequence.objects.using(DEFAULT_DB_ALIAS).get_or_create(name=label, defaults={'last_id': max(highest, default=0)})
+            sequences.update(last_id=F('last_id') + size)
+        last_id = sequences.values_list('last_id', flat=True).get()
+    return last_id - size + 1, last_id + 1
+
+
+def new_account_id():
+    """Reserve an id for a new account; write the account to ``shard_for`` that id."""
+    return allocate_ids(InvestmentAccount)[0]
+
+
+def delete_ids(model, ids, using=None, batch_size=1000):
+    """
+    Delete rows of ``model`` by primary key with plain ``DELETE ... WHERE id
+    IN (...)`` statements and return how many went.
+
+    Runs on ``using``, or where the routers send writes (the pinned shard for
+    sharded models). Unlike ``QuerySet.delete()`` this sends no delete
+    signals and follows no cascades, so callers keep anything derived from
+    the rows in step themselves.
+    """
+    using = using or router.db_for_write(model)
+    connection = connections[using]
+    table = connection.ops.quote_name(model._meta.db_table)
+    column = connection.ops.quote_name(model._meta.pk.column)
+    ids = list(ids)
+    deleted = 0
+    with connection.cursor() as cursor:
+        for start in range(0, len(ids), batch_size):
+            batch = ids[start:start + batch_size]
+            cursor.execute(f'DELETE FROM {table} WHERE {column} IN ({", ".join(["%s"] * len(batch))})', batch)
+            deleted += cursor.rowcount
+    return deleted
+
+
+class ShardRouter:
+    """
+    Send sharded models to the pinned shard, or to the shard of the instance
+    a query starts from; everything else goes to the default database.
+
+    Inactive with a single shard. Unpinned queries on sharded models go to
+    the default database, so code reading across accounts must use
+    ``fan_out``. Only the sharded tables are created on shards other than
+    ``default``.
+    """
+
+    def db_for_read(self, model, **hints):
+        return self.route(model, hints)
+
+    def db_for_write(self, model, **hints):
+        return self.route(model, hints)
+
+    def route(self, model, hints):
+        if not is_sharded():
+            return None
+        if not is_sharded_model(model):
+            return DEFAULT_DB_ALIAS
+        instance = hints.get('instance')
+        if instance is not None and is_sharded_model(instance):
+            # Related lookups stay with the row they start from, and a new
+            # row goes to its account's shard
+            if instance._state.db:
+                return instance._state.db
+            account_id = instance.pk if isinstance(instance, InvestmentAccount) else getattr(instance, 'account_id', None)
+            if account_id is not None:
+                return shard_for(account_id)
+        return current_shard() or DEFAULT_DB_ALIAS
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db == DEFAULT_DB_ALIAS or db not in get_shards():
+            return None
+        return model_name is not None and f'{app_label}.{model_name}' in SHARDED_MODELS
+
+
+class ShardPinMixin:
+    """
+    Pin a viewset's request to the shard returned by ``get_shard()``.
+
+    Requests that return None, lists for example, stay unpinned and read
+    across shards with ``fan_out``.
+    """
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        alias = self.get_shard() if is_sharded() else None
+        self.shard_token = _pinned.set(alias) if alias else None
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        token = getattr(self, 'shard_token', None)
+        if token is not None:
+            _pinned.reset(token)
+            self.shard_token = None
+        return response
+
+    def get_shard(self):
+        return None
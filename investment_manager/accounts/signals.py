@@ -0,0 +1,93 @@
+from functools import partial
+
+from django.contrib.auth.models import User
+from django.db import DEFAULT_DB_ALIAS, models, transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from . import events, ledger, sharding
+from .models import (
+    AccountBalance, AccountPermission, AccountUserBalance, ArchivedTransaction, InvestmentAccount, Transaction,
+    TransactionEvent, TransactionRollup,
+)
+from .permissions import invalidate_account_permissions
+
+# Sharded rows that belong to a user. Transactions go first, so their
+# removal is posted to the account balances while the rest still exist.
+USER_ROWS = (Transaction, ArchivedTransaction, TransactionEvent, AccountPermission, AccountUserBalance, TransactionRollup)
+
+
+@receiver(post_save, sender=InvestmentAccount)
+def open_account_balance(sender, instance, created, using, **kwargs):
+    if created:
+        AccountBalance.objects.using(using).get_or_create(account=instance)
+    else:
+        ledger.touch([instance.pk], using=using)
+
+
+@receiver(pre_save, sender=Transaction)
+def remember_previous_transaction(sender, instance, using, **kwargs):
+    instance._ledger_previous = None
+    if instance.pk is not None:
+        instance._ledger_previous = Transaction.objects.using(using).filter(pk=instance.pk).only('account_id', 'user_id', 'amount', 'timestamp').first()
+    elif sharding.is_sharded():
+        instance.pk = sharding.allocate_ids(Transaction)[0]
+
+
+@receiver(post_save, sender=Transaction)
+def post_transaction_to_ledger(sender, instance, created, using, **kwargs):
+    previous = getattr(instance, '_ledger_previous', None)
+    ledger.apply(added=[instance], removed=[previous] if previous is not None else [], using=using)
+    if created:
+        events.record([instance], using=using)
+
+
+@receiver(post_delete, sender=Transaction)
+@receiver(post_delete, sender=ArchivedTransaction)
+def remove_transaction_from_ledger(sender, instance, using, origin=None, **kwargs):
+    # Deleting the account takes its whole ledger with it. Deleting a user
+    # still moves the balances of the accounts it posted to; its own summary
+    # rows go in the same cascade, and apply() does not bring them back.
+    # Archived rows are still counted, so their removal is posted too.
+    if deleted_with(origin, InvestmentAccount):
+        return
+    ledger.apply(removed=[instance], using=using)
+
+
+@receiver(post_delete, sender=User)
+def delete_user_rows_on_shards(sender, instance, using, **kwargs):
+    """
+    Users live on the default database, so deleting one cascades there only.
+    Once that commits, delete the user's rows on every other shard as well.
+    """
+    if not sharding.is_sharded():
+        return
+    shards = [alias for alias in sharding.get_shards() if alias != DEFAULT_DB_ALIAS]
+    # Bound now: the collector clears instance.pk before the commit
+    delete = partial(delete_user_rows, instance.pk)
+    transaction.on_commit(lambda: sharding.fan_out(delete, shards), using=using)
+
+
+def delete_user_rows(user_id):
+    """Delete a user's rows on the pinned shard, one transaction for them all."""
+    with sharding.atomic():
+        for model in USER_ROWS:
+            model.objects.filter(user_id=user_id).delete()
+
+
+def deleted_with(origin, model):
+    """Whether a delete started from a ``model`` instance or queryset."""
+    if isinstance(origin, models.QuerySet):
+        return origin.model is model
+    return isinstance(origin, model)
+
+
+@receiver(post_save, sender=AccountPermission)
+@receiver(post_delete, sender=AccountPermission)
+def drop_cached_permissions(sender, instance, using, **kwargs):
+    # Drop again on commit so a request that re-cached the old grants while
+    # this transaction was open does not keep them.
+    invalidate_account_permissions([instance.user_id])
+    transaction.on_commit(lambda: invalidate_account_permissions([instance.user_id]), using=using)
+    # Grants are part of the account payload
+    ledger.touch([instance.account_id], using=using)
@@ -1,11 +1,49 @@
+import base64
+import csv
+import io
+import json
+import os
+import re
+import tempfile
+import time
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+from unittest import mock, skipUnless
+
+from concurrent.futures import Executor, Future
+
+from asgiref.sync import sync_to_async
 from rest_framework import status
-from rest_framework.test import APITestCase
+from rest_framework.test import APITestCase, APITransactionTestCase
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.conf import settings
+from django.db import IntegrityError, connection, connections, models, transaction
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import include, path
 from django.utils import timezone
-from .models import InvestmentAccount, Transaction, AccountPermission
+from . import archive, events, jobs, ledger, metrics, reports, sharding
+from .models import InvestmentAccount, Transaction, AccountPermission, AccountBalance, AccountUserBalance, ArchivedPeriod, ArchivedTransaction, BalanceCheckpoint, ReportJob, ShardSequence, TransactionEvent, TransactionRollup
+from .db_routers import PIN_HEADER, PRIMARY_COOKIE, ReplicaRouter
+from .sharding import ShardRouter
+from .pagination import KeysetPagination
+from .permissions import permission_cache_key
+from .row_serializers import InvestmentAccountRowSerializer, TransactionRowSerializer
+from .serializers import InvestmentAccountSerializer, TransactionSerializer
+from .urls import async_urlpatterns, sync_urlpatterns
+from .views import AdminTransactionViewSet
 
+# Replicas and shards are separate connections that cannot see a TestCase's
+# uncommitted rows, so tests use the default database alone;
+# ReplicaDatabaseTests and ShardedApiTests cover the other aliases.
+@override_settings(ACCOUNTS_DATABASE_REPLICAS=[], ACCOUNTS_SHARDS=['default'])
 class BaseTestCase(APITestCase):
     def setUp(self):
+        # Cached permission maps are keyed by user id, which the database reuses between tests
+        cache.clear()
+
         # Create a default user and account for base tests
         self.user = User.objects.create_user(username='testuser', password='password')
         self.account = InvestmentAccount.objects.create(name='Test Account')
@@ -144,3 +182,1657 @@ class InvestmentAccountTestCase(BaseTestCase):
     def test_transaction_creation(self):
         """Test creating a transaction."""
         self.assertEqual(self.transaction.amount, 100.00)
+
+class AccountBalanceLedgerTests(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.authenticate_user('testuser', 'password')
+
+    def test_create_update_delete_keep_balance_in_step(self):
+        response = self.client.post('/api/transactions/', {'account': self.account.id, 'amount': 50})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(ledger.account_balance(self.account.id), Decimal('150.00'))
+
+        self.client.patch(f'/api/transactions/{response.data["id"]}/', {'amount': 20})
+        self.assertEqual(ledger.account_balance(self.account.id), Decimal('120.00'))
+
+        self.client.delete(f'/api/transactions/{self.transaction.id}/')
+        self.assertEqual(ledger.account_balance(self.account.id), Decimal('20.00'))
+        self.assertEqual(AccountBalance.objects.get(account=self.account).transaction_count, 1)
+        self.assertEqual(ledger.user_balance(self.user.id), Decimal('20.00'))
+
+    def test_accounts_and_users_with_transactions_can_be_deleted(self):
+        other = User.objects.create_user(username='other', password='password')
+        AccountPermission.objects.create(user=other, account=self.account, permission='crud')
+        Transaction.objects.create(account=self.account, user=other, amount=Decimal('30.00'), timestamp=timezone.now() - timezone.timedelta(days=60))
+        ledger.checkpoint()
+
+        other.delete()
+        self.assertEqual(ledger.account_balance(self.account.id), Decimal('100.00'))
+        self.assertEqual(AccountBalance.objects.get(account=self.account).transaction_count, 1)
+        self.assertFalse(AccountUserBalance.objects.filter(user_id=other.id).exists())
+        self.assertFalse(TransactionRollup.objects.filter(user_id=other.id).exists())
+        self.assertFalse(BalanceCheckpoint.objects.filter(account=self.account).exclude(balance=0).exists())
+
+        response = self.client.delete(f'/api/accounts/{self.account.id}/')
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertFalse(Transaction.objects.exists())
+        for model in (AccountBalance, AccountUserBalance, TransactionRollup, BalanceCheckpoint):
+            self.assertFalse(model.objects.exists(), model)
+
+    def test_account_serializer_exposes_balance(self):
+        response = self.client.get(f'/api/accounts/{self.account.id}/')
+        self.assertEqual(response.data['balance'], '100.00')
+
+    def test_account_without_transactions_has_zero_balance(self):
+        account = InvestmentAccount.objects.create(name='Empty Account')
+        AccountPermission.objects.create(user=self.user, account=account, permission='view')
+        response = self.client.get(f'/api/accounts/{account.id}/')
+        self.assertEqual(response.data['balance'], '0.00')
+
+    def test_admin_total_uses_ledger_without_date_filter(self):
+        User.objects.create_superuser(username='admin', password='password')
+        self.authenticate_user('admin', 'password')
+        response = self.client.get('/api/admin-transactions/', {'user_id': self.user.id})
+        self.assertEqual(response.data['total_balance'], Decimal('100.00'))
+
+    def test_rebuild_matches_transaction_history(self):
+        Transaction.objects.create(account=self.account, user=self.user, amount=Decimal('25.50'))
+        AccountBalance.objects.all().delete()
+        AccountUserBalance.objects.all().delete()
+        ledger.rebuild([self.account.id])
+        self.assertEqual(ledger.account_balance(self.account.id), Decimal('125.50'))
+        self.assertEqual(AccountUserBalance.objects.get(account=self.account, user=self.user).transaction_count, 2)
+
+class MinorUnitAmountTests(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.authenticate_user('testuser', 'password')
+
+    def raw_value(self, table, column, key, pk):
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT {column} FROM {table} WHERE {key} = %s', [pk])
+            return cursor.fetchone()[0]
+
+    def test_amounts_are_stored_as_integer_cents(self):
+        self.assertEqual(self.raw_value('accounts_transaction', 'amount', 'id', self.transaction.id), 10000)
+        self.assertEqual(self.raw_value('accounts_accountbalance', 'balance', 'account_id', self.account.id), 10000)
+        self.assertEqual(Transaction.objects.get(pk=self.transaction.pk).amount, Decimal('100.00'))
+
+    def test_api_accepts_and_returns_decimal_strings(self):
+        for amount in ['0.10', '-12.34', '123456789012.34']:
+            response = self.client.post('/api/transactions/', {'account': self.account.id, 'amount': amount})
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            self.assertEqual(response.data['amount'], amount)
+            self.assertEqual(self.client.get(f'/api/transactions/{response.data["id"]}/').data['amount'], amount)
+        listed = [row['amount'] for row in self.client.get('/api/transactions/').data['results']]
+        self.assertCountEqual(listed, ['100.00', '0.10', '-12.34', '123456789012.34'])
+
+    def test_sub_cent_amounts_are_rejected(self):
+        response = self.client.post('/api/transactions/', {'account': self.account.id, 'amount': '1.005'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_dated_admin_total_is_exact(self):
+        for _ in range(3):
+            Transaction.objects.create(account=self.account, user=self.user, amount=Decimal('0.10'))
+        User.objects.create_superuser(username='admin', password='password')
+        self.authenticate_user('admin', 'password')
+        response = self.client.get('/api/admin-transactions/', {'user_id': self.user.id, 'start_date': '2000-01-01T00:00:00Z'})
+        self.assertEqual(response.data['total_balance'], Decimal('100.30'))
+
+class KeysetPaginationTests(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.authenticate_user('testuser', 'password')
+        for amount in range(1, 6):
+            Transaction.objects.create(account=self.account, user=self.user, amount=amount)
+        self.expected_ids = list(Transaction.objects.order_by('-timestamp', '-id').values_list('id', flat=True))
+
+    def collect_pages(self, url):
+        ids, pages = [], []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            pages.append(response.data)
+            ids.extend(row['id'] for row in response.data['results'])
+            url = response.data['next']
+        return ids, pages
+
+    def test_walks_every_transaction_once_newest_first(self):
+        ids, pages = self.collect_pages('/api/transactions/?page_size=2')
+        self.assertEqual(ids, self.expected_ids)
+        self.assertEqual(len(pages), 3)
+        self.assertIsNone(pages[0]['previous'])
+
+    def test_previous_link_returns_to_earlier_page(self):
+        first = self.client.get('/api/transactions/?page_size=2').data
+        second = self.client.get(first['next']).data
+        back = self.client.get(second['previous']).data
+        self.assertEqual([row['id'] for row in back['results']], [row['id'] for row in first['results']])
+        self.assertIsNotNone(back['next'])
+
+    def test_page_size_is_capped(self):
+        with mock.patch.object(KeysetPagination, 'max_page_size', 3):
+            response = self.client.get('/api/transactions/?page_size=50')
+        self.assertEqual(len(response.data['results']), 3)
+
+    def test_invalid_cursor_is_rejected(self):
+        response = self.client.get('/api/transactions/?cursor=bogus')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_admin_report_is_paginated(self):
+        User.objects.create_superuser(username='admin', password='password')
+        self.authenticate_user('admin', 'password')
+        response = self.client.get('/api/admin-transactions/', {'user_id': self.user.id, 'page_size': 4})
+        self.assertEqual([row['id'] for row in response.data['transactions']], self.expected_ids[:4])
+        self.assertEqual(response.data['total_balance'], Decimal('115.00'))
+        self.assertIsNotNone(response.data['next'])
+
+class TransactionExportTests(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        Transaction.objects.create(account=self.account, user=self.user, amount=Decimal('20.50'))
+        User.objects.create_superuser(username='admin', password='password')
+        self.authenticate_user('admin', 'password')
+
+    def test_ndjson_export_streams_rows_and_trailer(self):
+        response = self.client.get('/api/admin-transactions/', {'user_id': self.user.id, 'format': 'ndjson'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        lines = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual([line['amount'] for line in lines[:-1]], ['100.00', '20.50'])
+        self.assertEqual(lines[-1], {'total_balance': '120.50'})
+
+    def test_csv_export_flattens_user_and_ends_with_total(self):
+        response = self.client.get('/api/admin-transactions/', {'user_id': self.user.id}, HTTP_ACCEPT='text/csv')
+        rows = list(csv.reader(io.StringIO(b''.join(response.streaming_content).decode())))
+        self.assertEqual(rows[0], ['id', 'account', 'user.id', 'user.username', 'user.email', 'amount', 'timestamp'])
+        self.assertEqual(len(rows), 4)
+        self.assertEqual(rows[-1], ['total_balance', '120.50'])
+
+    def test_export_errors_use_requested_format(self):
+        response = self.client.get('/api/admin-transactions/', {'user_id': self.user.id, 'start_date': 'nope', 'format': 'ndjson'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(json.loads(response.content), {'error': 'Invalid start date format.'})
+
+class BulkTransactionIngestTests(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.post_account = InvestmentAccount.objects.create(name='Post Account')
+        self.view_account = InvestmentAccount.objects.create(name='View Account')
+        AccountPermission.objects.create(user=self.user, account=self.post_account, permission='post')
+        AccountPermission.objects.create(user=self.user, account=self.view_account, permission='view')
+        self.authenticate_user('testuser', 'password')
+
+    def post_batch(self, size):
+        rows = [{'account': self.account.id, 'amount': '10.00'}, {'account': self.post_account.id, 'amount': '5.25'}] * (size // 2)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/api/transactions/bulk/', rows, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return response, len(queries)
+
+    def test_json_batch_is_written_in_one_go(self):
+        response, _ = self.post_batch(100)
+        self.assertEqual(response.data['created'], 100)
+        self.assertEqual(response.data['results'][1]['status'], 'created')
+        self.assertEqual(Transaction.objects.filter(account=self.post_account).count(), 50)
+        self.assertEqual(ledger.account_balance(self.post_account.id), Decimal('262.50'))
+
+    def test_query_count_does_not_grow_with_batch_size(self):
+        self.post_batch(2)  # creates the summary rows the later batches only update
+        _, small = self.post_batch(4)
+        # Small enough that each bulk insert fits within SQLite's 999 query parameters
+        _, large = self.post_batch(150)
+        self.assertEqual(small, large)
+
+    def test_ndjson_body_is_accepted(self):
+        body = '\n'.join(json.dumps({'account': self.account.id, 'amount': amount}) for amount in ('1.00', '2.00'))
+        response = self.client.post('/api/transactions/bulk/', body, content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(ledger.account_balance(self.account.id), Decimal('103.00'))
+
+    def test_rejected_row_fails_whole_batch(self):
+        rows = [
+            {'account': self.account.id, 'amount': '10.00'},
+            {'account': self.view_account.id, 'amount': '10.00'},
+            {'account': self.account.id, 'amount': 'lots'},
+        ]
+        response = self.client.post('/api/transactions/bulk/', rows, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual([row['status'] for row in response.data['results']], ['valid', 'valid', 'invalid'])
+        self.assertEqual(Transaction.objects.count(), 1)
+
+        response = self.client.post('/api/transactions/bulk/', rows[:2], format='json')
+        self.assertEqual([row['status'] for row in response.data['results']], ['valid', 'invalid'])
+        self.assertIn('account', response.data['results'][1]['errors'])
+        self.assertEqual(Transaction.objects.count(), 1)
+
+    def test_body_must_be_a_list(self):
+        response = self.client.post('/api/transactions/bulk/', {'account': self.account.id, 'amount': '1.00'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+class ColumnarFormatTests(BaseTestCase):
+    media_type = 'application/vnd.accounts.columns+json'
+
+    def setUp(self):
+        super().setUp()
+        self.other = User.objects.create_user(username='other', password='password', email='other@example.com')
+        AccountPermission.objects.create(user=self.other, account=self.account, permission='crud')
+        for user, amount in ((self.other, '-2.50'), (self.user, '7.25'), (self.other, '0.01')):
+            Transaction.objects.create(account=self.account, user=user, amount=amount)
+        self.admin = User.objects.create_superuser(username='admin', password='password')
+        self.authenticate_user('testuser', 'password')
+
+    def rows(self, columns):
+        """The columns back as the rows the JSON format sends."""
+        return [
+            {'id': id, 'account': account, 'user': columns['users'][user], 'amount': amount,
+             'timestamp': (datetime(1970, 1, 1, tzinfo=dt_timezone.utc) + timedelta(microseconds=timestamp)).isoformat().replace('+00:00', 'Z')}
+            for id, account, user, amount, timestamp in zip(*(columns[field] for field in ('id', 'account', 'user', 'amount', 'timestamp')))
+        ]
+
+    def test_list_matches_json(self):
+        response = self.client.get('/api/transactions/?page_size=3', HTTP_ACCEPT=self.media_type)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], self.media_type)
+        columns = json.loads(response.content)['results']
+        self.assertEqual([user['username'] for user in columns['users']], ['other', 'testuser'])
+        self.assertEqual(columns['user'], [0, 1, 0])
+
+        expected = self.client.get('/api/transactions/?page_size=3', HTTP_ACCEPT='application/json').json()
+        self.assertEqual(self.rows(columns), expected['results'])
+        self.assertEqual(json.loads(response.content)['next'], expected['next'])
+
+    def test_admin_report_matches_json(self):
+        self.client.force_login(self.admin)
+        response = self.client.get(f'/api/admin-transactions/?user_id={self.other.id}&format=columns')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = json.loads(response.content)
+        expected = self.client.get(f'/api/admin-transactions/?user_id={self.other.id}&format=json').json()
+        self.assertEqual(self.rows(data['transactions']), expected['transactions'])
+        self.assertEqual(data['total_balance'], expected['total_balance'])
+
+    def test_other_responses_stay_plain_json(self):
+        response = self.client.get(f'/api/transactions/{self.transaction.id}/', HTTP_ACCEPT=self.media_type)
+        self.assertEqual(response.json()['amount'], '100.00')
+        response = self.client.get('/api/transactions/?cursor=nope', HTTP_ACCEPT=self.media_type)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertIn('detail', response.json())
+
+    def test_bulk_accepts_columns(self):
+        body = json.dumps({'account': [self.account.id, self.account.id], 'amount': ['1.00', 2]})
+        response = self.client.post('/api/transactions/bulk/', body, content_type=self.media_type)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['created'], 2)
+        self.assertEqual(ledger.account_balance(self.account.id), Decimal('107.76'))
+
+        for body in ({'account': [self.account.id], 'amount': []}, [{'account': self.account.id, 'amount': '1.00'}]):
+            response = self.client.post('/api/transactions/bulk/', json.dumps(body), content_type=self.media_type)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post('/api/transactions/bulk/', json.dumps({'account': [self.account.id], 'amount': ['lots']}), content_type=self.media_type)
+        self.assertEqual(response.data['results'][0]['status'], 'invalid')
+
+    def test_benchmark_compares_formats(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, 'results.json')
+            call_command('benchmark_formats', page_sizes='2,4', repeat=1, output=output, stdout=io.StringIO())
+            with open(output) as results:
+                report = json.load(results)
+        self.assertEqual([(result['rows'], result['format']) for result in report['results']], [(2, 'json'), (2, 'columns'), (4, 'json'), (4, 'columns')])
+        self.assertLess(report['results'][3]['bytes'], report['results'][2]['bytes'])
+
+class PermissionCacheTests(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.authenticate_user('testuser', 'password')
+
+    def permission_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        return response, [query for query in queries if 'accounts_accountpermission' in query['sql']]
+
+    def test_permissions_are_loaded_once_and_then_served_from_cache(self):
+        response, lookups = self.permission_queries(f'/api/transactions/{self.transaction.id}/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(lookups), 1)
+        self.assertEqual(cache.get(permission_cache_key(self.user.id)), {self.account.id: 'crud'})
+
+        response, lookups = self.permission_queries(f'/api/transactions/{self.transaction.id}/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(lookups, [])
+
+    def test_permission_changes_invalidate_cache(self):
+        self.client.get(f'/api/transactions/{self.transaction.id}/')
+        grant = AccountPermission.objects.get(user=self.user, account=self.account)
+        grant.permission = 'post'
+        grant.save()
+        self.assertIsNone(cache.get(permission_cache_key(self.user.id)))
+
+        response = self.client.get(f'/api/transactions/{self.transaction.id}/')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        grant.delete()
+        response = self.client.get(f'/api/transactions/{self.transaction.id}/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_user_has_one_grant_per_account(self):
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            AccountPermission.objects.create(user=self.user, account=self.account, permission='view')
+
+class BulkPermissionTests(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.admin = User.objects.create_superuser(username='admin', password='password')
+        self.other = User.objects.create_user(username='other', password='password')
+        self.leaver = User.objects.create_user(username='leaver', password='password')
+        self.second = InvestmentAccount.objects.create(name='Second Account')
+        AccountPermission.objects.create(user=self.leaver, account=self.second, permission='post')
+        self.client.force_login(self.admin)
+
+    def post(self, body):
+        return self.client.post('/api/admin-permissions/bulk/', body, format='json')
+
+    def grants(self):
+        return set(AccountPermission.objects.values_list('user_id', 'account_id', 'permission'))
+
+    def test_matrix_is_applied_and_diffed(self):
+        body = {
+            'grant': [{'users': [self.user.id, self.other.id], 'accounts': [self.account.id, self.second.id], 'permission': 'view'}],
+            'revoke': [{'users': [self.leaver.id], 'accounts': [self.second.id]}],
+        }
+        response = self.post(body)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {
+            'created': [
+                {'user': self.user.id, 'account': self.second.id, 'permission': 'view'},
+                {'user': self.other.id, 'account': self.account.id, 'permission': 'view'},
+                {'user': self.other.id, 'account': self.second.id, 'permission': 'view'},
+            ],
+            'updated': [{'user': self.user.id, 'account': self.account.id, 'permission': 'view', 'previous': 'crud'}],
+            'revoked': [{'user': self.leaver.id, 'account': self.second.id, 'previous': 'post'}],
+            'unchanged': 0,
+        })
+        self.assertEqual(self.grants(), {
+            (user.id, account.id, 'view') for user in (self.user, self.other) for account in (self.account, self.second)
+        })
+
+        response = self.post(body)
+        self.assertEqual(response.data, {'created': [], 'updated': [], 'revoked': [], 'unchanged': 5})
+
+    def test_query_count_does_not_grow_with_the_matrix(self):
+        def queries(users, accounts):
+            body = {'grant': [{'users': [user.id for user in users], 'accounts': [account.id for account in accounts], 'permission': 'view'}]}
+            with CaptureQueriesContext(connection) as captured:
+                self.assertEqual(self.post(body).status_code, status.HTTP_200_OK)
+            return len(captured)
+
+        small = queries([self.other], [self.account])
+        users = [User.objects.create_user(username=f'bulk-{index}') for index in range(10)]
+        accounts = [InvestmentAccount.objects.create(name=f'Bulk {index}') for index in range(10)]
+        self.assertEqual(queries(users, accounts), small)
+
+    def test_caches_and_account_versions_are_refreshed(self):
+        self.client.force_login(self.other)
+        self.assertEqual(self.client.get('/api/accounts/').data, [])
+        version = AccountBalance.objects.get(account=self.second).version
+
+        self.client.force_login(self.admin)
+        self.post({'grant': [{'users': [self.other.id], 'accounts': [self.second.id], 'permission': 'view'}]})
+        self.assertGreater(AccountBalance.objects.get(account=self.second).version, version)
+        self.client.force_login(self.other)
+        self.assertEqual([account['id'] for account in self.client.get('/api/accounts/').data], [self.second.id])
+
+    def test_invalid_matrices_change_nothing(self):
+        before = self.grants()
+        conflicting = {
+            'grant': [{'users': [self.other.id], 'accounts': [self.account.id], 'permission': 'view'}],
+            'revoke': [{'users': [self.other.id], 'accounts': [self.account.id]}],
+        }
+        self.assertEqual(self.post(conflicting).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.post({}).status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.post({'grant': [{'users': [self.other.id, 999999], 'accounts': [self.account.id, 888888], 'permission': 'crud'}]})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual((response.data['users'], response.data['accounts']), ([999999], [888888]))
+
+        self.authenticate_user('testuser', 'password')
+        self.assertEqual(self.post({'revoke': [{'users': [self.leaver.id], 'accounts': [self.second.id]}]}).status_code, status.HTTP_403_FORBIDDEN)
+        self.assertEqual(self.grants(), before)
+
+class QueryCountTests(BaseTestCase):
+    """List endpoints must issue the same number of queries however many rows they return."""
+
+    def setUp(self):
+        super().setUp()
+        self.admin = User.objects.create_superuser(username='admin', password='password')
+        self.add_rows(3)
+
+    def add_rows(self, count):
+        for _ in range(count):
+            other = User.objects.create_user(username=f'user{User.objects.count()}')
+            account = InvestmentAccount.objects.create(name='Shared Account')
+            AccountPermission.objects.create(user=self.user, account=account, permission='view')
+            AccountPermission.objects.create(user=other, account=account, permission='crud')
+            Transaction.objects.create(account=account, user=other, amount=10)
+            Transaction.objects.create(account=self.account, user=self.user, amount=5)
+
+    def count_queries(self, url, data=None):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, data)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return len(queries)
+
+    def assert_constant_queries(self, url, data=None):
+        cache.clear()
+        before = self.count_queries(url, data)
+        self.add_rows(10)
+        cache.clear()
+        self.assertEqual(self.count_queries(url, data), before)
+
+    def test_account_list(self):
+        self.authenticate_user('testuser', 'password')
+        self.assert_constant_queries('/api/accounts/')
+
+    def test_transaction_list(self):
+        self.authenticate_user('testuser', 'password')
+        self.assert_constant_queries('/api/transactions/')
+
+    def test_admin_report(self):
+        self.authenticate_user('admin', 'password')
+        self.assert_constant_queries('/api/admin-transactions/', {'user_id': self.user.id})
+
+class RowSerializerTests(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        other = User.objects.create_user(username='other', email='other@example.com')
+        AccountPermission.objects.create(user=other, account=self.account, permission='view')
+        Transaction.objects.create(account=self.account, user=other, amount=Decimal('0.10'))
+        InvestmentAccount.objects.create(name='No Grants')
+
+    def test_transaction_rows_match_model_serializer(self):
+        queryset = Transaction.objects.order_by('id')
+        row_serializer = TransactionRowSerializer()
+        fast = row_serializer.serialize(row_serializer.select(queryset))
+        self.assertEqual(fast, TransactionSerializer(queryset, many=True).data)
+
+    def test_account_rows_match_model_serializer(self):
+        queryset = InvestmentAccount.objects.order_by('id')
+        row_serializer = InvestmentAccountRowSerializer()
+        fast = row_serializer.serialize(row_serializer.select(queryset))
+        self.assertEqual(json.loads(json.dumps(fast)), json.loads(json.dumps(InvestmentAccountSerializer(queryset, many=True).data)))
+
+    def test_list_endpoints_use_row_serializers(self):
+        self.authenticate_user('testuser', 'password')
+        with mock.patch.object(TransactionSerializer, 'to_representation') as slow_path:
+            response = self.client.get('/api/transactions/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['results']), 2)
+        slow_path.assert_not_called()
+
+class TransactionRollupTests(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.authenticate_user('testuser', 'password')
+
+    def backdate(self, transaction, *date):
+        Transaction.objects.filter(pk=transaction.pk).update(timestamp=timezone.make_aware(timezone.datetime(*date)))
+
+    def test_rollups_follow_transaction_writes(self):
+        response = self.client.post('/api/transactions/', {'account': self.account.id, 'amount': 50})
+        today = ledger.bucket_for(timezone.now(), 'day')
+        rollup = TransactionRollup.objects.get(account=self.account, granularity='day', bucket=today)
+        self.assertEqual((rollup.total, rollup.transaction_count), (Decimal('150.00'), 2))
+
+        self.client.delete(f'/api/transactions/{response.data["id"]}/')
+        rollup.refresh_from_db()
+        self.assertEqual((rollup.total, rollup.transaction_count), (Decimal('100.00'), 1))
+
+    def test_endpoint_answers_from_rebuilt_rollups(self):
+        self.backdate(self.transaction, 2024, 1, 15)
+        for amount, date in ((20, (2024, 1, 31)), (30, (2024, 2, 1)), (40, (2024, 3, 5))):
+            self.backdate(Transaction.objects.create(account=self.account, user=self.user, amount=amount), *date)
+        ledger.rebuild_rollups([self.account.id])
+
+        response = self.client.get(f'/api/accounts/{self.account.id}/rollups/', {'start': '2024-01-20', 'end': '2024-02-29'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['results'], [
+            {'bucket': '2024-01-01', 'total': '120.00', 'transaction_count': 2},
+            {'bucket': '2024-02-01', 'total': '30.00', 'transaction_count': 1},
+        ])
+
+        response = self.client.get(f'/api/accounts/{self.account.id}/rollups/', {'granularity': 'week', 'start': '2024-01-29'})
+        self.assertEqual([row['bucket'] for row in response.data['results']], ['2024-01-29', '2024-03-04'])
+
+    def test_endpoint_rejects_unknown_granularity(self):
+        response = self.client.get(f'/api/accounts/{self.account.id}/rollups/', {'granularity': 'year'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_endpoint_rejects_non_numeric_user_id(self):
+        response = self.client.get(f'/api/accounts/{self.account.id}/rollups/', {'user_id': 'abc'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+class BalanceCheckpointTests(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.authenticate_user('testuser', 'password')
+        self.history = [self.post(amount, *date) for amount, date in (
+            (10, (2024, 1, 3)), (20, (2024, 1, 20)), (30, (2024, 2, 10)), (-5, (2024, 3, 1)),
+        )]
+
+    def post(self, amount, *date):
+        timestamp = timezone.make_aware(timezone.datetime(*date, 12))
+        return Transaction.objects.create(account=self.account, user=self.user, amount=amount, timestamp=timestamp)
+
+    def summed(self, moment):
+        totals = [
+            model.objects.filter(account=self.account, timestamp__lte=moment).aggregate(total=models.Sum('amount'), count=models.Count('id'))
+            for model in (Transaction, ArchivedTransaction)
+        ]
+        return sum((total['total'] or 0 for total in totals), Decimal('0')), sum(total['count'] for total in totals)
+
+    def assert_matches_history(self):
+        moments = [timezone.make_aware(timezone.datetime(*date)) for date in (
+            (2023, 12, 31), (2024, 1, 3, 12), (2024, 1, 10), (2024, 1, 31, 23, 59), (2024, 2, 10, 11), (2024, 3, 1, 12), (2024, 6, 1),
+        )]
+        for moment in moments + [timezone.now() - timezone.timedelta(seconds=1), timezone.now()]:
+            self.assertEqual(ledger.balance_as_of(self.account.id, moment), self.summed(moment), moment)
+
+    def test_balances_match_summing_the_history(self):
+        self.assert_matches_history()
+        call_command('checkpoint_balances', stdout=io.StringIO())
+        self.assertEqual(
+            list(BalanceCheckpoint.objects.filter(account=self.account).values_list('bucket', 'balance')),
+            [(date(2024, 1, 8), Decimal('10.00')), (date(2024, 1, 22), Decimal('30.00')), (date(2024, 2, 12), Decimal('60.00')),
+             (date(2024, 3, 4), Decimal('55.00'))],
+        )
+        self.assert_matches_history()
+
+        call_command('archive_transactions', before='2024-02-01', stdout=io.StringIO())
+        self.assert_matches_history()
+
+    def test_back_dated_changed_and_deleted_transactions_move_checkpoints(self):
+        ledger.checkpoint()
+        self.post(7, 2024, 1, 5)
+        self.history[2].delete()
+        self.history[1].amount = 25
+        self.history[1].save()
+        self.history[3].timestamp = timezone.make_aware(timezone.datetime(2023, 12, 1))
+        self.history[3].save()
+        self.assert_matches_history()
+
+        shifted = dict(BalanceCheckpoint.objects.values_list('bucket', 'balance'))
+        ledger.checkpoint(rebuild=True)
+        rebuilt = dict(BalanceCheckpoint.objects.values_list('bucket', 'balance'))
+        # A rebuild adds one after the newly active December and none after the emptied February and March weeks
+        self.assertEqual(set(rebuilt) ^ set(shifted), {date(2023, 12, 4), date(2024, 2, 12), date(2024, 3, 4)})
+        self.assertEqual({bucket: shifted[bucket] for bucket in rebuilt if bucket in shifted}, {
+            date(2024, 1, 8): Decimal('12.00'), date(2024, 1, 22): Decimal('37.00'),
+        })
+        self.assertEqual(shifted[date(2024, 3, 4)], Decimal('37.00'))
+        self.assert_matches_history()
+
+    def test_deleting_a_user_takes_their_archived_rows_out_of_the_ledger(self):
+        leaver = User.objects.create_user(username='leaver', password='password')
+        Transaction.objects.create(account=self.account, user=leaver, amount=7, timestamp=timezone.make_aware(timezone.datetime(2024, 1, 4)))
+        ledger.checkpoint()
+        call_command('archive_transactions', before='2024-02-01', stdout=io.StringIO())
+        balance = ledger.account_balance(self.account.id)
+
+        leaver.delete()
+        self.assertFalse(ArchivedTransaction.objects.filter(user_id=leaver.id).exists())
+        self.assertEqual(ledger.account_balance(self.account.id), balance - 7)
+        self.assert_matches_history()
+
+    def test_runs_only_add_new_checkpoints(self):
+        self.assertEqual(ledger.checkpoint(), 4)
+        self.assertEqual(ledger.checkpoint(), 0)
+        self.post(40, 2024, 4, 2)
+        self.assertEqual(ledger.checkpoint(), 1)
+        self.assert_matches_history()
+        with override_settings(ACCOUNTS_CHECKPOINT_INTERVAL='month'):
+            self.assertEqual(ledger.checkpoint(), 4)
+            self.assertEqual(set(BalanceCheckpoint.objects.values_list('granularity', flat=True)), {'month'})
+            self.assert_matches_history()
+
+    def test_query_count_does_not_depend_on_history(self):
+        ledger.checkpoint()
+        with self.assertNumQueries(3):
+            ledger.balance_as_of(self.account.id, timezone.make_aware(timezone.datetime(2024, 2, 20)))
+        with self.assertNumQueries(3):
+            ledger.balance_as_of(self.account.id, timezone.now())
+
+    def test_endpoint(self):
+        ledger.checkpoint()
+        url = f'/api/accounts/{self.account.id}/balance/'
+        response = self.client.get(url, {'as_of': '2024-01-20'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {'account': self.account.id, 'as_of': '2024-01-20T23:59:59.999999Z', 'balance': '30.00', 'transaction_count': 2})
+        self.assertEqual(self.client.get(url, {'as_of': '2024-01-20T11:00:00Z'}).data['balance'], '10.00')
+        self.assertEqual(self.client.get(url).data['balance'], '155.00')
+        self.assertEqual(self.client.get(url, {'as_of': 'yesterday'}).status_code, status.HTTP_400_BAD_REQUEST)
+
+        other = InvestmentAccount.objects.create(name='Other')
+        self.assertEqual(self.client.get(f'/api/accounts/{other.id}/balance/').status_code, status.HTTP_404_NOT_FOUND)
+
+class AsyncURLConf:
+    urlpatterns = [path('api/', include(async_urlpatterns + sync_urlpatterns))]
+
+@override_settings(ROOT_URLCONF=AsyncURLConf)
+class AsyncViewTests(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.admin = User.objects.create_superuser(username='admin', password='password')
+        post_account = InvestmentAccount.objects.create(name='Post Only')
+        AccountPermission.objects.create(user=self.user, account=post_account, permission='post')
+        self.post_transaction = Transaction.objects.create(account=post_account, user=self.user, amount=5)
+        for amount in (1, 2, 3):
+            Transaction.objects.create(account=self.account, user=self.user, amount=amount)
+
+    async def login(self, user):
+        await sync_to_async(self.async_client.force_login)(user)
+        await sync_to_async(self.client.force_login)(user)
+
+    async def assert_same_as_sync(self, url, data=None):
+        response = await self.async_client.get(url, data)
+        expected = await sync_to_async(self.client.get)(url, data, HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, expected.status_code)
+        self.assertEqual(response.json(), expected.json())
+        self.assertEqual(response.get('ETag'), expected.get('ETag'))
+        return response
+
+    async def test_transaction_list_matches_sync_view(self):
+        await self.login(self.user)
+        response = await self.assert_same_as_sync('/api/transactions/', {'page_size': 2})
+        await self.assert_same_as_sync(response.json()['next'])
+
+    async def test_transaction_detail_enforces_permissions(self):
+        await self.login(self.user)
+        await self.assert_same_as_sync(f'/api/transactions/{self.transaction.id}/')
+        response = await self.assert_same_as_sync(f'/api/transactions/{self.post_transaction.id}/')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        response = await self.assert_same_as_sync('/api/transactions/999999/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    async def test_admin_report_matches_sync_view(self):
+        await self.login(self.admin)
+        await self.assert_same_as_sync('/api/admin-transactions/', {'user_id': self.user.id})
+        await self.assert_same_as_sync('/api/admin-transactions/', {'user_id': self.user.id, 'start_date': '2000-01-01T00:00:00Z'})
+        response = await self.assert_same_as_sync('/api/admin-transactions/', {'user_id': self.user.id, 'end_date': 'soon'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    async def test_admin_report_requires_staff(self):
+        await self.login(self.user)
+        response = await self.async_client.get('/api/admin-transactions/', {'user_id': self.user.id})
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    async def test_archived_rows_match_sync_view(self):
+        def archive_oldest():
+            Transaction.objects.filter(amount__in=[1, 2]).update(timestamp=timezone.make_aware(timezone.datetime(2020, 1, 1)))
+            call_command('archive_transactions', before='2021-01-01', stdout=io.StringIO())
+
+        await sync_to_async(archive_oldest)()
+        await self.login(self.user)
+        response = await self.assert_same_as_sync('/api/transactions/', {'page_size': 3})
+        response = await self.assert_same_as_sync(response.json()['next'])
+        self.assertEqual(len(response.json()['results']), 2)
+        await self.assert_same_as_sync(f'/api/transactions/{response.json()["results"][-1]["id"]}/')
+
+        await self.login(self.admin)
+        await self.assert_same_as_sync('/api/admin-transactions/', {'user_id': self.user.id, 'start_date': '2019-01-01T00:00:00Z'})
+
+    async def test_basic_auth_and_anonymous_reads_fall_through_to_sync_view(self):
+        credentials = base64.b64encode(b'testuser:password').decode()
+        response = await self.async_client.get('/api/transactions/', headers={'Authorization': f'Basic {credentials}'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.json()['results']), 5)
+
+        response = await self.async_client.get('/api/transactions/')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    async def test_writes_fall_through_to_sync_view(self):
+        await self.login(self.user)
+        response = await self.async_client.post('/api/transactions/', {'account': self.account.id, 'amount': 9}, content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+@override_settings(ACCOUNTS_EVENTS_KEEPALIVE_SECONDS=0.05)
+class ChangeFeedTests(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.other_account = InvestmentAccount.objects.create(name='Other')
+        AccountPermission.objects.create(user=self.user, account=self.other_account, permission='view')
+        self.post_account = InvestmentAccount.objects.create(name='Post Only')
+        AccountPermission.objects.create(user=self.user, account=self.post_account, permission='post')
+        self.client.force_login(self.user)
+
+    def post(self, account, amount):
+        # The feed publishes on commit, which a TestCase never reaches
+        with self.captureOnCommitCallbacks(execute=True):
+            return Transaction.objects.create(account=account, user=self.user, amount=amount)
+
+    def read(self, **headers):
+        response = self.client.get('/api/transactions/events/', **headers)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        return parse_events(b''.join(response.streaming_content))
+
+    async def next_event(self, content):
+        while True:
+            events = parse_events(await content.__anext__())
+            if events:
+                return events[0]
+
+    async def test_new_transactions_are_pushed_to_readers(self):
+        await sync_to_async(self.async_client.force_login)(self.user)
+        response = await self.async_client.get('/api/transactions/events/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        content = response.streaming_content
+        self.assertIn(b'retry: ', await content.__anext__())
+
+        # Nothing is sent for an account the user may only post to
+        await sync_to_async(self.post)(self.post_account, 7)
+        created = await sync_to_async(self.post)(self.account, '12.50')
+        event = await self.next_event(content)
+        self.assertEqual(event['event'], 'transaction')
+        self.assertEqual(event['data'], {
+            'id': created.id, 'account': self.account.id, 'user': self.user.id, 'amount': '12.50',
+            'timestamp': TransactionSerializer(created).data['timestamp'],
+        })
+
+        # Grants are re-read with each keepalive
+        await sync_to_async(AccountPermission.objects.filter(account=self.account).delete)()
+        self.assertEqual(await content.__anext__(), b': keepalive\n\n')
+        await sync_to_async(self.post)(self.account, 1)
+        created = await sync_to_async(self.post)(self.other_account, 2)
+        self.assertEqual((await self.next_event(content))['data']['id'], created.id)
+
+        # As the server does once the client has gone
+        await sync_to_async(response.close)()
+        self.assertEqual(dict(events.broadcaster._watching), {})
+
+    def test_reconnect_sends_missed_events(self):
+        cursor = self.read()[0]['id']
+        self.assertEqual(self.read(HTTP_LAST_EVENT_ID=cursor)[0], {'id': cursor})
+
+        first = self.post(self.account, 1)
+        self.post(self.post_account, 2)
+        response = self.client.post('/api/transactions/bulk/', [{'account': self.account.id, 'amount': '3.00'}], format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        missed = self.read(HTTP_LAST_EVENT_ID=cursor)
+        self.assertEqual([event['data']['id'] for event in missed], [first.id, response.data['results'][0]['id']])
+        self.assertEqual(missed[1]['data']['amount'], '3.00')
+        self.assertEqual(self.read(HTTP_LAST_EVENT_ID=missed[0]['id'])[0]['data']['id'], missed[1]['data']['id'])
+        self.assertEqual(self.client.get('/api/transactions/events/', {'last_event_id': missed[-1]['id']}).status_code, status.HTTP_200_OK)
+        self.assertEqual(self.read(HTTP_LAST_EVENT_ID=missed[-1]['id']), [{'id': missed[-1]['id']}])
+
+    def test_reconnect_from_too_far_back_resets(self):
+        cursor = self.read()[0]['id']
+        for amount in (1, 2):
+            self.post(self.account, amount)
+        with override_settings(ACCOUNTS_EVENTS_REPLAY_LIMIT=1):
+            reset = self.read(HTTP_LAST_EVENT_ID=cursor)
+        self.assertEqual([event['event'] for event in reset], ['reset'])
+        self.assertEqual(reset[0]['id'], str(TransactionEvent.objects.latest('id').id))
+        self.assertEqual(self.read(HTTP_LAST_EVENT_ID='not-a-cursor')[0]['event'], 'reset')
+
+    def test_requires_authentication(self):
+        self.client.logout()
+        self.assertEqual(self.client.get('/api/transactions/events/').status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_prune_deletes_old_events(self):
+        self.post(self.account, 1)
+        TransactionEvent.objects.update(created_at=timezone.now() - timezone.timedelta(days=30))
+        kept = self.post(self.account, 2)
+        call_command('prune_transaction_events', stdout=io.StringIO())
+        self.assertEqual(list(TransactionEvent.objects.values_list('transaction_id', flat=True)), [kept.id])
+
+def parse_events(body):
+    """SSE messages as dicts of their fields, with ``data`` decoded from JSON; comments are skipped."""
+    parsed = []
+    for block in body.decode().split('\n\n'):
+        fields = dict(line.split(': ', 1) for line in block.splitlines() if line and not line.startswith(':'))
+        fields.pop('retry', None)
+        if 'data' in fields:
+            fields['data'] = json.loads(fields['data'])
+        if fields:
+            parsed.append(fields)
+    return parsed
+
+class ConditionalGetTests(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.authenticate_user('testuser', 'password')
+
+    def get(self, url, etag=None):
+        headers = {'HTTP_IF_NONE_MATCH': etag} if etag else {}
+        return self.client.get(url, HTTP_ACCEPT='application/json', **headers)
+
+    def test_unchanged_list_is_answered_without_the_main_query(self):
+        etag = self.get('/api/transactions/')['ETag']
+        with CaptureQueriesContext(connection) as queries:
+            response = self.get('/api/transactions/', etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response['ETag'], etag)
+        self.assertFalse(any('accounts_transaction' in query['sql'] for query in queries))
+
+    def test_writes_change_the_etag(self):
+        etag = self.get('/api/transactions/')['ETag']
+        Transaction.objects.create(account=self.account, user=self.user, amount=1)
+        response = self.get('/api/transactions/', etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_rebuild_never_repeats_an_etag(self):
+        url = f'/api/accounts/{self.account.id}/'
+        etag = self.get(url)['ETag']
+        # Changed behind the ledger's back, then repaired by a rebuild that
+        # must not reset the version to one the old tag was taken at
+        Transaction.objects.filter(pk=self.transaction.pk).update(amount=Decimal('5.00'))
+        ledger.rebuild()
+        for _ in range(2):
+            self.assertEqual(self.get(url, etag).status_code, status.HTTP_200_OK)
+            Transaction.objects.create(account=self.account, user=self.user, amount=1)
+        response = self.get(url, etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['balance'], '7.00')
+
+    def test_permission_and_account_changes_change_the_etag(self):
+        etag = self.get('/api/accounts/')['ETag']
+        other = User.objects.create_user(username='other', password='password')
+        AccountPermission.objects.create(user=other, account=self.account, permission='view')
+        self.assertEqual(self.get('/api/accounts/', etag).status_code, status.HTTP_200_OK)
+
+        etag = self.get('/api/accounts/')['ETag']
+        self.account.name = 'Renamed'
+        self.account.save()
+        self.assertEqual(self.get('/api/accounts/', etag).status_code, status.HTTP_200_OK)
+
+    def test_detail_etag_depends_only_on_its_account(self):
+        url = f'/api/transactions/{self.transaction.id}/'
+        etag = self.get(url)['ETag']
+        unrelated = InvestmentAccount.objects.create(name='Unrelated')
+        AccountPermission.objects.create(user=self.user, account=unrelated, permission='crud')
+        Transaction.objects.create(account=unrelated, user=self.user, amount=1)
+        self.assertEqual(self.get(url, etag).status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertNotEqual(self.get('/api/transactions/', etag).status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_formats_do_not_share_an_etag(self):
+        etag = self.get('/api/accounts/')['ETag']
+        response = self.client.get('/api/accounts/?format=api', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+@override_settings(ACCOUNTS_DATABASE_REPLICAS=[], ACCOUNTS_SHARDS=['default'])
+class LoadTestingCommandTests(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        call_command('seed_data', users=5, accounts=10, transactions=300, batch_size=100, stdout=io.StringIO())
+
+    def test_seed_data_builds_a_consistent_dataset(self):
+        self.assertEqual(Transaction.objects.count(), 300)
+        self.assertTrue(User.objects.get(username='bench-admin').is_superuser)
+        self.assertEqual(AccountBalance.objects.count(), InvestmentAccount.objects.count())
+        self.assertEqual(sum(AccountBalance.objects.values_list('transaction_count', flat=True)), 300)
+        # Every transaction is attributed to a user allowed to post to its account
+        self.assertFalse(Transaction.objects.exclude(
+            account__accountpermission__user=models.F('user'), account__accountpermission__permission__in=['crud', 'post'],
+        ).exists())
+
+    def test_benchmark_covers_every_endpoint_and_leaves_data_alone(self):
+        grant = AccountPermission.objects.filter(permission='crud', account__transactions__isnull=False).first()
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, 'results.json')
+            call_command('benchmark', grant.user.username, requests=2, output=output, stdout=io.StringIO())
+            with open(output) as results:
+                report = json.load(results)
+
+        self.assertEqual(report['dataset']['transactions'], Transaction.objects.count())
+        self.assertEqual(Transaction.objects.count(), 300)
+        names = {result['name'] for result in report['results']}
+        self.assertIn('transaction-bulk', names)
+        self.assertIn('admin-export-ndjson', names)
+        for result in report['results']:
+            self.assertLessEqual(result['p50_ms'], result['p99_ms'])
+            if result['name'].startswith('transaction-'):
+                self.assertGreater(result['queries'], 0)
+
+class RequestMetricsTests(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        metrics.registry.reset()
+        self.admin = User.objects.create_superuser(username='admin', password='password')
+
+    def scrape(self):
+        self.client.force_login(self.admin)
+        response = self.client.get('/api/metrics/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        return response.content.decode()
+
+    def test_requests_are_counted_per_route(self):
+        self.authenticate_user('testuser', 'password')
+        self.client.get('/api/transactions/')
+        self.client.get('/api/transactions/')
+        self.client.get(f'/api/transactions/{self.transaction.id}/')
+
+        text = self.scrape()
+        self.assertIn('accounts_http_requests_total{route="transaction-list",method="GET",status="200"} 2', text)
+        self.assertIn('accounts_http_requests_total{route="transaction-detail",method="GET",status="200"} 1', text)
+        self.assertIn('accounts_http_request_duration_seconds_count{route="transaction-list",method="GET"} 2', text)
+        self.assertIn('accounts_db_queries_per_request_bucket{route="transaction-list",method="GET",le="+Inf"} 2', text)
+        self.assertNotIn('accounts_db_queries_per_request_bucket{route="transaction-list",method="GET",le="0"} 1', text)
+
+    def test_query_count_and_size_are_recorded(self):
+        self.authenticate_user('testuser', 'password')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/accounts/')
+
+        route = metrics.registry.routes['account-list', 'GET']
+        self.assertEqual(route.queries.sum, len(queries))
+        self.assertGreater(route.db_seconds, 0)
+        self.assertEqual(route.size.sum, len(response.content))
+
+    def test_endpoint_is_admin_only(self):
+        self.authenticate_user('testuser', 'password')
+        self.assertEqual(self.client.get('/api/metrics/').status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_slow_queries_are_logged_over_threshold(self):
+        self.authenticate_user('testuser', 'password')
+        with override_settings(ACCOUNTS_SLOW_QUERY_MS=0), self.assertLogs('accounts.slow_queries', 'WARNING') as logs:
+            self.client.get('/api/transactions/')
+        self.assertIn('/api/transactions/', logs.output[0])
+        self.assertGreater(metrics.registry.routes['transaction-list', 'GET'].slow_queries, 0)
+
+        with override_settings(ACCOUNTS_SLOW_QUERY_MS=None):
+            self.client.get('/api/transactions/')
+        self.assertIn('accounts_db_slow_queries_total{route="transaction-list",method="GET"} ' + str(
+            metrics.registry.routes['transaction-list', 'GET'].slow_queries), self.scrape())
+
+@skipUnless(connection.vendor == 'sqlite', 'Checks SQLite EXPLAIN QUERY PLAN output.')
+class QueryPlanTests(BaseTestCase):
+    """
+    Run every query the read endpoints issue through EXPLAIN QUERY PLAN and
+    fail if one of them scans an accounts table or sorts its whole match set,
+    either of which costs time in proportion to the table rather than the page.
+    """
+    bad_steps = re.compile(r'^SCAN (TABLE )?accounts_|^USE TEMP B-TREE FOR ORDER BY')
+
+    def setUp(self):
+        super().setUp()
+        self.admin = User.objects.create_superuser(username='admin', password='password')
+        for amount in (1, 2, 3):
+            Transaction.objects.create(account=self.account, user=self.user, amount=amount)
+
+    def requests(self):
+        yield self.user, '/api/accounts/', 'application/json'
+        yield self.user, f'/api/accounts/{self.account.id}/', 'application/json'
+        yield self.user, f'/api/accounts/{self.account.id}/rollups/?granularity=day&start=2024-01-01&end=2030-01-01', 'application/json'
+        yield self.user, '/api/transactions/?page_size=2', 'application/json'
+        yield self.user, f'/api/transactions/{self.transaction.id}/', 'application/json'
+        yield self.admin, f'/api/admin-transactions/?user_id={self.user.id}&page_size=2', 'application/json'
+        yield self.admin, f'/api/admin-transactions/?user_id={self.user.id}&start_date=2000-01-01T00:00:00Z', 'application/json'
+        yield self.admin, f'/api/admin-transactions/?user_id={self.user.id}&format=ndjson', 'application/x-ndjson'
+
+    def explain(self, sql):
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}')
+            return [row[-1] for row in cursor.fetchall()]
+
+    def test_read_queries_use_indexes(self):
+        for user, url, accept in self.requests():
+            # Start from a cold permission cache so its query is checked too
+            cache.clear()
+            self.client.force_login(user)
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url, HTTP_ACCEPT=accept)
+                if response.streaming:
+                    b''.join(response.streaming_content)
+            self.assertEqual(response.status_code, status.HTTP_200_OK, url)
+
+            for query in queries:
+                if not query['sql'].startswith('SELECT') or 'accounts_' not in query['sql']:
+                    continue
+                plan = self.explain(query['sql'])
+                with self.subTest(url=url, sql=query['sql']):
+                    self.assertFalse([step for step in plan if self.bad_steps.search(step)], plan)
+
+    def test_check_catches_a_missing_index(self):
+        sql = str(Transaction.objects.filter(amount=1).order_by('-timestamp').query)
+        self.assertTrue(any(self.bad_steps.search(step) for step in self.explain(sql)))
+
+class AdminChangelistTests(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.admin = User.objects.create_superuser(username='admin', password='password')
+        self.client.force_login(self.admin)
+
+    def add_transactions(self, *timestamps):
+        account = InvestmentAccount.objects.create(name=f'Account {InvestmentAccount.objects.count()}')
+        Transaction.objects.bulk_create(
+            Transaction(account=account, user=self.user, amount=1, timestamp=timestamp)
+            for timestamp in timestamps
+        )
+        return account
+
+    def changelist(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response, len(queries)
+
+    def test_queries_do_not_grow_with_rows(self):
+        for url in ('/admin/accounts/transaction/', '/admin/accounts/accountpermission/'):
+            _, before = self.changelist(url)
+            for index in range(10):
+                account = self.add_transactions(*[timezone.now()] * 3)
+                AccountPermission.objects.create(user=User.objects.create(username=f'{url}-{index}'), account=account, permission='view')
+            response, after = self.changelist(url)
+            self.assertEqual(after, before, url)
+            self.assertIn('Account 9', response.content.decode())
+
+    def test_counts_stop_at_the_limit(self):
+        account = self.add_transactions(*[timezone.now()] * 9)
+        with override_settings(ACCOUNTS_ADMIN_COUNT_LIMIT=5):
+            response, _ = self.changelist('/admin/accounts/transaction/')
+            self.assertEqual(response.context['cl'].result_count, 5)
+            self.assertIsNone(response.context['cl'].full_result_count)
+            response, _ = self.changelist(f'/admin/accounts/transaction/?account__id__exact={self.account.id}')
+            self.assertEqual(response.context['cl'].result_count, 1)
+        response, _ = self.changelist(f'/admin/accounts/transaction/?account__id__exact={account.id}')
+        self.assertEqual(response.context['cl'].result_count, 9)
+
+    def test_date_hierarchy_matches_a_full_scan(self):
+        self.add_transactions(*(timezone.make_aware(timezone.datetime(*moment)) for moment in (
+            (2023, 5, 4, 10), (2024, 1, 31, 23, 59, 59), (2024, 3, 2), (2024, 3, 15, 12), (2024, 3, 15, 18),
+        )))
+        queryset = self.client.get('/admin/accounts/transaction/').context['cl'].queryset
+        march = queryset.filter(timestamp__gte='2024-03-01T00:00:00Z', timestamp__lt='2024-04-01T00:00:00Z')
+        for kind, rows in (('year', queryset), ('month', queryset.filter(timestamp__year=2024)), ('day', march)):
+            for order in ('ASC', 'DESC'):
+                self.assertEqual(rows.datetimes('timestamp', kind, order), list(models.QuerySet.datetimes(rows, 'timestamp', kind, order)), (kind, order))
+        self.assertEqual(queryset.aggregate(first=models.Min('timestamp'), last=models.Max('timestamp')), Transaction.objects.aggregate(first=models.Min('timestamp'), last=models.Max('timestamp')))
+
+        response, _ = self.changelist('/admin/accounts/transaction/?timestamp__year=2024&timestamp__month=3')
+        self.assertEqual(response.context['cl'].result_count, 3)
+        self.assertIn('timestamp__day=15', response.content.decode())
+
+    def test_change_form_uses_raw_id_widgets(self):
+        response = self.client.get(f'/admin/accounts/transaction/{self.transaction.id}/change/')
+        self.assertContains(response, 'vForeignKeyRawIdAdminField', count=2)
+
+    def test_benchmark_leaves_data_alone(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, 'results.json')
+            call_command('benchmark_admin', sizes='5,20', requests=1, output=output, stdout=io.StringIO())
+            with open(output) as results:
+                report = json.load(results)
+
+        self.assertEqual({result['rows'] for result in report['results']}, {5, 20})
+        self.assertEqual(Transaction.objects.count(), 1)
+        self.assertFalse(User.objects.filter(username='admin-benchmark').exists())
+
+class TransactionArchiveTests(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.admin = User.objects.create_superuser(username='admin', password='password')
+        for month in range(1, 7):
+            Transaction.objects.create(
+                account=self.account, user=self.user, amount=month,
+                timestamp=timezone.make_aware(timezone.datetime(2020, month, 15)),
+            )
+        Transaction.objects.create(account=self.account, user=self.user, amount=50)
+        self.expected = list(Transaction.objects.order_by('-timestamp', '-id').values_list('id', flat=True))
+        self.balance = ledger.account_balance(self.account.id)
+        call_command('archive_transactions', before='2020-04-20', stdout=io.StringIO())
+
+    def walk(self, url, key):
+        ids = []
+        while url:
+            response = self.client.get(url, HTTP_ACCEPT='application/json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            ids.extend(row['id'] for row in response.json()[key])
+            url = response.json()['next']
+        return ids
+
+    def test_whole_months_before_the_cutoff_are_moved(self):
+        self.assertEqual(ArchivedTransaction.objects.count(), 3)
+        self.assertFalse(Transaction.objects.filter(timestamp__year=2020, timestamp__month__lt=4).exists())
+        self.assertEqual(list(ArchivedPeriod.objects.order_by('start').values_list('transaction_count', flat=True)), [1, 1, 1])
+        self.assertEqual(ledger.account_balance(self.account.id), self.balance)
+
+        ledger.rebuild()
+        ledger.rebuild_rollups()
+        self.assertEqual(ledger.account_balance(self.account.id), self.balance)
+
+    def test_list_pages_across_the_archive(self):
+        self.authenticate_user('testuser', 'password')
+        self.assertEqual(self.walk('/api/transactions/?page_size=2', 'results'), self.expected)
+
+        archived = ArchivedTransaction.objects.first()
+        response = self.client.get(f'/api/transactions/{archived.id}/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['amount'], '1.00')
+        response = self.client.delete(f'/api/transactions/{archived.id}/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_recent_reads_do_not_touch_the_archive(self):
+        self.authenticate_user('testuser', 'password')
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get('/api/transactions/?page_size=1')
+        self.assertFalse([query for query in queries if 'accounts_archivedtransaction' in query['sql']])
+
+        self.client.force_login(self.admin)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/admin-transactions/', {'user_id': self.user.id, 'start_date': '2020-05-01T00:00:00Z'})
+        self.assertEqual(response.data['total_balance'], Decimal('161.00'))
+        self.assertFalse([query for query in queries if 'accounts_archivedtransaction' in query['sql']])
+
+    def test_admin_report_accepts_naive_dates(self):
+        self.client.force_login(self.admin)
+        params = f'user_id={self.user.id}&start_date=2020-02-01T00:00:00&end_date=2020-05-31T00:00:00'
+        response = self.client.get(f'/api/admin-transactions/?{params}')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['total_balance'], Decimal('14.00'))
+        response = self.client.get(f'/api/admin-transactions/?{params}&format=ndjson')
+        self.assertEqual(len(b''.join(response.streaming_content).splitlines()), 5)
+
+    def test_admin_report_and_export_include_archived_rows(self):
+        self.client.force_login(self.admin)
+        params = f'user_id={self.user.id}&start_date=2020-02-01T00:00:00Z&end_date=2020-05-31T00:00:00Z'
+        response = self.client.get(f'/api/admin-transactions/?{params}')
+        self.assertEqual(response.data['total_balance'], Decimal('14.00'))
+        self.assertEqual(len(self.walk(f'/api/admin-transactions/?{params}&page_size=1', 'transactions')), 4)
+
+        response = self.client.get(f'/api/admin-transactions/?user_id={self.user.id}&format=ndjson')
+        lines = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual([line['id'] for line in lines[:-1]], self.expected[::-1])
+        self.assertEqual(lines[-1], {'total_balance': str(self.balance)})
+
+class BatchAdminReportTests(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.admin = User.objects.create_superuser(username='admin', password='password')
+        self.other = User.objects.create_user(username='other', password='password', email='other@example.com')
+        self.second = InvestmentAccount.objects.create(name='Second Account')
+        for user, account, amount, day in (
+            (self.user, self.second, 20, 10), (self.other, self.account, 7, 11),
+            (self.other, self.second, 3, 12), (self.other, self.second, 4, 20),
+        ):
+            Transaction.objects.create(user=user, account=account, amount=amount, timestamp=timezone.make_aware(timezone.datetime(2024, 1, day)))
+        self.client.force_login(self.admin)
+
+    def test_groups_totals_by_user_and_account(self):
+        response = self.client.get('/api/admin-transactions/batch/', {'user_ids': [self.user.id, self.other.id]})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['transaction_count'], 5)
+        self.assertEqual(response.data['total_balance'], Decimal('134'))
+
+        user, other = response.data['users']
+        self.assertEqual(user['user'], {'id': self.user.id, 'username': 'testuser', 'email': ''})
+        self.assertEqual(user['total_balance'], Decimal('120'))
+        self.assertEqual([account['account'] for account in user['accounts']], [self.account.id, self.second.id])
+        self.assertEqual(other['accounts'][1], {'account': self.second.id, 'total_balance': Decimal('7'), 'transaction_count': 2})
+        self.assertEqual([row['amount'] for row in other['transactions']], ['4.00', '3.00', '7.00'])
+
+    def test_accounts_and_dates_narrow_the_report(self):
+        response = self.client.post('/api/admin-transactions/batch/', {
+            'account_ids': [self.second.id], 'start_date': '2024-01-11T00:00:00Z', 'end_date': '2024-01-31T00:00:00Z',
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([user['user']['id'] for user in response.data['users']], [self.other.id])
+        self.assertEqual(response.data['total_balance'], Decimal('7'))
+
+    def test_query_count_does_not_grow_with_users(self):
+        def count(user_ids):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get('/api/admin-transactions/batch/', {'user_ids': user_ids, 'start_date': '2000-01-01T00:00:00Z'})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            return len(queries)
+
+        self.assertEqual(count([self.user.id]), count([self.user.id, self.other.id, 999]))
+
+    def test_requires_ids_and_staff(self):
+        response = self.client.get('/api/admin-transactions/batch/')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        self.client.force_login(self.user)
+        response = self.client.get('/api/admin-transactions/batch/', {'user_ids': [self.user.id]})
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+class InlineExecutor(Executor):
+    """Runs each job as it is submitted, on this test's database connection."""
+
+    def submit(self, function, *args, **kwargs):
+        future = Future()
+        future.set_result(function(*args, **kwargs))
+        return future
+
+class ReportJobTests(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        results = tempfile.TemporaryDirectory()
+        self.addCleanup(results.cleanup)
+        overrides = override_settings(ACCOUNTS_JOB_RESULTS_DIR=results.name)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        self.admin = User.objects.create_superuser(username='admin', password='password')
+        self.client.force_login(self.admin)
+
+    def enqueue(self, kind, **params):
+        return self.client.post('/api/jobs/', {'kind': kind, 'params': params}, format='json')
+
+    def work(self):
+        call_command('run_jobs', once=True, processes=0, stdout=io.StringIO())
+
+    def test_export_job_matches_the_streamed_export(self):
+        response = self.enqueue('export', user_id=self.user.id, format='ndjson')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response['Location'], response.data['url'])
+        job_url = response.data['url']
+        self.assertEqual(self.client.get(f'{job_url}result/').status_code, status.HTTP_409_CONFLICT)
+
+        self.work()
+        job = self.client.get(job_url).data
+        self.assertEqual((job['status'], job['attempts']), ('succeeded', 1))
+        result = self.client.get(job['result'])
+        self.assertEqual(result['Content-Type'], 'application/x-ndjson; charset=utf-8')
+        streamed = self.client.get(f'/api/admin-transactions/?user_id={self.user.id}&format=ndjson')
+        self.assertEqual(b''.join(result.streaming_content), b''.join(streamed.streaming_content))
+
+    def test_batch_report_job_has_no_row_limit(self):
+        Transaction.objects.create(account=self.account, user=self.user, amount=5)
+        with mock.patch.object(AdminTransactionViewSet, 'batch_max_rows', 1):
+            response = self.client.get('/api/admin-transactions/batch/', {'user_ids': [self.user.id]})
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.enqueue('batch-report', user_ids=[self.user.id])
+            self.work()
+        job = ReportJob.objects.get()
+        self.assertEqual(job.status, 'succeeded')
+        with open(jobs.get_result_path(job)) as result:
+            report = json.load(result)
+        self.assertEqual((report['transaction_count'], report['total_balance']), (2, 105.0))
+
+    def test_invalid_jobs_and_other_users_are_rejected(self):
+        self.assertEqual(self.enqueue('export', user_id=self.user.id, start_date='soon').status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.enqueue('export', user_id=self.user.id, format='xml').status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.enqueue('batch-report').status_code, status.HTTP_400_BAD_REQUEST)
+        job_url = self.enqueue('export', user_id=self.user.id).data['url']
+
+        User.objects.create_superuser(username='other-admin', password='password')
+        self.authenticate_user('other-admin', 'password')
+        self.assertEqual(self.client.get(job_url).status_code, status.HTTP_404_NOT_FOUND)
+        self.authenticate_user('testuser', 'password')
+        self.assertEqual(self.client.get('/api/jobs/').status_code, status.HTTP_403_FORBIDDEN)
+
+    @override_settings(ACCOUNTS_JOB_MAX_ATTEMPTS=2, ACCOUNTS_JOB_RETRY_SECONDS=60)
+    def test_failed_jobs_are_retried_with_backoff_then_failed(self):
+        self.enqueue('export', user_id=self.user.id)
+        with mock.patch('accounts.reports.run_export_job', side_effect=RuntimeError('disk full')):
+            self.work()
+            job = ReportJob.objects.get()
+            self.assertEqual((job.status, job.attempts, job.error), ('queued', 1, 'RuntimeError: disk full'))
+            self.assertGreater(job.run_after, timezone.now() + timezone.timedelta(seconds=50))
+
+            # Not due yet
+            self.work()
+            self.assertEqual(ReportJob.objects.get().attempts, 1)
+
+            ReportJob.objects.update(run_after=timezone.now())
+            self.work()
+        job = ReportJob.objects.get()
+        self.assertEqual((job.status, job.attempts), ('failed', 2))
+        self.assertEqual(os.listdir(jobs.get_results_dir()), [])
+
+    def test_jobs_of_a_lost_worker_are_requeued(self):
+        job = jobs.enqueue('export', self.user, {'user_id': self.user.id})
+        self.assertEqual(jobs.claim('gone'), [job.pk])
+        ReportJob.objects.update(locked_until=timezone.now() - timezone.timedelta(seconds=1))
+        self.work()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts, job.error), ('queued', 1, 'The worker running the job stopped.'))
+
+    @override_settings(ACCOUNTS_JOB_LEASE_SECONDS=0.15)
+    def test_inline_runs_renew_the_lease(self):
+        self.enqueue('export', user_id=self.user.id)
+        run_export_job = reports.run_export_job
+
+        def slow_export(params, output):
+            time.sleep(0.3)
+            return run_export_job(params, output)
+
+        with mock.patch('accounts.reports.run_export_job', side_effect=slow_export), mock.patch('accounts.jobs.renew') as renew:
+            self.work()
+        job = ReportJob.objects.get()
+        self.assertEqual(job.status, 'succeeded')
+        self.assertGreaterEqual(renew.call_count, 2)
+        renew.assert_called_with(jobs.worker_name(), [job.pk])
+
+    def test_pool_runs_jobs_and_shuts_down(self):
+        for _ in range(2):
+            self.enqueue('export', user_id=self.user.id)
+        pool = InlineExecutor()
+        with mock.patch('accounts.management.commands.run_jobs.Command.start_pool', return_value=pool), \
+                mock.patch.object(pool, 'shutdown', wraps=pool.shutdown) as shutdown:
+            call_command('run_jobs', once=True, processes=2, poll_interval=0, stdout=io.StringIO())
+        self.assertEqual(list(ReportJob.objects.values_list('status', flat=True)), ['succeeded', 'succeeded'])
+        shutdown.assert_called_once_with(wait=False)
+
+    @override_settings(ACCOUNTS_JOB_CONCURRENCY=1, ACCOUNTS_JOB_USER_LIMIT=2)
+    def test_concurrency_and_per_user_limits(self):
+        for _ in range(2):
+            self.assertEqual(self.enqueue('export', user_id=self.user.id).status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(self.enqueue('export', user_id=self.user.id).status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+
+        first, second = ReportJob.objects.order_by('pk').values_list('pk', flat=True)
+        self.assertEqual(jobs.claim('one', limit=2), [first])
+        self.assertEqual(jobs.claim('two'), [])
+        self.assertEqual(ReportJob.objects.get(pk=second).attempts, 0)
+
+@override_settings(ACCOUNTS_DATABASE_REPLICAS=['replica'])
+class ReplicaRoutingTests(BaseTestCase):
+    """Records where the router would send each read, while still running it on the primary."""
+
+    def setUp(self):
+        super().setUp()
+        self.authenticate_user('testuser', 'password')
+        self.reads = []
+        route = ReplicaRouter.db_for_read
+
+        def record(router, model, **hints):
+            self.reads.append((model, route(router, model, **hints)))
+
+        patcher = mock.patch.object(ReplicaRouter, 'db_for_read', autospec=True, side_effect=record)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def replica_models(self):
+        return {model for model, alias in self.reads if alias == 'replica'}
+
+    def test_view_reads_go_to_replica_but_session_and_permissions_do_not(self):
+        response = self.client.get('/api/transactions/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn(Transaction, self.replica_models())
+        self.assertNotIn(User, self.replica_models())
+        self.assertNotIn(AccountPermission, {model for model, alias in self.reads})
+
+    def test_writes_read_their_own_writes_and_pin_the_client(self):
+        response = self.client.post('/api/transactions/', {'account': self.account.id, 'amount': 5})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.replica_models(), set())
+        self.assertIn(PRIMARY_COOKIE, response.cookies)
+
+        self.reads.clear()
+        self.client.get('/api/transactions/')
+        self.assertEqual(self.replica_models(), set())
+
+        self.client.cookies.pop(PRIMARY_COOKIE)
+        self.client.get('/api/transactions/')
+        self.assertIn(Transaction, self.replica_models())
+
+    def test_header_pins_request_to_primary(self):
+        self.client.get('/api/accounts/', headers={PIN_HEADER: '1'})
+        self.assertEqual(self.replica_models(), set())
+
+    def test_export_streams_from_replica(self):
+        admin = User.objects.create_superuser(username='admin', password='password')
+        self.client.force_login(admin)
+        response = self.client.get(f'/api/admin-transactions/?user_id={self.user.id}&format=ndjson')
+        self.reads.clear()
+        b''.join(response.streaming_content)
+        self.assertEqual(self.reads, [])
+
+
+@skipUnless('replica' in settings.DATABASES, 'Set ACCOUNTS_REPLICA_DB to run against a replica alias.')
+@override_settings(ACCOUNTS_DATABASE_REPLICAS=['replica'])
+class ReplicaDatabaseTests(APITransactionTestCase):
+    # Rows must be committed for the replica connection to see them
+    databases = {'default', 'replica'} & set(settings.DATABASES)
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='testuser', password='password')
+        account = InvestmentAccount.objects.create(name='Test Account')
+        AccountPermission.objects.create(user=self.user, account=account, permission='crud')
+        Transaction.objects.create(account=account, user=self.user, amount=100)
+
+    def test_reads_run_on_replica_connection(self):
+        self.client.force_login(self.user)
+        with CaptureQueriesContext(connections['replica']) as queries:
+            response = self.client.get('/api/transactions/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['results']), 1)
+        self.assertTrue(any('accounts_transaction' in query['sql'] for query in queries))
+
+
+class ShardRoutingTests(BaseTestCase):
+    shards = ['default', 'east', 'west']
+
+    def test_accounts_spread_evenly_and_stably(self):
+        with override_settings(ACCOUNTS_SHARDS=self.shards):
+            placements = [sharding.shard_for(account_id) for account_id in range(1, 3001)]
+            self.assertEqual(placements, [sharding.shard_for(str(account_id)) for account_id in range(1, 3001)])
+        for alias in self.shards:
+            self.assertGreater(placements.count(alias), 800)
+
+    def test_router_sends_account_data_to_its_shard(self):
+        router = ShardRouter()
+        self.assertIsNone(router.db_for_read(Transaction))
+
+        with override_settings(ACCOUNTS_SHARDS=self.shards):
+            self.assertEqual(router.db_for_read(User), 'default')
+            self.assertEqual(router.db_for_read(Transaction), 'default')
+            with sharding.pinned('west'):
+                self.assertEqual(router.db_for_write(AccountBalance), 'west')
+                self.assertEqual(router.db_for_read(User, instance=self.transaction), 'default')
+            unsaved = Transaction(account_id=7, user=self.user, amount=1)
+            self.assertEqual(router.db_for_write(Transaction, instance=unsaved), sharding.shard_for(7))
+
+            self.assertIsNone(router.allow_migrate('default', 'auth', 'user'))
+            self.assertTrue(router.allow_migrate('east', 'accounts', 'transaction'))
+            self.assertFalse(router.allow_migrate('east', 'accounts', 'shardsequence'))
+            self.assertFalse(router.allow_migrate('east', 'auth', 'user'))
+            self.assertFalse(router.allow_migrate('east', 'accounts'))
+
+    def test_ids_come_from_blocks_above_existing_rows(self):
+        with mock.patch.dict(sharding._blocks, clear=True), override_settings(ACCOUNTS_SHARD_ID_BLOCK=10):
+            first = sharding.allocate_ids(Transaction, 3)
+            self.assertEqual(first, [self.transaction.id + 1, self.transaction.id + 2, self.transaction.id + 3])
+            with self.assertNumQueries(0):
+                self.assertEqual(sharding.allocate_ids(Transaction), [self.transaction.id + 4])
+            self.assertEqual(sharding.allocate_ids(Transaction, 20)[0], self.transaction.id + 11)
+            self.assertEqual(ShardSequence.objects.get(name='accounts.transaction').last_id, self.transaction.id + 30)
+
+
+@skipUnless(len(settings.ACCOUNTS_SHARDS) > 1, 'Set ACCOUNTS_SHARD_DBS to run against several shards.')
+class ShardedApiTests(APITransactionTestCase):
+    # Shards are read from worker threads, which only see committed rows
+    databases = set(settings.ACCOUNTS_SHARDS)
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='testuser', password='password', email='test@example.com')
+        self.admin = User.objects.create_superuser(username='admin', password='password')
+        # One account on every shard
+        self.accounts = {}
+        while len(self.accounts) < len(sharding.get_shards()):
+            account_id = sharding.new_account_id()
+            alias = sharding.shard_for(account_id)
+            if alias not in self.accounts:
+                with sharding.pinned(alias):
+                    account = InvestmentAccount.objects.create(id=account_id, name=f'Account on {alias}')
+                    AccountPermission.objects.create(user=self.user, account=account, permission='crud')
+                self.accounts[alias] = account
+        self.client.force_login(self.user)
+
+    def post(self, account, amount, day):
+        with sharding.pinned(sharding.shard_for(account.id)):
+            return Transaction.objects.create(
+                account=account, user=self.user, amount=amount, timestamp=timezone.make_aware(timezone.datetime(2024, 1, day)),
+            )
+
+    def test_writes_land_on_the_account_shard(self):
+        ids = set()
+        for alias, account in self.accounts.items():
+            response = self.client.post('/api/transactions/', {'account': account.id, 'amount': '12.50'})
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            ids.add(response.data['id'])
+            self.assertEqual(response.data['user']['username'], 'testuser')
+            for other in sharding.get_shards():
+                self.assertEqual(Transaction.objects.using(other).filter(pk=response.data['id']).exists(), other == alias)
+            self.assertEqual(AccountBalance.objects.using(alias).get(account=account).balance, Decimal('12.50'))
+        self.assertEqual(len(ids), len(self.accounts))
+
+        response = self.client.post('/api/accounts/', {'name': 'New'})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        alias = sharding.shard_for(response.data['id'])
+        self.assertTrue(AccountBalance.objects.using(alias).filter(account_id=response.data['id']).exists())
+
+    def test_lists_merge_shards_in_timestamp_order(self):
+        transactions = [self.post(account, day, day) for day, account in enumerate(list(self.accounts.values()) * 3, start=1)]
+        expected = [transaction.id for transaction in sorted(transactions, key=lambda row: (row.timestamp, row.id), reverse=True)]
+
+        seen, url = [], '/api/transactions/?page_size=2'
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            seen += [row['id'] for row in response.data['results']]
+            url = response.data['next']
+        self.assertEqual(seen, expected)
+        self.assertEqual(response.data['results'][0]['user']['email'], 'test@example.com')
+
+        response = self.client.get('/api/transactions/?page_size=20', HTTP_ACCEPT='application/vnd.accounts.columns+json')
+        self.assertEqual(response.data['results']['id'], expected)
+        self.assertEqual(response.data['results']['users'], [{'id': self.user.id, 'username': 'testuser', 'email': 'test@example.com'}])
+
+        response = self.client.get('/api/accounts/')
+        self.assertEqual(sorted(account['id'] for account in response.data), sorted(account.id for account in self.accounts.values()))
+        self.assertEqual(response.data[0]['permissions'][0]['user']['username'], 'testuser')
+        self.assertEqual(sum(Decimal(account['balance']) for account in response.data), sum(Decimal(day) for day in range(1, len(transactions) + 1)))
+
+        etag = response['ETag']
+        self.assertEqual(self.client.get('/api/accounts/', HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_304_NOT_MODIFIED)
+        self.post(self.accounts[sharding.get_shards()[-1]], 1, 1)
+        self.assertEqual(self.client.get('/api/accounts/', HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_200_OK)
+
+    def test_detail_update_and_delete_on_every_shard(self):
+        for alias, account in self.accounts.items():
+            transaction = self.post(account, 10, 5)
+            response = self.client.get(f'/api/transactions/{transaction.id}/')
+            self.assertEqual(response.data['amount'], '10.00')
+            response = self.client.put(f'/api/transactions/{transaction.id}/', {'account': account.id, 'amount': '4.00'})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(ledger.account_balance(account.id), Decimal('4.00'))
+
+            response = self.client.get(f'/api/accounts/{account.id}/rollups/')
+            self.assertEqual(response.data['results'][0]['total'], '4.00')
+            self.assertEqual(self.client.delete(f'/api/transactions/{transaction.id}/').status_code, status.HTTP_204_NO_CONTENT)
+            self.assertEqual(ledger.account_balance(account.id), Decimal('0.00'))
+
+    def test_bulk_spans_shards(self):
+        rows = [{'account': account.id, 'amount': '2.00'} for account in self.accounts.values()] * 2
+        response = self.client.post('/api/transactions/bulk/', rows, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len({row['id'] for row in response.data['results']}), len(rows))
+        for alias, account in self.accounts.items():
+            self.assertEqual(Transaction.objects.using(alias).filter(account=account).count(), 2)
+            self.assertEqual(ledger.account_balance(account.id), Decimal('4.00'))
+
+    def test_change_feed_resumes_on_every_shard(self):
+        cursor = parse_events(b''.join(self.client.get('/api/transactions/events/').streaming_content))[0]['id']
+        self.assertEqual(len(cursor.split('.')), len(sharding.get_shards()))
+        created = [self.post(account, 5, 1).id for account in self.accounts.values()]
+
+        response = self.client.get('/api/transactions/events/', HTTP_LAST_EVENT_ID=cursor)
+        missed = parse_events(b''.join(response.streaming_content))
+        self.assertEqual(sorted(event['data']['id'] for event in missed), sorted(created))
+        response = self.client.get('/api/transactions/events/', HTTP_LAST_EVENT_ID=missed[-1]['id'])
+        self.assertEqual(parse_events(b''.join(response.streaming_content)), [{'id': missed[-1]['id']}])
+
+    def test_bulk_permissions_span_shards(self):
+        other = User.objects.create_user(username='other', password='password')
+        account_ids = [account.id for account in self.accounts.values()]
+        self.client.force_login(self.admin)
+        response = self.client.post('/api/admin-permissions/bulk/', {
+            'grant': [{'users': [other.id], 'accounts': account_ids, 'permission': 'view'}],
+            'revoke': [{'users': [self.user.id], 'accounts': account_ids}],
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['created']), len(account_ids))
+        self.assertEqual(len(response.data['revoked']), len(account_ids))
+        for alias, account in self.accounts.items():
+            grants = AccountPermission.objects.using(alias).filter(account=account)
+            self.assertEqual(list(grants.values_list('user_id', 'permission')), [(other.id, 'view')])
+
+    def test_admin_reports_combine_shards(self):
+        for day, account in enumerate(self.accounts.values(), start=1):
+            self.post(account, 10 * day, day)
+        expected_total = sum(10 * day for day in range(1, len(self.accounts) + 1))
+        self.client.force_login(self.admin)
+
+        response = self.client.get(f'/api/admin-transactions/?user_id={self.user.id}')
+        self.assertEqual(response.data['total_balance'], expected_total)
+        self.assertEqual([row['account'] for row in response.data['transactions']], [account.id for account in reversed(self.accounts.values())])
+        response = self.client.get(f'/api/admin-transactions/?user_id={self.user.id}&start_date=2024-01-02T00:00:00Z')
+        self.assertEqual(response.data['total_balance'], expected_total - 10)
+
+        response = self.client.get(f'/api/admin-transactions/?user_id={self.user.id}&format=ndjson')
+        lines = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual([line['account'] for line in lines[:-1]], [account.id for account in self.accounts.values()])
+        self.assertEqual(Decimal(lines[-1]['total_balance']), expected_total)
+
+        response = self.client.get('/api/admin-transactions/batch/', {'user_ids': [self.user.id]})
+        self.assertEqual(response.data['total_balance'], expected_total)
+        self.assertEqual(response.data['users'][0]['user']['username'], 'testuser')
+        self.assertEqual(len(response.data['users'][0]['accounts']), len(self.accounts))
+
+    def test_deleting_a_user_clears_every_shard(self):
+        leaver = User.objects.create_user(username='leaver', password='password')
+        for day, account in enumerate(self.accounts.values(), start=1):
+            self.post(account, 10, day)
+            with sharding.pinned(sharding.shard_for(account.id)):
+                AccountPermission.objects.create(user=leaver, account=account, permission='crud')
+                Transaction.objects.create(account=account, user=leaver, amount=5)
+
+        leaver.delete()
+        for alias, account in self.accounts.items():
+            for model in (AccountPermission, Transaction, AccountUserBalance, TransactionRollup, TransactionEvent):
+                self.assertFalse(model.objects.using(alias).filter(user_id=leaver.id).exists(), (alias, model))
+            self.assertEqual(ledger.account_balance(account.id), Decimal('10.00'))
+        self.assertEqual(ledger.user_balance(leaver.id), 0)
+        self.assertEqual(ledger.user_balance(self.user.id), 10 * len(self.accounts))
+
+    def test_rebuild_and_archive_cover_every_shard(self):
+        for account in self.accounts.values():
+            self.post(account, 5, 1)
+        AccountBalance.objects.using(sharding.get_shards()[-1]).update(balance=0)
+        self.assertEqual(ledger.rebuild(), len(self.accounts))
+        self.assertEqual(ledger.user_balance(self.user.id), 5 * len(self.accounts))
+
+        self.assertEqual(archive.archive_before(timezone.make_aware(timezone.datetime(2024, 3, 1))), len(self.accounts))
+        self.assertIsNotNone(archive.get_horizon())
+        response = self.client.get('/api/transactions/')
+        self.assertEqual(len(response.data['results']), len(self.accounts))
+
+        self.assertEqual(ledger.checkpoint(), len(self.accounts))
+        for alias, account in self.accounts.items():
+            self.assertEqual(BalanceCheckpoint.objects.using(alias).get(account=account).balance, Decimal('5.00'))
+            response = self.client.get(f'/api/accounts/{account.id}/balance/', {'as_of': '2024-02-01'})
+            self.assertEqual(response.data['balance'], '5.00')
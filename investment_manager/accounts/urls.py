@@ -1,12 +1,30 @@
+from django.conf import settings
 from rest_framework.routers import DefaultRouter
 from django.urls import path, include
-from .views import InvestmentAccountViewSet, TransactionViewSet, AdminTransactionViewSet
+from . import async_views
+from .views import InvestmentAccountViewSet, TransactionViewSet, AdminTransactionViewSet, BulkPermissionView, MetricsView, ReportJobViewSet
 
 router = DefaultRouter()
 router.register(r'accounts', InvestmentAccountViewSet, basename='account')
 router.register(r'transactions', TransactionViewSet, basename='transaction')
+router.register(r'jobs', ReportJobViewSet, basename='job')
 
-urlpatterns = [
+sync_urlpatterns = [
+    # Ahead of the router, whose detail route would take "events" for a pk
+    path('transactions/events/', async_views.transaction_events, name='transaction-events'),
     path('', include(router.urls)),
-    path('admin-transactions/', AdminTransactionViewSet.as_view({'get': 'list_user_transactions'})),
+    path('admin-transactions/', AdminTransactionViewSet.as_view({'get': 'list_user_transactions'}), name='admin-transactions'),
+    path('admin-transactions/batch/', AdminTransactionViewSet.as_view({'get': 'batch_report', 'post': 'batch_report'}), name='admin-transactions-batch'),
+    path('admin-permissions/bulk/', BulkPermissionView.as_view(), name='admin-permissions-bulk'),
+    path('metrics/', MetricsView.as_view(), name='metrics'),
 ]
+
+# Async reads shadow the matching sync routes when enabled, under the same
+# names so reversing URLs and per-route metrics do not depend on the mode
+async_urlpatterns = [
+    path('transactions/', async_views.transaction_collection, name='transaction-list'),
+    path('transactions/<int:pk>/', async_views.transaction_member, name='transaction-detail'),
+    path('admin-transactions/', async_views.admin_transactions, name='admin-transactions'),
+]
+
+urlpatterns = (async_urlpatterns if settings.ACCOUNTS_ASYNC_VIEWS else []) + sync_urlpatterns
@@ -1,76 +1,454 @@
-from rest_framework import viewsets, status
-from rest_framework.permissions import IsAuthenticated, IsAdminUser
+from contextlib import ExitStack
+from datetime import datetime, time
+from collections.abc import Mapping
+from itertools import chain
+from operator import attrgetter
+
+from rest_framework import mixins, viewsets, status
+from rest_framework.generics import get_object_or_404
+from rest_framework.permissions import SAFE_METHODS, IsAuthenticated, IsAdminUser
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.exceptions import PermissionDenied
-from django.utils.dateparse import parse_datetime
-from django.db import models
-from .models import InvestmentAccount, Transaction, AccountPermission
-from .serializers import InvestmentAccountSerializer, TransactionSerializer
-from .permissions import HasAccountPermission
+from rest_framework.parsers import JSONParser
+from rest_framework.settings import api_settings
+from rest_framework.views import APIView
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.http import FileResponse, Http404, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from django.db import models, transaction
+from django.db.models import Prefetch
+from . import archive, events, jobs, ledger, metrics, reports, sharding
+from .models import InvestmentAccount, Transaction, AccountPermission, ArchivedTransaction, ReportJob, TransactionRollup
+from .serializers import InvestmentAccountSerializer, TransactionSerializer, TransactionIngestSerializer, RollupBucketSerializer, BalanceAsOfSerializer, BatchReportSerializer, BulkPermissionSerializer, ReportJobSerializer
+from .row_serializers import InvestmentAccountRowSerializer, TransactionRowSerializer
+from .conditional import AccountVersionConditionalMixin
+from .db_routers import ReplicaReadMixin
+from .pagination import KeysetPagination
+from .parsers import ColumnarParser, NDJSONParser
+from .reports import archived_report_queryset, report_queryset
+from .permissions import HasAccountPermission, apply_permission_changes, get_account_permissions
+from .renderers import ColumnarRenderer, CSVRenderer, NDJSONRenderer, PrometheusRenderer, StreamingRenderer
+from .sharding import ShardPinMixin
+
+class RowSerializerListMixin:
+    """
+    Serve GET lists through ``row_serializer_class`` when the view sets one,
+    laid out by column when the client asked for ColumnarRenderer.
+    """
+    row_serializer_class = None
+
+    def list(self, request, *args, **kwargs):
+        if self.row_serializer_class is None:
+            return super().list(request, *args, **kwargs)
+
+        row_serializer = self.row_serializer_class()
+        serialize = row_serializer.serialize_columns if isinstance(request.accepted_renderer, ColumnarRenderer) else row_serializer.serialize
+        rows = row_serializer.select(self.filter_queryset(self.get_queryset()))
+        shards = self.get_list_shards()
+        if self.paginator is None:
+            return Response(serialize(chain.from_iterable(sharding.fan_out(lambda: list(rows.all()), shards))))
 
-class InvestmentAccountViewSet(viewsets.ModelViewSet):
+        horizon = self.get_archive_horizon()
+        archived = row_serializer.select(self.filter_queryset(self.get_archive_queryset())) if horizon is not None else None
+        page = self.paginator.paginate_queryset(rows, self.request, view=self, archive=archived, horizon=horizon, shards=shards)
+        return self.get_paginated_response(serialize(page))
+
+    def get_archive_horizon(self):
+        """Timestamp before which rows may live in ``get_archive_queryset()``, or None."""
+        return None
+
+    def get_list_shards(self):
+        """The shards a sharded list reads from; None for all of them."""
+        return None
+
+class InvestmentAccountViewSet(ShardPinMixin, ReplicaReadMixin, AccountVersionConditionalMixin, RowSerializerListMixin, viewsets.ModelViewSet):
     queryset = InvestmentAccount.objects.all()
     serializer_class = InvestmentAccountSerializer
+    row_serializer_class = InvestmentAccountRowSerializer
     permission_classes = [IsAuthenticated, HasAccountPermission]
 
+    def perform_create(self, serializer):
+        if not sharding.is_sharded():
+            return super().perform_create(serializer)
+        # The id decides the shard, so it is taken before the row is written
+        account_id = sharding.new_account_id()
+        with sharding.pinned(sharding.shard_for(account_id)):
+            serializer.save(id=account_id)
+
     def get_queryset(self):
-        return self.queryset.filter(users=self.request.user)
+        grants = sharding.select_user(AccountPermission.objects.all())
+        return (
+            self.queryset.filter(pk__in=get_account_permissions(self.request))
+            .select_related('ledger')
+            .prefetch_related(Prefetch('accountpermission_set', queryset=grants))
+        )
+
+    def get_object_account_id(self, account_permissions):
+        try:
+            return int(self.kwargs['pk'])
+        except ValueError:
+            return None
+
+    def get_shard(self):
+        if 'pk' not in self.kwargs:
+            return None
+        account_id = self.get_object_account_id(None)
+        return sharding.shard_for(account_id) if account_id is not None else None
+
+    def get_list_shards(self):
+        return sharding.shards_for(get_account_permissions(self.request))
+
+    @action(detail=True, methods=['get'])
+    def rollups(self, request, pk=None):
+        """
+        Per-bucket totals for the account, answered from the rollup table.
+
+        Accepts ``granularity`` (day, week or month), inclusive ``start`` and
+        ``end`` dates and an optional ``user_id``.
+        """
+        account = self.get_object()
+        granularity = request.query_params.get('granularity', 'month')
+        if granularity not in ledger.ROLLUP_GRANULARITIES:
+            return Response({'error': 'Invalid granularity.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        rollups = TransactionRollup.objects.filter(account=account, granularity=granularity)
+
+        for param, lookup in (('start', 'bucket__gte'), ('end', 'bucket__lte')):
+            value = request.query_params.get(param)
+            if not value:
+                continue
+            try:
+                day = parse_date(value) or parse_datetime(value)
+            except ValueError:
+                day = None
+            if day is None:
+                return Response({'error': f'Invalid {param} date format.'}, status=status.HTTP_400_BAD_REQUEST)
+            rollups = rollups.filter(**{lookup: ledger.bucket_for(day, granularity)})
 
-class TransactionViewSet(viewsets.ModelViewSet):
+        user_id = request.query_params.get('user_id')
+        if user_id:
+            if not user_id.isdigit():
+                return Response({'error': 'Invalid user_id.'}, status=status.HTTP_400_BAD_REQUEST)
+            rollups = rollups.filter(user_id=int(user_id))
+
+        buckets = (
+            rollups.values('bucket')
+            .annotate(bucket_total=models.Sum('total'), bucket_count=models.Sum('transaction_count'))
+            .filter(bucket_count__gt=0)
+            .order_by('bucket')
+        )
+        return Response({'granularity': granularity, 'results': RollupBucketSerializer(buckets, many=True).data})
+
+    @action(detail=True, methods=['get'])
+    def balance(self, request, pk=None):
+        """
+        The account's balance over every transaction up to ``as_of`` (a
+        datetime, or a date for the end of that day; now by default),
+        answered from the nearest balance checkpoint.
+        """
+        account = self.get_object()
+        as_of = request.query_params.get('as_of')
+        if as_of:
+            try:
+                day = parse_date(as_of)
+                moment = parse_datetime(as_of) if day is None else timezone.make_aware(datetime.combine(day, time.max))
+            except ValueError:
+                moment = None
+            if moment is None:
+                return Response({'error': 'Invalid as_of date format.'}, status=status.HTTP_400_BAD_REQUEST)
+            if timezone.is_naive(moment):
+                moment = timezone.make_aware(moment)
+        else:
+            moment = timezone.now()
+
+        balance, transaction_count = ledger.balance_as_of(account.pk, moment)
+        return Response(BalanceAsOfSerializer({
+            'account': account.pk, 'as_of': moment, 'balance': balance, 'transaction_count': transaction_count,
+        }).data)
+
+class TransactionViewSet(ShardPinMixin, ReplicaReadMixin, AccountVersionConditionalMixin, RowSerializerListMixin, viewsets.ModelViewSet):
     queryset = Transaction.objects.all()
     serializer_class = TransactionSerializer
+    row_serializer_class = TransactionRowSerializer
     permission_classes = [IsAuthenticated, HasAccountPermission]
+    pagination_class = KeysetPagination
+    renderer_classes = api_settings.DEFAULT_RENDERER_CLASSES + [ColumnarRenderer]
+    bulk_max_rows = 50000
+    bulk_batch_size = 1000
 
     def perform_create(self, serializer):
         account = serializer.validated_data.get('account') 
         
-        try:
-            account_permission = AccountPermission.objects.get(user=self.request.user, account=account)
-        except AccountPermission.DoesNotExist:
+        permission = get_account_permissions(self.request).get(account.pk)
+        if permission is None:
             raise PermissionDenied("You do not have permission to create transactions.")
 
-        if account_permission.permission in ['crud', 'post']:
-            serializer.save(user=self.request.user)
+        if permission in ['crud', 'post']:
+            with sharding.atomic():
+                serializer.save(user=self.request.user)
         else:
             raise PermissionDenied("You do not have permission to create transactions.")
 
+    def perform_update(self, serializer):
+        # The ledger is adjusted from model signals; keep it in the same commit.
+        # Sharded, the request is pinned to the transaction's shard, so moving
+        # it to an account on another shard fails validation.
+        with sharding.atomic():
+            serializer.save()
+
+    def perform_destroy(self, instance):
+        with sharding.atomic():
+            instance.delete()
+
     def get_queryset(self):
-        return self.queryset.filter(account__users=self.request.user)
+        return sharding.select_user(self.queryset.filter(account_id__in=get_account_permissions(self.request)))
 
-    def list(self, request, *args, **kwargs):
-        queryset = self.get_queryset()
-        serializer = self.get_serializer(queryset, many=True)
-        return Response(serializer.data)
+    def get_shard(self):
+        if 'pk' in self.kwargs:
+            try:
+                pk = int(self.kwargs['pk'])
+            except ValueError:
+                return None
+            return sharding.locate(lambda: Transaction.objects.filter(pk=pk).exists() or ArchivedTransaction.objects.filter(pk=pk).exists())
+        if self.action == 'create' and isinstance(self.request.data, Mapping):
+            try:
+                return sharding.shard_for(self.request.data.get('account'))
+            except (TypeError, ValueError):
+                return None
+        return None
+
+    def get_list_shards(self):
+        return sharding.shards_for(get_account_permissions(self.request))
+
+    def get_object_account_id(self, account_permissions):
+        try:
+            return self.get_queryset().filter(pk=self.kwargs['pk']).values_list('account_id', flat=True).first()
+        except ValueError:
+            return None
+
+    def get_archive_horizon(self):
+        return archive.get_horizon()
+
+    def get_archive_queryset(self):
+        return sharding.select_user(ArchivedTransaction.objects.filter(account_id__in=get_account_permissions(self.request)))
+
+    def get_object(self):
+        try:
+            return super().get_object()
+        except Http404:
+            # Archived transactions can still be read, but not changed
+            if self.request.method not in SAFE_METHODS:
+                raise
+        instance = get_object_or_404(self.get_archive_queryset(), pk=self.kwargs['pk'])
+        self.check_object_permissions(self.request, instance)
+        return instance
 
-class AdminTransactionViewSet(viewsets.ViewSet):
+    @action(detail=False, methods=['post'], url_path='bulk', parser_classes=[JSONParser, NDJSONParser, ColumnarParser])
+    def bulk(self, request):
+        """
+        Create many transactions at once from a JSON array, NDJSON or
+        columnar body (see ColumnarParser).
+
+        Permission is checked once per distinct account and the rows are
+        written with a single bulk insert. The batch is all or nothing: if any
+        row is rejected nothing is written and the per-row results say why.
+        """
+        rows = request.data
+        if not isinstance(rows, list):
+            return Response({'error': 'Expected a list of transactions.'}, status=status.HTTP_400_BAD_REQUEST)
+        if len(rows) > self.bulk_max_rows:
+            return Response({'error': f'At most {self.bulk_max_rows} transactions per request.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        serializer = TransactionIngestSerializer(data=rows, many=True)
+        if serializer.is_valid():
+            errors = self.check_bulk_permissions(serializer.validated_data)
+        else:
+            errors = serializer.errors
+
+        if any(errors):
+            results = [
+                {'index': index, 'status': 'invalid', 'errors': row_errors} if row_errors else {'index': index, 'status': 'valid'}
+                for index, row_errors in enumerate(errors)
+            ]
+            return Response({'created': 0, 'results': results}, status=status.HTTP_400_BAD_REQUEST)
+
+        instances = [
+            Transaction(account_id=row['account'], user=request.user, amount=row['amount'])
+            for row in serializer.validated_data
+        ]
+        if sharding.is_sharded():
+            for instance, pk in zip(instances, sharding.allocate_ids(Transaction, len(instances))):
+                instance.pk = pk
+        # One transaction per shard, all held open until every shard's rows are
+        # in, so a failure anywhere writes nothing
+        with ExitStack() as stack:
+            for alias, rows in sharding.group_by_shard(instances, key=attrgetter('account_id')).items():
+                stack.enter_context(transaction.atomic(using=alias))
+                Transaction.objects.using(alias).bulk_create(rows, batch_size=self.bulk_batch_size)
+                # bulk_create skips model signals, so post to the ledger and the change feed directly
+                ledger.apply(added=rows, using=alias)
+                events.record(rows, using=alias)
+
+        results = [{'index': index, 'status': 'created', 'id': instance.pk} for index, instance in enumerate(instances)]
+        return Response({'created': len(instances), 'results': results}, status=status.HTTP_201_CREATED)
+
+    def check_bulk_permissions(self, rows):
+        granted = get_account_permissions(self.request)
+        denied = {'account': ['You do not have permission to create transactions.']}
+        return [{} if granted.get(row['account']) in ('crud', 'post') else denied for row in rows]
+
+class AdminTransactionViewSet(ReplicaReadMixin, viewsets.ViewSet):
     permission_classes = [IsAdminUser]
+    pagination_class = KeysetPagination
+    renderer_classes = api_settings.DEFAULT_RENDERER_CLASSES + [NDJSONRenderer, CSVRenderer, ColumnarRenderer]
+    export_chunk_size = reports.EXPORT_CHUNK_SIZE
+    batch_max_rows = reports.BATCH_MAX_ROWS
 
     @action(detail=False, methods=['get'], url_path='admin-transactions')
     def list_user_transactions(self, request):
         user_id = request.query_params.get('user_id')
-        start_date = request.query_params.get('start_date')
-        end_date = request.query_params.get('end_date')
-
-        transactions = Transaction.objects.filter(user__id=user_id)
+        transactions, dates, error = report_queryset(request.query_params)
+        if error:
+            return Response({'error': error}, status=status.HTTP_400_BAD_REQUEST)
+        horizon = archive.get_horizon()
+        archived = archived_report_queryset(request.query_params, dates, horizon)
 
-        if start_date:
-            start_date = parse_datetime(start_date)
-            if start_date is None:
-                return Response({'error': 'Invalid start date format.'}, status=status.HTTP_400_BAD_REQUEST)
-            transactions = transactions.filter(timestamp__gte=start_date)
+        if isinstance(request.accepted_renderer, StreamingRenderer):
+            return self.export(transactions, archived, request.accepted_renderer)
 
-        if end_date:
-            end_date = parse_datetime(end_date)
-            if end_date is None:
-                return Response({'error': 'Invalid end date format.'}, status=status.HTTP_400_BAD_REQUEST)
-            transactions = transactions.filter(timestamp__lte=end_date)
+        if dates:
+            total_balance = sum(sharding.fan_out(lambda: sum(
+                queryset.aggregate(total=models.Sum('amount'))['total'] or 0
+                for queryset in (transactions, archived) if queryset is not None
+            )))
+        else:
+            total_balance = ledger.user_balance(user_id)
 
-        total_balance = transactions.aggregate(total=models.Sum('amount'))['total'] or 0
+        row_serializer = TransactionRowSerializer()
+        paginator = self.pagination_class()
+        page = paginator.paginate_queryset(
+            row_serializer.select(transactions), request, view=self,
+            archive=row_serializer.select(archived) if archived is not None else None, horizon=horizon,
+        )
 
+        serialize = row_serializer.serialize_columns if isinstance(request.accepted_renderer, ColumnarRenderer) else row_serializer.serialize
         data = {
-            'transactions': TransactionSerializer(transactions, many=True).data,
+            'transactions': serialize(page),
             'total_balance': total_balance,
+            'next': paginator.get_next_link(),
+            'previous': paginator.get_previous_link(),
         }
 
         return Response(data)
+
+    def export(self, transactions, archived, renderer):
+        """Stream every matching row, ending with a ``total_balance`` trailer row."""
+        chunks = reports.export(transactions, archived, renderer, chunk_size=self.export_chunk_size)
+        response = StreamingHttpResponse(chunks, content_type=f'{renderer.media_type}; charset={renderer.charset}')
+        response['Content-Disposition'] = f'attachment; filename="transactions.{renderer.format}"'
+        return response
+
+    def batch_report(self, request):
+        """Report on many users and/or accounts at once, grouped by user (see ``reports.batch_report``)."""
+        serializer = BatchReportSerializer(data=request.data if request.method == 'POST' else request.query_params)
+        serializer.is_valid(raise_exception=True)
+        data, error = reports.batch_report(serializer.validated_data, max_rows=self.batch_max_rows)
+        if error:
+            return Response({'error': error}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(data)
+
+class BulkPermissionView(APIView):
+    """
+    Grant and revoke account permissions in bulk (see BulkPermissionSerializer
+    for the body) and answer with what changed.
+
+    Every user and account must exist. The whole matrix is applied or none of
+    it is, with upserts and deletes rather than a write per grant.
+    """
+    permission_classes = [IsAdminUser]
+    lookup_batch_size = 500
+
+    def post(self, request):
+        serializer = BulkPermissionSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        changes = serializer.validated_data['changes']
+
+        unknown = self.find_unknown(changes)
+        if unknown:
+            return Response({'error': 'Unknown users or accounts.', **unknown}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(apply_permission_changes(changes, batch_size=self.lookup_batch_size))
+
+    def find_unknown(self, changes):
+        user_ids = sorted({user_id for user_id, _ in changes})
+        account_ids = sorted({account_id for _, account_id in changes})
+        users = set(chain.from_iterable(
+            User.objects.filter(pk__in=batch).values_list('pk', flat=True) for batch in self.batches(user_ids)
+        ))
+        accounts = set(chain.from_iterable(sharding.fan_out_accounts(lambda ids: [
+            account_id for batch in self.batches(ids)
+            for account_id in InvestmentAccount.objects.filter(pk__in=batch).values_list('pk', flat=True)
+        ], account_ids)))
+        unknown = {
+            'users': [user_id for user_id in user_ids if user_id not in users],
+            'accounts': [account_id for account_id in account_ids if account_id not in accounts],
+        }
+        return {key: ids for key, ids in unknown.items() if ids}
+
+    def batches(self, ids):
+        return [ids[start:start + self.lookup_batch_size] for start in range(0, len(ids), self.lookup_batch_size)]
+
+class ReportJobViewSet(mixins.CreateModelMixin, mixins.ListModelMixin, mixins.RetrieveModelMixin, viewsets.GenericViewSet):
+    """
+    Admin reports and exports run in the background by ``run_jobs``.
+
+    ``POST`` queues a job and answers 202 with its URL; poll that until its
+    ``result`` link appears, then download the file from there. Each user
+    sees only their own jobs and may have ``ACCOUNTS_JOB_USER_LIMIT`` queued
+    or running at a time.
+    """
+    serializer_class = ReportJobSerializer
+    permission_classes = [IsAdminUser]
+
+    def get_queryset(self):
+        return ReportJob.objects.filter(requested_by=self.request.user).order_by('-id')
+
+    def create(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        reports.validate_job_params(serializer.validated_data['kind'], serializer.validated_data.get('params', {}))
+
+        limit = getattr(settings, 'ACCOUNTS_JOB_USER_LIMIT', 5)
+        if jobs.active_job_count(request.user) >= limit:
+            return Response(
+                {'error': f'You already have {limit} jobs queued or running; wait for one to finish.'},
+                status=status.HTTP_429_TOO_MANY_REQUESTS,
+            )
+
+        job = jobs.enqueue(serializer.validated_data['kind'], request.user, serializer.validated_data.get('params', {}))
+        data = self.get_serializer(job).data
+        return Response(data, status=status.HTTP_202_ACCEPTED, headers={'Location': data['url']})
+
+    @action(detail=True, methods=['get'])
+    def result(self, request, pk=None):
+        job = self.get_object()
+        if job.status != 'succeeded':
+            return Response({'error': f'The job is {job.status}.'}, status=status.HTTP_409_CONFLICT)
+        try:
+            result = open(jobs.get_result_path(job), 'rb')
+        except FileNotFoundError:
+            raise Http404('The result file has been removed.')
+        extension = job.result_name.rpartition('.')[2]
+        response = FileResponse(result, as_attachment=True, filename=f'{job.kind}-{job.pk}.{extension}')
+        response['Content-Type'] = job.content_type
+        return response
+
+class MetricsView(APIView):
+    """Request and database metrics for this process, in Prometheus text format."""
+    permission_classes = [IsAdminUser]
+    renderer_classes = [PrometheusRenderer]
+
+    def get(self, request):
+        return Response(metrics.registry.render(), content_type=PrometheusRenderer.content_type)
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -46,6 +47,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'accounts.middleware.RequestMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -87,6 +89,19 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+# Each process keeps its own LocMem cache, so permission changes reach other
+# workers only when their entry expires. Point this at a shared backend such
+# as Redis or Memcached when running more than one process.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
@@ -127,3 +142,88 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# Accounts app
+
+# Seconds a user's account permission map stays cached between requests
+ACCOUNTS_PERMISSION_CACHE_TIMEOUT = 300
+
+# Serve transaction reads and the admin report from native async views;
+# only worthwhile under an ASGI server (see accounts/async_views.py)
+ACCOUNTS_ASYNC_VIEWS = os.environ.get('ACCOUNTS_ASYNC_VIEWS', '') == '1'
+
+# Log SQL queries slower than this many milliseconds to accounts.slow_queries;
+# unset to turn the log off. Request metrics are served at /api/metrics/.
+ACCOUNTS_SLOW_QUERY_MS = float(os.environ['ACCOUNTS_SLOW_QUERY_MS']) if os.environ.get('ACCOUNTS_SLOW_QUERY_MS') else None
+
+# The admin changelists count at most this many matching rows per page load;
+# past it they show the database's estimate (PostgreSQL) or the limit itself
+ACCOUNTS_ADMIN_COUNT_LIMIT = 10000
+
+# Point-in-time balances (/api/accounts/{id}/balance/?as_of=) start from a
+# checkpoint taken every day, week or month; checkpoint_balances adds them
+ACCOUNTS_CHECKPOINT_INTERVAL = 'week'
+
+# archive_transactions moves whole months older than this many days out of
+# the transaction table by default
+ACCOUNTS_ARCHIVE_AFTER_DAYS = 365
+
+# Accounts, grants, transactions and their ledger and archive rows are spread
+# over these aliases by account id (see accounts/sharding.py); users stay on
+# default. To try it locally, list extra sqlite files in ACCOUNTS_SHARD_DBS,
+# e.g. "shard1.sqlite3,shard2.sqlite3", and run migrate with --database for
+# each shard. Cross-shard reads run on ACCOUNTS_SHARD_WORKERS threads.
+ACCOUNTS_SHARDS = ['default']
+for index, name in enumerate(filter(None, os.environ.get('ACCOUNTS_SHARD_DBS', '').split(',')), start=1):
+    DATABASES[f'shard{index}'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / name.strip(),
+    }
+    ACCOUNTS_SHARDS.append(f'shard{index}')
+ACCOUNTS_SHARD_WORKERS = 8
+
+# GET requests on the accounts API read from these database aliases (see
+# accounts/db_routers.py). To try it locally, point ACCOUNTS_REPLICA_DB at a
+# copy of db.sqlite3; under test the replica mirrors the test database.
+if os.environ.get('ACCOUNTS_REPLICA_DB'):
+    DATABASES['replica'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / os.environ['ACCOUNTS_REPLICA_DB'],
+        'TEST': {'MIRROR': 'default'},
+    }
+# Replicas apply only to unsharded deployments
+DATABASE_ROUTERS = ['accounts.sharding.ShardRouter', 'accounts.db_routers.ReplicaRouter']
+ACCOUNTS_DATABASE_REPLICAS = [alias for alias in DATABASES if alias not in ACCOUNTS_SHARDS]
+
+# Seconds a client keeps reading from the primary after it writes, covering replication lag
+ACCOUNTS_REPLICA_LAG_SECONDS = 5
+
+# Background report jobs (see accounts/jobs.py), run by the run_jobs command.
+# Results are written under ACCOUNTS_JOB_RESULTS_DIR. At most
+# ACCOUNTS_JOB_CONCURRENCY jobs run at once across all workers, and each
+# user may have ACCOUNTS_JOB_USER_LIMIT queued or running. A failed job is
+# retried after ACCOUNTS_JOB_RETRY_SECONDS, doubling each time, up to
+# ACCOUNTS_JOB_MAX_ATTEMPTS tries; a worker that stops renewing its lease for
+# ACCOUNTS_JOB_LEASE_SECONDS loses the job to another.
+ACCOUNTS_JOB_RESULTS_DIR = BASE_DIR / 'job_results'
+ACCOUNTS_JOB_CONCURRENCY = 4
+ACCOUNTS_JOB_USER_LIMIT = 5
+ACCOUNTS_JOB_MAX_ATTEMPTS = 3
+ACCOUNTS_JOB_RETRY_SECONDS = 30
+ACCOUNTS_JOB_LEASE_SECONDS = 300
+
+# The transaction change feed at /api/transactions/events/ (see
+# accounts/events.py). A stream sends a keepalive, and re-reads the user's
+# grants, every ACCOUNTS_EVENTS_KEEPALIVE_SECONDS and ends after
+# ACCOUNTS_EVENTS_MAX_SECONDS; the client reconnects ACCOUNTS_EVENTS_RETRY_MS
+# later and is sent up to ACCOUNTS_EVENTS_REPLAY_LIMIT missed events from the
+# log, or told to reload. A client more than ACCOUNTS_EVENTS_QUEUE_SIZE events
+# behind is disconnected. prune_transaction_events keeps
+# ACCOUNTS_EVENTS_RETENTION_DAYS of the log.
+ACCOUNTS_EVENTS_KEEPALIVE_SECONDS = 15
+ACCOUNTS_EVENTS_MAX_SECONDS = 300
+ACCOUNTS_EVENTS_RETRY_MS = 3000
+ACCOUNTS_EVENTS_REPLAY_LIMIT = 1000
+ACCOUNTS_EVENTS_QUEUE_SIZE = 1000
+ACCOUNTS_EVENTS_RETENTION_DAYS = 7